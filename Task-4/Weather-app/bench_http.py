@@ -0,0 +1,144 @@
+"""
+HTTP Session Benchmark
+======================
+
+Runs a local stand-in for the OpenWeatherMap endpoint and times weather
+lookups three ways:
+
+    before   requests.get() per lookup, a new TCP connection every time
+    after    WeatherAPI's pooled session, connections kept alive (the
+             cache bypassed, so every lookup is a request)
+    cached   WeatherAPI.get_weather_data(), cache included: one request,
+             then hits
+
+--connect-delay makes the stand-in wait before answering on each new
+connection, to play the part of the round trips a real TCP + TLS
+handshake to a remote server costs. --fail-every answers every Nth
+request with 503 to show the retries at work.
+
+Usage:
+    python bench_http.py --requests 500 --connect-delay 30 --fail-every 20
+"""
+
+import argparse
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from config import UNITS
+from weather_api import WeatherAPI
+
+SAMPLE = {
+    'name': 'London', 'sys': {'country': 'GB', 'sunrise': 1700000000, 'sunset': 1700030000},
+    'main': {'temp': 11.2, 'feels_like': 10.1, 'temp_min': 9.8, 'temp_max': 12.4,
+             'humidity': 81, 'pressure': 1012},
+    'weather': [{'main': 'Clouds', 'description': 'broken clouds', 'icon': '04d'}],
+    'wind': {'speed': 4.6, 'deg': 240}, 'clouds': {'all': 75}, 'visibility': 10000,
+    'timezone': 0,
+}
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    body = json.dumps(SAMPLE).encode()
+
+    def setup(self):
+        super().setup()
+        # Headers and body go out in separate writes; without this Nagle
+        # holds the body back until the client's delayed ACK (40 ms)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        time.sleep(server.connect_delay)
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            failing = server.fail_every and server.requests % server.fail_every == 0
+        if failing:
+            server.failures += 1
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stand_in(connect_delay, fail_every):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.connect_delay = connect_delay
+    server.fail_every = fail_every
+    server.connections = server.requests = server.failures = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(name, lookup, server, count):
+    server.connections = server.requests = server.failures = 0
+    times = []
+    errors = 0
+    for _ in range(count):
+        started = time.perf_counter()
+        success, _ = lookup('London')
+        times.append(time.perf_counter() - started)
+        errors += not success
+    times.sort()
+    print(f"{name:<8} {percentile(times, 0.50) * 1000:>8.2f} {percentile(times, 0.90) * 1000:>8.2f} "
+          f"{percentile(times, 0.99) * 1000:>8.2f} {sum(times) / count * 1000:>8.2f} "
+          f"{server.connections:>6} {server.failures:>6} {errors:>6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pooled session vs requests.get()")
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--connect-delay', type=float, default=0.0,
+                        help="milliseconds the stand-in waits on every new connection")
+    parser.add_argument('--fail-every', type=int, default=0,
+                        help="answer every Nth request with 503 (0 = never)")
+    args = parser.parse_args()
+
+    server = start_stand_in(args.connect_delay / 1000, args.fail_every)
+    url = f"http://127.0.0.1:{server.server_address[1]}/data/2.5/weather"
+
+    # Backoff off, so the numbers show the cost of the extra request only
+    pooled = WeatherAPI(backoff=0)
+    pooled.base_url = url
+
+    # What get_weather_data() did before: a bare requests.get() per lookup
+    def lookup_bare(city):
+        params = {'q': city, 'appid': pooled.api_key, 'units': UNITS}
+        response = requests.get(url, params=params, timeout=10)
+        if response.status_code != 200:
+            return False, f"API Error: {response.status_code}"
+        return True, pooled.parse_weather_data(response.json())
+
+    print(f"{'':<8} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'mean ms':>8} "
+          f"{'conns':>6} {'503s':>6} {'errors':>6}")
+    run('before', lookup_bare, server, args.requests)
+    run('after', pooled.fetch_weather_data, server, args.requests)
+    run('cached', pooled.get_weather_data, server, args.requests)
+    pooled.close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,18 @@ WINDOW_WIDTH = 450
 WINDOW_HEIGHT = 600
 UNITS = "metric"  
 
+# HTTP Settings
+HTTP_TIMEOUT = 10
+HTTP_POOL_SIZE = 10             # kept-alive connections per host
+HTTP_RETRIES = 3                # for timeouts, dropped connections and 5xx replies
+HTTP_BACKOFF = 0.5              # retries wait 0s, 1s, 2s, ... (urllib3 backoff factor)
+HTTP_RETRY_STATUSES = (500, 502, 503, 504)
+
+# Cache Settings
+CACHE_TTL = 600                 # seconds a lookup is fresh (the provider updates about every 10 min)
+CACHE_STALE_TTL = 3600          # seconds past that it is still shown while being refreshed
+CACHE_SIZE = 100                # cities kept, least recently used dropped first
+
 COLORS = {
     "primary": "#2E86AB",
     "secondary": "#A23B72", 
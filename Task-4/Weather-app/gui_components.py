@@ -13,6 +13,7 @@ from config import *
 class WeatherApp:
     def __init__(self):
         self.root = tk.Tk()
+        self.shown_city = None  # cache key of the city on screen
         self.setup_window()
         self.create_widgets()
         
@@ -326,23 +327,41 @@ class WeatherApp:
             messagebox.showwarning("Input Required", "Please enter a city name!")
             return
         
+        self.shown_city = weather_api.cache_key(city)
+        
+        # Cached data (even if stale) is shown at once; stale data is
+        # refreshed in the background and redrawn when it arrives
+        cached = weather_api.cached_weather(city)
+        if cached is not None:
+            _, age = cached
+            success, result = weather_api.get_weather_data(
+                city, on_refresh=lambda ok, data: self.root.after(0, self.handle_refresh, city, ok, data))
+            self.handle_weather_result(city, success, result)
+            refreshing = ", refreshing..." if age >= weather_api.cache_ttl else ""
+            self.update_status(f"✅ Weather for {result['city']} (cached {int(age // 60)} min ago{refreshing})")
+            return
+        
         # Show loading
         self.search_button.config(state="disabled", text="Loading...")
         self.show_loading()
         
-        # Fetch weather data directly (no threading for now)
+        # Fetch in the background so the window stays responsive
+        threading.Thread(target=self.fetch_weather, args=(city,), daemon=True).start()
+    
+    def fetch_weather(self, city):
+        """Runs on a worker thread; the result is handled in the main thread"""
         try:
             success, result = weather_api.get_weather_data(city)
-            
-            # Handle result directly
-            self.handle_weather_result(success, result)
-            
         except Exception as e:
-            self.search_button.config(state="normal", text="Search")
-            messagebox.showerror("Error", f"An error occurred: {str(e)}")
+            success, result = False, f"An error occurred: {str(e)}"
+        self.root.after(0, self.handle_weather_result, city, success, result)
     
-    def handle_weather_result(self, success, result):
+    def handle_weather_result(self, city, success, result):
         """Handle weather result in main thread"""
+        # A slow lookup must not replace the city searched for after it;
+        # that search re-enables the button when its own result arrives
+        if weather_api.cache_key(city) != self.shown_city:
+            return
         self.search_button.config(state="normal", text="Search")
         
         if success:
@@ -352,6 +371,17 @@ class WeatherApp:
             self.show_error(result)
             messagebox.showerror("Error", result)
     
+    def handle_refresh(self, city, success, result):
+        """A background refresh of cached data finished (main thread)"""
+        # The user may have looked up another city meanwhile
+        if weather_api.cache_key(city) != self.shown_city:
+            return
+        if success:
+            self.display_weather_data(result)
+            self.update_status(f"✅ Weather updated for {result['city']}")
+        else:
+            self.update_status(f"⚠️ Could not refresh ({result}), showing cached data")
+    
     def show_loading(self):
         """Show loading screen"""
         for widget in self.weather_frame.winfo_children():
@@ -3,17 +3,153 @@
 
 import requests
 import json
-from config import API_KEY, BASE_URL, UNITS, HTTP_SUCCESS, HTTP_NOT_FOUND, HTTP_UNAUTHORIZED
+import threading
+import time
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.util.retry import Retry
+from config import (API_KEY, BASE_URL, UNITS, HTTP_SUCCESS, HTTP_NOT_FOUND, HTTP_UNAUTHORIZED,
+                    HTTP_TIMEOUT, HTTP_POOL_SIZE, HTTP_RETRIES, HTTP_BACKOFF, HTTP_RETRY_STATUSES,
+                    CACHE_TTL, CACHE_STALE_TTL, CACHE_SIZE)
 
 class WeatherAPI:
-    def __init__(self):
+    def __init__(self, pool_size=HTTP_POOL_SIZE, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF,
+                 cache_ttl=CACHE_TTL, stale_ttl=CACHE_STALE_TTL, cache_size=CACHE_SIZE):
         self.api_key = API_KEY
         self.base_url = BASE_URL
         self.units = UNITS
+        self.session = self.create_session(pool_size, retries, backoff)
+        
+        # (city, units) -> (fetched at, parsed data), least recently used first
+        self.cache = OrderedDict()
+        self.cache_ttl = cache_ttl
+        self.stale_ttl = stale_ttl
+        self.cache_size = cache_size
+        self.cache_lock = threading.Lock()
+        self.refreshing = {}        # key -> on_refresh callbacks waiting for it
+        self.cache_hits = 0
+        self.stale_hits = 0
+        self.cache_misses = 0
+    
+    def create_session(self, pool_size, retries, backoff):
+        """
+        One session for every request, so lookups reuse kept-alive
+        connections instead of opening a new one each time
+        """
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=HTTP_RETRY_STATUSES,
+            allowed_methods=frozenset(['GET']),
+            # After the last retry, hand back the 5xx response itself
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                              max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
     
-    def get_weather_data(self, city_name):
+    def close(self):
+        """
+        Close the pooled connections
+        """
+        self.session.close()
+    
+    def cache_key(self, city_name):
+        """
+        Lookups differing only in case or spacing share a cache entry
         """
-        Fetch weather data for a given city
+        return ' '.join(city_name.split()).casefold(), self.units
+    
+    def cached_weather(self, city_name):
+        """
+        Cached data for a city and its age in seconds, or None if
+        get_weather_data() would have to wait for the network.
+        Does not count as a hit or miss.
+        """
+        with self.cache_lock:
+            entry = self.cache.get(self.cache_key(city_name))
+        if entry is None:
+            return None
+        fetched_at, data = entry
+        age = time.monotonic() - fetched_at
+        if age >= self.cache_ttl + self.stale_ttl:
+            return None
+        return data, age
+    
+    def cache_stats(self):
+        """
+        Hit/miss counters and the number of cached cities
+        """
+        with self.cache_lock:
+            return {
+                'hits': self.cache_hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.cache_misses,
+                'size': len(self.cache)
+            }
+    
+    def clear_cache(self):
+        with self.cache_lock:
+            self.cache.clear()
+    
+    def get_weather_data(self, city_name, on_refresh=None):
+        """
+        Weather data for a city, from the cache while it is fresh.
+        Data past its TTL but within the stale window is returned at once
+        and refreshed in a background thread, which then calls
+        on_refresh(success, data/error_message) if given.
+        Returns: tuple (success, data/error_message)
+        """
+        key = self.cache_key(city_name)
+        now = time.monotonic()
+        with self.cache_lock:
+            entry = self.cache.get(key)
+            age = now - entry[0] if entry is not None else None
+            if age is not None and age < self.cache_ttl:
+                self.cache.move_to_end(key)
+                self.cache_hits += 1
+                return True, entry[1]
+            if age is not None and age < self.cache_ttl + self.stale_ttl:
+                self.cache.move_to_end(key)
+                self.stale_hits += 1
+                # One refresh per city at a time; later callers wait for it too
+                if key not in self.refreshing:
+                    self.refreshing[key] = []
+                    threading.Thread(target=self.refresh, args=(city_name, key),
+                                     daemon=True).start()
+                if on_refresh is not None:
+                    self.refreshing[key].append(on_refresh)
+                return True, entry[1]
+            self.cache_misses += 1
+        return self.fetch_and_store(city_name, key)
+    
+    def refresh(self, city_name, key):
+        try:
+            success, result = self.fetch_and_store(city_name, key)
+        finally:
+            with self.cache_lock:
+                callbacks = self.refreshing.pop(key)
+        for on_refresh in callbacks:
+            on_refresh(success, result)
+    
+    def fetch_and_store(self, city_name, key):
+        success, result = self.fetch_weather_data(city_name)
+        # Failures are not cached: a stale entry stays until it ages out
+        if success:
+            with self.cache_lock:
+                self.cache[key] = (time.monotonic(), result)
+                self.cache.move_to_end(key)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return success, result
+    
+    def fetch_weather_data(self, city_name):
+        """
+        Fetch weather data for a given city from the API
         Returns: tuple (success, data/error_message)
         """
         try:
@@ -25,7 +161,7 @@ class WeatherAPI:
             }
             
             
-            response = requests.get(self.base_url, params=params, timeout=10)
+            response = self.session.get(self.base_url, params=params, timeout=HTTP_TIMEOUT)
             
             
             if response.status_code == HTTP_SUCCESS:
@@ -41,12 +177,16 @@ class WeatherAPI:
             else:
                 return False, f"API Error: {response.status_code}"
                 
-        except requests.exceptions.ConnectionError:
-            return False, "No internet connection! Please check your network."
-        
         except requests.exceptions.Timeout:
             return False, "Request timeout! Please try again."
         
+        except requests.exceptions.ConnectionError as e:
+            # Read timeouts that outlast the retries arrive as a ConnectionError
+            reason = getattr(e.args[0], 'reason', None) if e.args else None
+            if isinstance(reason, ReadTimeoutError):
+                return False, "Request timeout! Please try again."
+            return False, "No internet connection! Please check your network."
+        
         except requests.exceptions.RequestException as e:
             return False, f"Request error: {str(e)}"
         
@@ -118,7 +258,7 @@ class WeatherAPI:
                 'units': self.units
             }
             
-            response = requests.get(self.base_url, params=test_params, timeout=5)
+            response = self.session.get(self.base_url, params=test_params, timeout=5)
             
             if response.status_code == HTTP_UNAUTHORIZED:
                 return False, "Invalid API key!"
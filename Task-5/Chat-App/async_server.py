@@ -0,0 +1,203 @@
+"""
+asyncio engine
+==============
+
+Every client is served by coroutines on one event loop, which runs in a
+thread of its own so the engine can be started and stopped from ordinary
+code. Many thousands of mostly idle connections cost little more than
+their socket buffers.
+"""
+
+import asyncio
+import threading
+
+import lifecycle
+import outbound
+import protocol
+from history import ChatHistory
+from hub import ChatHub
+from registry import ClientRegistry
+
+
+class AsyncEngine:
+    def __init__(self, config, chat_log=None, tls_context=None):
+        self.config = config
+        self.tls = tls_context
+        # All connections are multiplexed on one event loop, so the registry
+        # is only ever touched from the loop thread
+        self.registry = ClientRegistry()
+        self.hub = ChatHub(self.registry, self.disconnect, ChatHistory(config.history), chat_log)
+        self.loop = None
+        self.server = None
+        self.address = None
+        self.stopped = None
+        self.thread = None
+        self.error = None
+
+    # ----------------- Connections -----------------
+    def disconnect(self, writer):
+        writer.transport.abort()
+
+    async def write(self, writer, queue):
+        try:
+            while True:
+                batch = await queue.get_batch()
+                if batch is None:
+                    break
+                writer.writelines(batch)
+                self.hub.socket_writes.inc()
+                await writer.drain()
+        except OSError:
+            queue.close()
+            writer.transport.abort()
+            return
+        # Everything queued is written; close() flushes the transport first
+        writer.close()
+
+    async def handle(self, reader, writer):
+        hub = self.hub
+        config = self.config
+        address = writer.get_extra_info('peername')
+        print(f"Connected with {str(address)}")
+        # asyncio turns Nagle off on every connection; honour --no-tcp-nodelay
+        protocol.tune_socket(writer.get_extra_info('socket'), config.tcp_nodelay)
+        ssl_object = writer.get_extra_info('ssl_object')
+        if ssl_object is not None:
+            hub.tls_connected(ssl_object.session_reused)
+
+        frames = protocol.FrameReader()
+        try:
+            writer.write(protocol.encode(protocol.NICK, ' '.join(hub.features)))
+            frame_type, payload = await asyncio.wait_for(
+                protocol.read_frame(reader, frames, config.recv_size), config.handshake_timeout)
+        except (OSError, protocol.ProtocolError, asyncio.TimeoutError):
+            frame_type = None
+        if frame_type == protocol.NICK:
+            nickname, features = protocol.parse_nick(payload)
+            if not protocol.valid_nickname(nickname):
+                writer.write(protocol.encode(protocol.SYSTEM, protocol.NICKNAME_RULES))
+                frame_type = None
+        if frame_type != protocol.NICK:
+            print(f"Handshake with {str(address)} failed")
+            hub.handshake_failures.inc()
+            writer.close()
+            return
+        queue = outbound.AsyncOutboundQueue(config.queue_size, config.slow_policy)
+        writer_task = asyncio.ensure_future(self.write(writer, queue))
+
+        try:
+            client = hub.join(writer, nickname, queue, features)
+            print(f"Nickname of the client is {client.nickname}")
+            # Anything that arrived together with the nickname is parsed first
+            batch = frames.feed(b'')
+            while True:
+                for frame_type, payload in batch:
+                    # Block policy: stop reading from the sender until the
+                    # lagging clients have caught up
+                    for lagging in hub.handle_frame(client, frame_type, payload):
+                        await lagging.wait_for_space()
+                batch = await protocol.read_frames(reader, frames, config.recv_size)
+                hub.socket_reads.inc()
+        except (OSError, protocol.ProtocolError):
+            pass
+        finally:
+            hub.leave(writer)
+            queue.close()
+            writer_task.cancel()
+            writer.close()
+
+    async def heartbeat(self):
+        # One task drives the timer wheel for every connection
+        while True:
+            await asyncio.sleep(self.hub.wheel.tick)
+            self.hub.heartbeat()
+
+    # ----------------- Serving -----------------
+    def serve(self, bus=None):
+        """Start the event loop thread and wait until it is listening.
+        Returns the (host, port) the server is listening on."""
+        ready = threading.Event()
+        self.thread = threading.Thread(target=asyncio.run, args=(self.run(bus, ready),),
+                                       name='event-loop')
+        self.thread.start()
+        ready.wait()
+        if self.error is not None:
+            self.thread.join()
+            raise self.error
+        return self.address
+
+    async def run(self, bus, ready):
+        config = self.config
+        try:
+            self.loop = asyncio.get_running_loop()
+            self.stopped = asyncio.Event()
+            if bus is not None:
+                # Bus messages arrive on the bus thread and are delivered on the loop
+                self.hub.bus = bus
+                bus.start(self.hub, self.loop.call_soon_threadsafe)
+            listener = lifecycle.inherited_listener()
+            # asyncio accepts up to `backlog` pending connections per wakeup, so
+            # reconnect storms are drained in batches
+            if listener is None:
+                self.server = await asyncio.start_server(
+                    self.handle, config.host, config.port, backlog=config.backlog,
+                    reuse_address=True, reuse_port=bus is not None, ssl=self.tls,
+                    ssl_handshake_timeout=config.handshake_timeout if self.tls else None)
+                self.address = self.server.sockets[0].getsockname()[:2]
+                print(f"Server started on {config.host}:{self.address[1]}")
+            else:
+                self.server = await asyncio.start_server(
+                    self.handle, sock=listener, backlog=config.backlog, ssl=self.tls,
+                    ssl_handshake_timeout=config.handshake_timeout if self.tls else None)
+                self.address = listener.getsockname()[:2]
+                print(f"Server took over {self.address} from the previous process")
+        except BaseException as e:
+            self.error = e
+            ready.set()
+            return
+        for sock in self.server.sockets:
+            protocol.tune_socket(sock, config.tcp_nodelay, config.sndbuf, config.rcvbuf)
+        print("Server is running and waiting for connections...")
+        if self.hub.ping_interval:
+            asyncio.ensure_future(self.heartbeat())
+        ready.set()
+        await self.stopped.wait()
+        await self.drain()
+
+    # ----------------- Shutdown -----------------
+    def stop(self, restart=False):
+        """Begin a graceful shutdown; safe to call from any thread or a
+        signal handler. With restart, a new process takes over the port."""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._stop, restart)
+
+    def _stop(self, restart):
+        hub = self.hub
+        if hub.draining:
+            return
+        print("Restarting..." if restart else "Shutting down...")
+        hub.begin_drain(lifecycle.RESTART_REASON if restart else lifecycle.SHUTDOWN_REASON)
+        if restart:
+            lifecycle.spawn_successor(self.server.sockets[0])
+        self.server.close()
+        self.stopped.set()
+
+    async def drain(self):
+        hub = self.hub
+        # The timeout covers the goodbyes too, however they are spread
+        deadline = self.loop.time() + hub.drain_timeout
+        clients = self.registry.clients()
+        pause = hub.drain_spread / len(clients) if clients else 0
+        for client in clients:
+            hub.goodbye(client)
+            await asyncio.sleep(max(0, min(pause, deadline - self.loop.time())))
+        while len(self.registry) and self.loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        for client in self.registry.clients():
+            self.disconnect(client.key)
+        print(f"Drained {len(clients)} clients")
+
+    def wait(self, timeout=None):
+        """Block until the server has drained. Returns True if it has."""
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
@@ -0,0 +1,76 @@
+"""
+Chat log write benchmark
+========================
+
+Measures sustained append throughput of the on-disk chat log with
+per-message writes (batch size 0: one write() per record) against
+batched writes, for each fsync policy. Finishes with an mmap read-back
+of the whole log.
+
+Usage:
+    python bench_chatlog.py --messages 200000 --size 120
+"""
+
+import argparse
+import shutil
+import tempfile
+import time
+
+import chatlog
+import protocol
+
+
+def run(directory, messages, frame, batch_size, fsync):
+    log = chatlog.ChatLog(directory, batch_size=batch_size, fsync=fsync,
+                          fsync_interval=0.1)
+    started = time.perf_counter()
+    for i in range(messages):
+        log.append('lobby', frame)
+    log.close()
+    return time.perf_counter() - started
+
+
+def read_back(directory, page=1000):
+    log = chatlog.ChatLog(directory, batch_size=0)
+    started = time.perf_counter()
+    offset = 0
+    total = 0
+    while True:
+        records, offset = log.read_since(offset, 'lobby', page)
+        if not records:
+            break
+        total += len(records)
+    log.close()
+    return total, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat log write throughput")
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--size', type=int, default=120, help="chat text bytes per message")
+    parser.add_argument('--always-messages', type=int, default=2000,
+                        help="messages for the fsync=always runs, which are much slower")
+    args = parser.parse_args()
+
+    frame = protocol.encode(protocol.CHAT, 'x' * args.size)
+    print(f"{'mode':<12} {'fsync':<9} {'messages':>9} {'msgs/s':>11} {'MB/s':>8}")
+    for fsync in chatlog.FSYNC_POLICIES:
+        messages = args.always_messages if fsync == 'always' else args.messages
+        for mode, batch_size in (('per-message', 0), ('batched', chatlog.DEFAULT_BATCH_SIZE)):
+            directory = tempfile.mkdtemp(prefix='chatlog-bench-')
+            try:
+                elapsed = run(directory, messages, frame, batch_size, fsync)
+                rate = messages / elapsed
+                print(f"{mode:<12} {fsync:<9} {messages:>9} {rate:>11.0f} "
+                      f"{rate * len(frame) / 1e6:>8.1f}")
+                if fsync == 'never' and mode == 'batched':
+                    total, read_time = read_back(directory)
+            finally:
+                shutil.rmtree(directory)
+
+    print(f"\nmmap read-back: {total} records in {read_time:.2f}s "
+          f"({total / read_time:.0f} records/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Frame compression benchmark
+===========================
+
+Compares bytes on the wire and CPU time for raw frames against the
+negotiated per-message compression, for a few kinds of chat traffic:
+short chat lines, longer prose and pasted logs.
+
+Per-message compression (what the server does) is measured as one
+compress per broadcast plus, for every recipient, the time to parse and
+inflate what it receives. For reference it is also compared with a
+per-connection streaming context, which compresses better because it
+remembers earlier messages, but has to run once per recipient since every
+connection's stream state differs.
+
+Usage:
+    python bench_compression.py --messages 5000 --recipients 100
+"""
+
+import argparse
+import random
+import time
+import zlib
+
+import protocol
+
+WORDS = ("hello everyone anyone know why the build is failing again I think "
+         "it was working yesterday could you please have a look at this when "
+         "you get a chance thanks really appreciate it okay sounds good").split()
+
+LOG_LINES = (
+    'Traceback (most recent call last):',
+    '  File "/srv/app/worker.py", line 214, in run_job',
+    '    result = handler(payload)',
+    '  File "/srv/app/handlers.py", line 88, in handle',
+    "KeyError: 'user_id'",
+    '2024-05-02 10:15:32,114 INFO worker-3 job 4411 finished in 0.84s',
+    '2024-05-02 10:15:32,587 WARNING worker-1 retrying https://api.example.com/v1/items',
+    '2024-05-02 10:15:33,001 ERROR worker-2 connection reset by peer',
+)
+
+
+def chat_line(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+
+
+def prose(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(40, 80)))
+
+
+def pasted_log(rng):
+    return '\n'.join(rng.choice(LOG_LINES) for _ in range(rng.randint(5, 20)))
+
+
+def make_frames(kind, count, seed=1):
+    rng = random.Random(seed)
+    return [protocol.encode(protocol.CHAT, f"user{rng.randint(1, 50)}: {kind(rng)}")
+            for _ in range(count)]
+
+
+def read_time(frames, recipients):
+    """Time for every recipient to parse the frames; they all receive the
+    same bytes, so one reader is timed and the result scaled"""
+    started = time.perf_counter()
+    reader = protocol.FrameReader()
+    for frame in frames:
+        reader.feed(frame)
+    return (time.perf_counter() - started) * recipients
+
+
+def bench_raw(frames, recipients):
+    return sum(len(f) for f in frames) * recipients, 0.0, read_time(frames, recipients)
+
+
+def bench_per_message(frames, recipients):
+    started = time.perf_counter()
+    compressed = [protocol.compress(f) for f in frames]
+    compress_time = time.perf_counter() - started
+    return (sum(len(c) for c in compressed) * recipients, compress_time,
+            read_time(compressed, recipients))
+
+
+def bench_streaming(frames, recipients):
+    """One deflate stream per connection, flushed after every message"""
+    started = time.perf_counter()
+    compressor = zlib.compressobj(protocol.COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    chunks = [compressor.compress(f) + compressor.flush(zlib.Z_SYNC_FLUSH) for f in frames]
+    compress_time = (time.perf_counter() - started) * recipients
+
+    started = time.perf_counter()
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    reader = protocol.FrameReader()
+    for chunk in chunks:
+        reader.feed(decompressor.decompress(chunk))
+    return (sum(len(c) for c in chunks) * recipients, compress_time,
+            (time.perf_counter() - started) * recipients)
+
+
+MODES = (('raw', bench_raw), ('per-message', bench_per_message), ('streaming', bench_streaming))
+TRAFFIC = (('chat lines', chat_line), ('prose', prose), ('pasted logs', pasted_log))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Frame compression: bytes on wire and CPU")
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--recipients', type=int, default=100,
+                        help="clients each broadcast is delivered to")
+    args = parser.parse_args()
+
+    print(f"{args.messages} broadcasts to {args.recipients} recipients each\n")
+    print(f"{'traffic':<12} {'mode':<12} {'wire MB':>9} {'ratio':>7} "
+          f"{'compress ms':>12} {'read ms':>9}")
+    for name, kind in TRAFFIC:
+        frames = make_frames(kind, args.messages)
+        raw_bytes = None
+        for mode, bench in MODES:
+            wire, compress_time, parse_time = bench(frames, args.recipients)
+            if raw_bytes is None:
+                raw_bytes = wire
+            print(f"{name:<12} {mode:<12} {wire / 1e6:>9.2f} {wire / raw_bytes:>7.2f} "
+                  f"{compress_time * 1000:>12.1f} {parse_time * 1000:>9.1f}")
+        print()
+
+
+if __name__ == '__main__':
+    main()
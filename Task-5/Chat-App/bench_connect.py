@@ -0,0 +1,103 @@
+"""
+Connect-storm benchmark
+=======================
+
+Simulates the reconnect storm after a server restart: a few clients
+connect and never send a nickname, then N clients connect at the same
+moment. For every client it measures the time from starting the TCP
+connect to receiving the server's welcome message, i.e. a completed
+NICK handshake, and reports latency percentiles per engine.
+
+Usage:
+    python bench_connect.py --clients 5000 --stalled 5
+"""
+
+import argparse
+import asyncio
+import time
+
+import protocol
+from bench_engines import raise_fd_limit, start_server, wait_for_port
+
+
+async def storm_client(port, index, timeout):
+    started = time.monotonic()
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    frames = protocol.FrameReader()
+    try:
+        frame_type, _ = await asyncio.wait_for(protocol.read_frame(reader, frames), timeout)
+        if frame_type != protocol.NICK:
+            raise RuntimeError("unexpected greeting")
+        writer.write(protocol.encode(protocol.NICK, f"storm{index}"))
+        deadline = started + timeout
+        while True:
+            frame_type, payload = await asyncio.wait_for(
+                protocol.read_frame(reader, frames), deadline - time.monotonic())
+            if frame_type == protocol.SYSTEM and payload.startswith(b"Connected to the server"):
+                return time.monotonic() - started, writer
+    except BaseException:
+        writer.close()
+        raise
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run_engine(engine, port, n_clients, n_stalled, timeout):
+    proc = start_server(engine, port, ('--handshake-timeout', str(timeout / 2)))
+    writers = []
+    try:
+        probe = await wait_for_port(port)
+        writers.append(probe.writer)
+
+        # Connections that never finish the handshake
+        for _ in range(n_stalled):
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writers.append(writer)
+
+        started = time.monotonic()
+        results = await asyncio.gather(*(storm_client(port, i, timeout) for i in range(n_clients)),
+                                       return_exceptions=True)
+        elapsed = time.monotonic() - started
+
+        latencies = sorted(r[0] for r in results if isinstance(r, tuple))
+        writers.extend(r[1] for r in results if isinstance(r, tuple))
+        return {
+            'engine': engine,
+            'ok': len(latencies),
+            'elapsed': elapsed,
+            'p50': percentile(latencies, 0.50) if latencies else float('nan'),
+            'p95': percentile(latencies, 0.95) if latencies else float('nan'),
+            'p99': percentile(latencies, 0.99) if latencies else float('nan'),
+            'max': latencies[-1] if latencies else float('nan'),
+        }
+    finally:
+        for writer in writers:
+            writer.close()
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Connect-storm latency")
+    parser.add_argument('--clients', type=int, default=5000)
+    parser.add_argument('--stalled', type=int, default=5,
+                        help="clients that connect first and never send a nickname")
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--port', type=int, default=5060)
+    parser.add_argument('--engines', nargs='+', default=['threaded', 'asyncio'])
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    print(f"{'engine':<10} {'ok':>6} {'total s':>8} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'max ms':>8}")
+    for i, engine in enumerate(args.engines):
+        r = asyncio.run(run_engine(engine, args.port + i, args.clients, args.stalled,
+                                   args.timeout))
+        print(f"{r['engine']:<10} {r['ok']:>6} {r['elapsed']:>8.2f} {r['p50'] * 1000:>8.0f} "
+              f"{r['p95'] * 1000:>8.0f} {r['p99'] * 1000:>8.0f} {r['max'] * 1000:>8.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""
+Load benchmark: threaded engine vs asyncio engine
+=================================================
+
+Starts each server engine in a subprocess, connects N headless clients,
+completes the NICK handshake for all of them and then has a few of them
+send fixed-size messages for a while. Reports how many connections were
+held and how many message deliveries per second reached the clients.
+
+Usage:
+    python bench_engines.py --clients 2000 --senders 10 --duration 5
+"""
+
+import argparse
+import asyncio
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import protocol
+
+MESSAGE_SIZE = 64
+# The senders deliberately flood the server, so flood control is turned off
+UNLIMITED = ('--rate-messages', '0', '--rate-bytes', '0')
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def start_server(engine, port, extra_args=()):
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.Popen(
+        [sys.executable, 'server.py', '--engine', engine,
+         '--host', '127.0.0.1', '--port', str(port), *extra_args],
+        cwd=here, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        preexec_fn=raise_fd_limit)
+    return proc
+
+
+async def wait_for_port(port, timeout=10, ssl=None):
+    """Connect a probe client once the server is up and return it; the
+    caller closes it whenever it likes."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        probe = BenchClient('probe')
+        try:
+            await probe.connect(port, ssl=ssl)
+            return probe
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"server on port {port} did not come up")
+
+
+class BenchClient:
+    def __init__(self, index):
+        self.nickname = f"bench{index}"
+        self.received = 0
+        self.frames = protocol.FrameReader()
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, port, timeout=10, ssl=None):
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', port, ssl=ssl)
+        frame_type, _ = await asyncio.wait_for(
+            protocol.read_frame(self.reader, self.frames), timeout)
+        if frame_type != protocol.NICK:
+            raise RuntimeError("unexpected greeting")
+        self.writer.write(protocol.encode(protocol.NICK, self.nickname))
+        await self.writer.drain()
+
+    async def read_loop(self):
+        try:
+            while True:
+                for frame_type, payload in await protocol.read_frames(self.reader, self.frames):
+                    if frame_type == protocol.CHAT:
+                        self.received += 1
+                    elif frame_type == protocol.PING:
+                        self.writer.write(protocol.encode(protocol.PONG, payload))
+        except (OSError, protocol.ProtocolError, asyncio.CancelledError):
+            pass
+
+    async def send_loop(self, stop_at):
+        message = protocol.encode(protocol.CHAT, 'x' * MESSAGE_SIZE)
+        sent = 0
+        while time.monotonic() < stop_at:
+            self.writer.write(message)
+            try:
+                await asyncio.wait_for(self.writer.drain(), stop_at - time.monotonic() + 1)
+            except (asyncio.TimeoutError, ConnectionError, OSError):
+                # The server stopped reading from us or dropped us
+                break
+            sent += 1
+            # Yield so readers get a fair share of the loop
+            await asyncio.sleep(0)
+        return sent
+
+
+async def run_engine(engine, port, n_clients, n_senders, duration):
+    proc = start_server(engine, port, UNLIMITED)
+    try:
+        probe = await wait_for_port(port)
+        probe_reader = asyncio.ensure_future(probe.read_loop())
+
+        clients = [BenchClient(i) for i in range(n_clients)]
+        started = time.monotonic()
+        results = await asyncio.gather(*(c.connect(port) for c in clients),
+                                       return_exceptions=True)
+        connected = [c for c, r in zip(clients, results) if r is None]
+        for c, r in zip(clients, results):
+            if r is not None and c.writer is not None:
+                c.writer.close()
+        connect_time = time.monotonic() - started
+
+        readers = [asyncio.ensure_future(c.read_loop()) for c in connected]
+        # Let the join notices settle before counting
+        await asyncio.sleep(1)
+        for c in connected:
+            c.received = 0
+
+        stop_at = time.monotonic() + duration
+        sent = await asyncio.gather(*(c.send_loop(stop_at) for c in connected[:n_senders]))
+        await asyncio.sleep(0.5)
+
+        delivered = sum(c.received for c in connected)
+        for task in readers + [probe_reader]:
+            task.cancel()
+        for c in connected:
+            c.writer.close()
+
+        return {
+            'engine': engine,
+            'connected': len(connected),
+            'connect_time': connect_time,
+            'sent_per_sec': sum(sent) / duration,
+            'delivered_per_sec': delivered / duration,
+        }
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare chat server engines")
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--senders', type=int, default=5)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--engines', nargs='+', default=['threaded', 'asyncio'])
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    print(f"{'engine':<10} {'held':>6} {'connect s':>10} {'sent/s':>10} {'delivered/s':>12}")
+    for i, engine in enumerate(args.engines):
+        result = asyncio.run(run_engine(engine, args.port + i, args.clients,
+                                        args.senders, args.duration))
+        print(f"{result['engine']:<10} {result['connected']:>6} "
+              f"{result['connect_time']:>10.2f} {result['sent_per_sec']:>10.0f} "
+              f"{result['delivered_per_sec']:>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+File transfer benchmark
+=======================
+
+Starts a local server and three library clients: alice sends a file of
+--size MB to bob while carol keeps chatting. Reports the transfer rate
+each side saw and how long carol's messages took to reach bob, who
+receives them on the same connection as the file, before and during the
+transfer.
+
+Usage:
+    python bench_files.py --engines threaded asyncio --size 200
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+import protocol
+from bench_engines import UNLIMITED, start_server, wait_for_port
+from chat_client import ChatClient, Message, Transfer
+
+CHAT_INTERVAL = 0.02
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def same_contents(a, b):
+    with open(a, 'rb') as f, open(b, 'rb') as g:
+        while True:
+            block = f.read(1024 * 1024)
+            if block != g.read(1024 * 1024):
+                return False
+            if not block:
+                return True
+
+
+async def chatter_loop(carol, phase, stop):
+    """carol sends timestamps until stop is set; bob's side records them"""
+    while not stop.is_set():
+        carol.send(f"{phase} {time.monotonic()}")
+        await asyncio.sleep(CHAT_INTERVAL)
+
+
+async def watch(client, latencies, transfers):
+    async for event in client:
+        if isinstance(event, Transfer):
+            transfers.put_nowait(event)
+        elif isinstance(event, Message) and event.type == protocol.CHAT:
+            phase, _, sent = event.text.rpartition(' ')
+            phase = phase.rpartition(' ')[2]
+            if phase in latencies:
+                latencies[phase].append((time.monotonic() - float(sent)) * 1000)
+
+
+async def run_engine(engine, args):
+    proc = start_server(engine, args.port, (*UNLIMITED, '--max-file-mb', str(args.size + 1)))
+    workdir = tempfile.mkdtemp(prefix='bench-files-')
+    path = os.path.join(workdir, 'payload.bin')
+    with open(path, 'wb') as f:
+        for _ in range(args.size):
+            f.write(os.urandom(1024 * 1024))
+    clients = []
+    try:
+        probe = await wait_for_port(args.port)
+        probe.writer.close()
+        alice = ChatClient('alice', port=args.port, compress=False, reconnect=False)
+        bob = ChatClient('bob', port=args.port, compress=False, reconnect=False,
+                         download_dir=os.path.join(workdir, 'downloads'),
+                         max_download_size=(args.size + 1) * 1024 * 1024)
+        carol = ChatClient('carol', port=args.port, compress=False, reconnect=False)
+        clients = [alice, bob, carol]
+        for client in clients:
+            await client.connect()
+        latencies = {'idle': [], 'busy': []}
+        sent, received = asyncio.Queue(), asyncio.Queue()
+        watchers = [asyncio.ensure_future(watch(alice, {}, sent)),
+                    asyncio.ensure_future(watch(bob, latencies, received)),
+                    asyncio.ensure_future(watch(carol, {}, asyncio.Queue()))]
+
+        stop = asyncio.Event()
+        chatter = asyncio.ensure_future(chatter_loop(carol, 'idle', stop))
+        await asyncio.sleep(args.idle)
+        stop.set()
+        await chatter
+
+        stop = asyncio.Event()
+        chatter = asyncio.ensure_future(chatter_loop(carol, 'busy', stop))
+        alice.send_file(path, 'bob')
+        upload = await sent.get()
+        download = await received.get()
+        stop.set()
+        await chatter
+        await asyncio.sleep(0.2)
+        for task in watchers:
+            task.cancel()
+        intact = download.path is not None and same_contents(path, download.path)
+    finally:
+        for client in clients:
+            await client.close()
+        proc.terminate()
+        proc.wait()
+        shutil.rmtree(workdir)
+    return {
+        'engine': engine,
+        'error': upload.error or download.error,
+        'send_mbps': upload.rate / 1e6,
+        'recv_mbps': download.rate / 1e6,
+        'intact': intact,
+        'idle_p50': statistics.median(latencies['idle'] or [0]),
+        'idle_p99': percentile(latencies['idle'], 0.99),
+        'busy_p50': statistics.median(latencies['busy'] or [0]),
+        'busy_p99': percentile(latencies['busy'], 0.99),
+        'busy_count': len(latencies['busy']),
+    }
+
+
+def print_row(result):
+    if result['error']:
+        print(f"{result['engine']:<9} failed: {result['error']}")
+        return
+    print(f"{result['engine']:<9} {result['send_mbps']:>8.1f} {result['recv_mbps']:>8.1f} "
+          f"{str(result['intact']):>6} {result['idle_p50']:>8.2f} {result['idle_p99']:>8.2f} "
+          f"{result['busy_p50']:>8.2f} {result['busy_p99']:>8.2f} {result['busy_count']:>6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="File transfer benchmark")
+    parser.add_argument('--engines', nargs='+', default=['threaded', 'asyncio'])
+    parser.add_argument('--port', type=int, default=5092)
+    parser.add_argument('--size', type=int, default=100, help="MB to send")
+    parser.add_argument('--idle', type=float, default=2.0,
+                        help="seconds of chat measured before the transfer starts")
+    args = parser.parse_args()
+
+    print(f"{'engine':<9} {'send MB/s':>8} {'recv MB/s':>8} {'intact':>6} {'idle p50':>8} "
+          f"{'idle p99':>8} {'busy p50':>8} {'busy p99':>8} {'msgs':>6}")
+    for engine in args.engines:
+        print_row(asyncio.run(run_engine(engine, args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Socket tuning benchmark
+=======================
+
+Runs the headless load generator against a local server once per set of
+socket options and reports, next to loadgen's latency percentiles, how
+many reads and writes the server issued on client sockets per message it
+delivered (scraped from the chat_socket_*_total metrics).
+
+The variants:
+
+    nagle     --no-tcp-nodelay --send-mode join   (how the threaded engine used to run)
+    nodelay   --send-mode join
+    sendmsg   the defaults: TCP_NODELAY and sendmsg() of queued frames
+    buffers   the defaults with 256 KB SO_SNDBUF/SO_RCVBUF
+
+Usage:
+    python bench_sockets.py --engines threaded asyncio --clients 200 --senders 20 --rate 20
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from bench_engines import UNLIMITED, start_server
+
+VARIANTS = {
+    'nagle': ('--no-tcp-nodelay', '--send-mode', 'join'),
+    'nodelay': ('--send-mode', 'join'),
+    'sendmsg': (),
+    'buffers': ('--sndbuf', '262144', '--rcvbuf', '262144'),
+}
+
+
+def scrape(port, names):
+    """Current values of the named counters from the metrics endpoint"""
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=5) as response:
+        text = response.read().decode()
+    values = dict.fromkeys(names, 0.0)
+    for line in text.splitlines():
+        name, _, value = line.partition(' ')
+        if name in values:
+            values[name] = float(value)
+    return values
+
+
+def wait_for_metrics(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            return scrape(port, ())
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("server did not come up")
+
+
+def run_variant(engine, name, args):
+    server_args = (*UNLIMITED, '--metrics-port', str(args.metrics_port), *VARIANTS[name])
+    proc = start_server(engine, args.port, server_args)
+    report_path = os.path.join(tempfile.mkdtemp(prefix='bench-sockets-'), 'report.json')
+    try:
+        wait_for_metrics(args.metrics_port)
+        subprocess.run(
+            [sys.executable, 'loadgen.py', '--port', str(args.port),
+             '--clients', str(args.clients), '--senders', str(args.senders),
+             '--rate', str(args.rate), '--size', str(args.size),
+             '--duration', str(args.duration), '--report', report_path],
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True,
+            stdout=subprocess.DEVNULL)
+        counters = scrape(args.metrics_port, ('chat_socket_reads_total',
+                                              'chat_socket_writes_total',
+                                              'chat_messages_out_total'))
+    finally:
+        proc.terminate()
+        proc.wait()
+    with open(report_path) as f:
+        report = json.load(f)
+    frames_out = counters['chat_messages_out_total'] or 1
+    return {
+        'engine': engine,
+        'variant': name,
+        'reads': int(counters['chat_socket_reads_total']),
+        'writes': int(counters['chat_socket_writes_total']),
+        'frames_out': int(counters['chat_messages_out_total']),
+        'writes_per_frame': round(counters['chat_socket_writes_total'] / frames_out, 3),
+        'delivery_ratio': report['throughput']['delivery_ratio'],
+        'latency_ms': report['latency_ms'],
+    }
+
+
+def print_row(result):
+    latency = result['latency_ms']
+    print(f"{result['engine']:<9} {result['variant']:<8} {result['reads']:>9} {result['writes']:>9} "
+          f"{result['frames_out']:>10} {result['writes_per_frame']:>8} "
+          f"{latency['p50']:>8} {latency['p99']:>8} {latency['max']:>8} "
+          f"{result['delivery_ratio']:>6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Socket option benchmark")
+    parser.add_argument('--engines', nargs='+', default=['threaded', 'asyncio'])
+    parser.add_argument('--variants', nargs='+', choices=VARIANTS, default=list(VARIANTS))
+    parser.add_argument('--port', type=int, default=5091)
+    parser.add_argument('--metrics-port', type=int, default=9191)
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--senders', type=int, default=20)
+    parser.add_argument('--rate', type=float, default=20.0)
+    parser.add_argument('--size', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--report', help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    print(f"{'engine':<9} {'variant':<8} {'reads':>9} {'writes':>9} {'frames out':>10} "
+          f"{'w/frame':>8} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8} {'ratio':>6}")
+    results = []
+    for engine in args.engines:
+        for name in args.variants:
+            results.append(run_variant(engine, name, args))
+            print_row(results[-1])
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,346 @@
+"""
+TLS benchmark
+=============
+
+Compares plaintext with TLS on a local server, using a freshly generated
+self-signed certificate (RSA-2048 unless --key-type ec, see tls.py).
+First the server's side of a handshake is timed in memory, full and
+resumed, without sockets or a scheduler in the way. Then three
+measurements per engine:
+
+    handshakes  --clients clients connect and complete the NICK handshake,
+                --concurrency at a time: plaintext, full TLS handshakes,
+                and TLS resuming a session from an earlier connection.
+                Reports connections per second, time to the welcome
+                message and server CPU per connection.
+    restart     the reconnect storm after a hot restart (SIGHUP): every
+                client is told to reconnect and offers its session to the
+                new process, which cannot resume it (see tls.py), so
+                every client pays a full handshake.
+    messages    one client sends --messages messages of --size bytes, one
+                at a time (round trip) and then all at once (throughput),
+                plaintext and over TLS. Reports the round trip, messages
+                per second and server CPU per message.
+
+Server CPU comes from /proc, so this is Linux only.
+
+Usage:
+    python bench_tls.py --engines threaded asyncio --clients 500
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import signal
+import ssl
+import tempfile
+import time
+
+import protocol
+import tls
+from bench_engines import UNLIMITED, raise_fd_limit, start_server, wait_for_port
+from loadgen import percentile, stop_spawned
+
+WELCOME = b"Connected to the server"
+
+
+def cpu_seconds(pid):
+    """User + system CPU time a process has used so far"""
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rpartition(')')[2].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def read_pid(pid_file):
+    with open(pid_file) as f:
+        return int(f.read())
+
+
+class TLSSetup:
+    """Certificate and contexts for one run"""
+
+    def __init__(self, directory, key_type):
+        self.cert, self.key = tls.generate_certificate(directory, key_type=key_type)
+        self.client = tls.client_context(self.cert)
+
+    def server_args(self):
+        return ['--tls-cert', self.cert, '--tls-key', self.key]
+
+
+# ----------------- Clients -----------------
+class Client:
+    def __init__(self, index, context=None):
+        self.nickname = f"tls{index}"
+        self.context = context
+        self.session = None
+        self.resumed = False
+        self.reader = None
+        self.writer = None
+        self.frames = None
+
+    async def connect(self, port, timeout):
+        """Connect and wait for the welcome message. Returns the seconds it took."""
+        started = time.perf_counter()
+        context = tls.Resuming(self.context, self.session) if self.context else None
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection('127.0.0.1', port, ssl=context), timeout)
+        self.frames = protocol.FrameReader()
+        frame_type, _ = await asyncio.wait_for(self.read(), timeout)
+        if frame_type != protocol.NICK:
+            raise RuntimeError("unexpected greeting")
+        ssl_object = self.writer.get_extra_info('ssl_object')
+        if ssl_object is not None:
+            self.session = ssl_object.session
+            self.resumed = ssl_object.session_reused
+        self.writer.write(protocol.encode(protocol.NICK, self.nickname))
+        while True:
+            frame_type, payload = await asyncio.wait_for(self.read(), timeout)
+            if frame_type == protocol.SYSTEM and payload.startswith(WELCOME):
+                return time.perf_counter() - started
+
+    async def read(self):
+        return await protocol.read_frame(self.reader, self.frames)
+
+    async def wait_closed(self, timeout):
+        """Read until the server's CLOSE frame or the end of the connection"""
+        try:
+            while True:
+                frame_type, _ = await asyncio.wait_for(self.read(), timeout)
+                if frame_type == protocol.CLOSE:
+                    return
+        except (OSError, protocol.ProtocolError, asyncio.TimeoutError):
+            pass
+        finally:
+            self.writer.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def connect_all(clients, port, concurrency, timeout):
+    """Returns (seconds for all of them, sorted connect times)"""
+    gate = asyncio.Semaphore(concurrency)
+
+    async def connect(client):
+        async with gate:
+            return await client.connect(port, timeout)
+
+    started = time.perf_counter()
+    times = await asyncio.gather(*(connect(c) for c in clients))
+    return time.perf_counter() - started, sorted(times)
+
+
+def handshake_row(engine, mode, clients, elapsed, times, cpu):
+    return {
+        'engine': engine,
+        'mode': mode,
+        'per_sec': len(clients) / elapsed,
+        'p50_ms': percentile(times, 0.50) * 1000,
+        'p99_ms': percentile(times, 0.99) * 1000,
+        'cpu_ms': cpu / len(clients) * 1000,
+        'resumed': sum(c.resumed for c in clients),
+    }
+
+
+# ----------------- Measurements -----------------
+def server_handshake_time(server, client, session=None):
+    """One handshake between two in-memory endpoints. Returns the seconds
+    spent in the server's half, the client's session and whether it was
+    resumed."""
+    server_in, server_out = ssl.MemoryBIO(), ssl.MemoryBIO()
+    client_in, client_out = ssl.MemoryBIO(), ssl.MemoryBIO()
+    server_end = server.wrap_bio(server_in, server_out, server_side=True)
+    client_end = client.wrap_bio(client_in, client_out, server_hostname='127.0.0.1',
+                                 session=session)
+    elapsed = 0.0
+    server_done = client_done = False
+    while not (server_done and client_done):
+        if not client_done:
+            try:
+                client_end.do_handshake()
+                client_done = True
+            except ssl.SSLWantReadError:
+                pass
+        server_in.write(client_out.read())
+        if not server_done:
+            started = time.perf_counter()
+            try:
+                server_end.do_handshake()
+                server_done = True
+            except ssl.SSLWantReadError:
+                pass
+            elapsed += time.perf_counter() - started
+        client_in.write(server_out.read())
+    # TLS 1.3 session tickets come after the handshake, with the first data
+    started = time.perf_counter()
+    server_end.write(b'\0')
+    elapsed += time.perf_counter() - started
+    client_in.write(server_out.read())
+    client_end.read(1)
+    return elapsed, client_end.session, client_end.session_reused
+
+
+def bench_handshake_cost(setup, count):
+    server = tls.server_context(setup.cert, setup.key)
+    full = sum(server_handshake_time(server, setup.client)[0] for _ in range(count))
+    _, session, _ = server_handshake_time(server, setup.client)
+    resumed = 0.0
+    for _ in range(count):
+        elapsed, session, reused = server_handshake_time(server, setup.client, session)
+        if not reused:
+            raise RuntimeError("session was not resumed")
+        resumed += elapsed
+    return full / count, resumed / count
+
+
+async def bench_handshakes(engine, args, setup):
+    rows = []
+    for mode in ('plain', 'full', 'resumed'):
+        server_args = [*UNLIMITED, *(setup.server_args() if mode != 'plain' else ())]
+        context = setup.client if mode != 'plain' else None
+        proc = start_server(engine, args.port, server_args)
+        try:
+            probe = await wait_for_port(args.port, ssl=context)
+            probe.writer.close()
+            clients = [Client(i, context) for i in range(args.clients)]
+            if mode == 'resumed':
+                # One full handshake each to get a session, not measured
+                await connect_all(clients, args.port, args.concurrency, args.timeout)
+                for client in clients:
+                    client.close()
+                await asyncio.sleep(0.5)
+            cpu = cpu_seconds(proc.pid)
+            elapsed, times = await connect_all(clients, args.port, args.concurrency, args.timeout)
+            cpu = cpu_seconds(proc.pid) - cpu
+            for client in clients:
+                client.close()
+            rows.append(handshake_row(engine, mode, clients, elapsed, times, cpu))
+        finally:
+            proc.terminate()
+            proc.wait()
+    return rows
+
+
+async def bench_restart(engine, args, setup):
+    pid_file = os.path.join(tempfile.mkdtemp(prefix='bench-tls-'), 'server.pid')
+    proc = start_server(engine, args.port, [*UNLIMITED, *setup.server_args(),
+                                            '--pid-file', pid_file, '--drain-spread', '0.5'])
+    try:
+        probe = await wait_for_port(args.port, ssl=setup.client)
+        probe.writer.close()
+        clients = [Client(i, setup.client) for i in range(args.clients)]
+        await connect_all(clients, args.port, args.concurrency, args.timeout)
+        old_pid = read_pid(pid_file)
+        os.kill(old_pid, signal.SIGHUP)
+        await asyncio.gather(*(c.wait_closed(args.timeout) for c in clients))
+        # The new process writes its pid once it is up
+        while read_pid(pid_file) == old_pid:
+            await asyncio.sleep(0.05)
+        new_pid = read_pid(pid_file)
+        cpu = cpu_seconds(new_pid)
+        elapsed, times = await connect_all(clients, args.port, args.concurrency, args.timeout)
+        cpu = cpu_seconds(new_pid) - cpu
+        for client in clients:
+            client.close()
+        row = handshake_row(engine, 'restart', clients, elapsed, times, cpu)
+    finally:
+        stop_spawned(proc, pid_file)
+    return [row]
+
+
+async def bench_messages(engine, args, setup):
+    rows = []
+    for mode in ('plain', 'tls'):
+        server_args = [*UNLIMITED, '--queue-size', str(args.messages * 2),
+                       *(setup.server_args() if mode == 'tls' else ())]
+        context = setup.client if mode == 'tls' else None
+        proc = start_server(engine, args.port, server_args)
+        try:
+            probe = await wait_for_port(args.port, ssl=context)
+            probe.writer.close()
+            client = Client(0, context)
+            await client.connect(args.port, args.timeout)
+            text = 'x' * args.size
+            frame = protocol.encode(protocol.CHAT, text)
+
+            async def echoes(count):
+                seen = 0
+                while seen < count:
+                    frame_type, payload = await client.read()
+                    if frame_type == protocol.CHAT and payload.endswith(text.encode()):
+                        seen += 1
+
+            round_trips = []
+            for _ in range(args.messages):
+                started = time.perf_counter()
+                client.writer.write(frame)
+                await echoes(1)
+                round_trips.append(time.perf_counter() - started)
+            round_trips.sort()
+
+            cpu = cpu_seconds(proc.pid)
+            started = time.perf_counter()
+            client.writer.write(frame * args.messages)
+            await echoes(args.messages)
+            elapsed = time.perf_counter() - started
+            cpu = cpu_seconds(proc.pid) - cpu
+            client.close()
+            rows.append({
+                'engine': engine,
+                'mode': mode,
+                'rtt_p50_ms': percentile(round_trips, 0.50) * 1000,
+                'rtt_p99_ms': percentile(round_trips, 0.99) * 1000,
+                'per_sec': args.messages / elapsed,
+                'cpu_us': cpu / args.messages * 1e6,
+            })
+        finally:
+            proc.terminate()
+            proc.wait()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TLS handshake and per-message overhead")
+    parser.add_argument('--engines', nargs='+', default=['threaded', 'asyncio'])
+    parser.add_argument('--port', type=int, default=5093)
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=50,
+                        help="handshakes in flight at once")
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--size', type=int, default=100, help="message text bytes")
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--key-type', choices=tls.KEY_TYPES, default='rsa',
+                        help="certificate key; resumption saves more with RSA signatures")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    directory = tempfile.mkdtemp(prefix='bench-tls-')
+    try:
+        setup = TLSSetup(directory, args.key_type)
+        full, resumed = bench_handshake_cost(setup, args.clients)
+        print(f"server side of a handshake ({args.key_type}): full {full * 1e6:.0f} us, "
+              f"resumed {resumed * 1e6:.0f} us ({full / resumed:.1f}x)\n")
+        print(f"{'engine':<9} {'handshakes':<16} {'conn/s':>8} {'p50 ms':>8} {'p99 ms':>8} "
+              f"{'cpu ms':>8} {'resumed':>8}")
+        for engine in args.engines:
+            rows = asyncio.run(bench_handshakes(engine, args, setup))
+            rows += asyncio.run(bench_restart(engine, args, setup))
+            for row in rows:
+                print(f"{row['engine']:<9} {row['mode']:<16} {row['per_sec']:>8.0f} "
+                      f"{row['p50_ms']:>8.2f} {row['p99_ms']:>8.2f} {row['cpu_ms']:>8.3f} "
+                      f"{row['resumed']:>8}")
+        print()
+        print(f"{'engine':<9} {'messages':<16} {'rtt p50':>8} {'rtt p99':>8} {'msg/s':>8} "
+              f"{'cpu us':>8}")
+        for engine in args.engines:
+            for row in asyncio.run(bench_messages(engine, args, setup)):
+                print(f"{row['engine']:<9} {row['mode']:<16} {row['rtt_p50_ms']:>8.3f} "
+                      f"{row['rtt_p99_ms']:>8.3f} {row['per_sec']:>8.0f} {row['cpu_us']:>8.1f}")
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,512 @@
+"""
+Chat client library
+===================
+
+Everything a program needs to talk to the chat server, without a window:
+connecting, the NICK handshake (asking for compression if the server
+offers it), sending, answering PINGs, and reconnecting with exponential
+backoff. Messages sent while the connection is down wait in an outbox and
+go out once it is back. client_gui.py is one user of it; bots and tests
+are others.
+
+    client = ChatClient('alice', port=5000)
+    await client.connect()
+    client.send("hello")
+    async for event in client:
+        print(event)
+
+The iterator yields four kinds of event:
+
+    Message      a CHAT, SYSTEM or CLOSE frame from the server
+    HistoryPage  the answer to request_older()
+    Status       the connection went down or came back
+    Transfer     a file was sent or received (or failed), with its rate
+
+send_file() offers a file to another user and, once they accept it,
+streams it with sendfile(), one chunk at a time and only while no chat
+message is waiting, so a transfer never
+holds up the conversation. Files sent to us are written chunk by chunk
+to download_dir; with None, the default, they are refused, and so are
+files over max_download_size. Transfers do not survive a dropped
+connection.
+
+It ends after close(), or when the connection drops and reconnect is off.
+
+With tls_context (see tls.client_context()) the connection is
+encrypted, and every reconnect offers the session of the previous
+connection so the server can resume it instead of doing a full
+handshake. Files are then sent through the TLS layer, without sendfile().
+
+send() never blocks and may be called from any thread. start_thread()
+runs the client on an event loop of its own, for programs such as Tk
+that have a main loop of their own.
+"""
+
+import asyncio
+import collections
+import itertools
+import os
+import random
+import threading
+import time
+
+import protocol
+import tls
+
+DEFAULT_OUTBOX_SIZE = 1000
+DEFAULT_RECONNECT_MIN = 0.5
+DEFAULT_RECONNECT_MAX = 30.0
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_MAX_DOWNLOAD_SIZE = 100 * 1024 * 1024
+# Bytes of a received file's name, leaving room under the usual 255 byte
+# limit for the " (n)" of a duplicate and the .part suffix
+MAX_FILE_NAME = 200
+
+Message = collections.namedtuple('Message', 'type text')
+HistoryPage = collections.namedtuple('HistoryPage', 'offset messages')
+Status = collections.namedtuple('Status', 'connected text')
+
+
+class Transfer(collections.namedtuple('Transfer', 'sent name peer size seconds path error')):
+    """A finished file transfer; error says why if it failed"""
+
+    __slots__ = ()
+
+    @property
+    def rate(self):
+        """Bytes per second"""
+        return self.size / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self):
+        direction = f"to {self.peer}" if self.sent else f"from {self.peer}"
+        if self.error:
+            return f"Transfer of {self.name} {direction} failed: {self.error}"
+        verb = "Sent" if self.sent else "Received"
+        return (f"{verb} {self.name} {direction}: {self.size / 1e6:.1f} MB in "
+                f"{self.seconds:.2f}s ({self.rate / 1e6:.1f} MB/s)")
+
+
+class _File:
+    """One transfer in progress"""
+
+    __slots__ = ('id', 'name', 'peer', 'size', 'done', 'file', 'path', 'started')
+
+    def __init__(self, transfer_id, name, peer, size, file, path):
+        self.id = transfer_id
+        self.name = name
+        self.peer = peer
+        self.size = size
+        self.done = 0
+        self.file = file
+        self.path = path
+        self.started = time.monotonic()
+
+
+def _file_name(offered):
+    """The sender's name for a file, made safe to create in the download
+    directory: no directories, no control characters, not too long"""
+    name = os.path.basename(offered.replace('\\', '/'))
+    name = ''.join(c for c in name if c.isprintable()).strip()
+    if name in ('', '.', '..'):
+        return 'file'
+    root, ext = os.path.splitext(name)
+    if len(ext.encode('utf-8')) > MAX_FILE_NAME // 2:
+        root, ext = name, ''
+    room = MAX_FILE_NAME - len(ext.encode('utf-8'))
+    return root.encode('utf-8')[:room].decode('utf-8', 'ignore') + ext
+
+
+_END = object()
+
+
+class OutboxFull(Exception):
+    """Raised by send() when outbox_size messages are already waiting"""
+
+
+class ChatClient:
+    def __init__(self, nickname, host='127.0.0.1', port=5000, compress=True, reconnect=True,
+                 outbox_size=DEFAULT_OUTBOX_SIZE, reconnect_min=DEFAULT_RECONNECT_MIN,
+                 reconnect_max=DEFAULT_RECONNECT_MAX, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 download_dir=None, max_download_size=DEFAULT_MAX_DOWNLOAD_SIZE, tls_context=None):
+        if not protocol.valid_nickname(nickname):
+            raise ValueError(protocol.NICKNAME_RULES)
+        self.nickname = nickname
+        self.host = host
+        self.port = port
+        self.compress = compress
+        self.reconnect = reconnect
+        self.outbox_size = outbox_size
+        self.reconnect_min = reconnect_min
+        self.reconnect_max = reconnect_max
+        self.connect_timeout = connect_timeout
+        self.download_dir = download_dir
+        self.max_download_size = max_download_size
+        self.tls_context = tls_context
+        self.tls_session = None      # offered on the next connection
+        self.tls_resumed = False     # whether the current one resumed a session
+        # Encoded frames not yet written; appended to from any thread
+        self.outbox = collections.deque()
+        self.sending = []
+        # Frames that only make sense on the current connection (PONGs,
+        # file control); written before anything else, dropped with it
+        self.control = collections.deque()
+        self.offered = {}            # uploads waiting for the recipient to accept
+        self.uploads = collections.OrderedDict()
+        self.sent_files = {}         # uploads waiting for the server's "done"
+        self.downloads = {}
+        self._upload_ids = itertools.count(1)
+        self.features = set()
+        self.connected = False
+        self.closed = False
+        self._loop = None
+        self._events = None
+        self._wakeup = None
+        self._reader = None
+        self._writer = None
+        self._frames = None
+        self._task = None
+
+    @property
+    def unsent(self):
+        """Messages waiting for a connection, including any being written"""
+        return len(self.outbox) + len(self.sending)
+
+    # ----------------- Sending -----------------
+    def send(self, text):
+        """Queue a chat message or /command (the server adds our nickname)"""
+        self._queue(protocol.encode(protocol.CHAT, text))
+
+    def request_older(self, offset=None, text=None):
+        """Ask for the page of logged messages before a log offset, before
+        the logged message with this text, or else before the newest one.
+        The server answers with a HistoryPage if it keeps a chat log."""
+        if offset is not None:
+            request = f"before {offset}"
+        elif text is not None:
+            request = "before\n" + text
+        else:
+            request = "before"
+        self._queue(protocol.encode(protocol.HISTORY, request))
+
+    def send_file(self, path, nickname):
+        """Send a file to one user. Thread-safe; the outcome arrives as a
+        Transfer event."""
+        if self.closed or self._loop is None:
+            raise ConnectionError("client is not running")
+        file = open(path, 'rb')
+        upload = _File(next(self._upload_ids), os.path.basename(path), nickname,
+                       os.fstat(file.fileno()).st_size, file, path)
+        self._loop.call_soon_threadsafe(self._start_upload, upload)
+
+    def _start_upload(self, upload):
+        if not self.connected:
+            self._finish(upload, True, "not connected")
+        elif protocol.FILES not in self.features:
+            self._finish(upload, True, "the server does not relay files")
+        else:
+            self.offered[upload.id] = upload
+            self._control_frame(protocol.FILE, f"offer {upload.id} {upload.size} "
+                                               f"{upload.peer} {upload.name}")
+
+    def _control_frame(self, frame_type, payload):
+        self.control.append(protocol.encode(frame_type, payload))
+        self._wakeup.set()
+
+    def _queue(self, frame):
+        if self.closed:
+            raise ConnectionError("client is closed")
+        if self.unsent >= self.outbox_size:
+            raise OutboxFull(f"{self.unsent} messages are waiting to be sent")
+        self.outbox.append(frame)
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _write(self, writer):
+        """Send control frames, then the outbox in order, then file chunks.
+        An outbox batch only leaves it once written, so whatever a dropped
+        connection interrupts is sent again."""
+        while True:
+            if self.control:
+                while self.control:
+                    writer.write(self.control.popleft())
+                await writer.drain()
+                continue
+            if not self.outbox:
+                if self.uploads:
+                    # One chunk, then look for chat messages again
+                    await self._send_chunk(writer)
+                    continue
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            while self.outbox:
+                self.sending.append(self.outbox.popleft())
+            try:
+                writer.writelines(self.sending)
+                await writer.drain()
+            except BaseException:
+                self.outbox.extendleft(reversed(self.sending))
+                raise
+            finally:
+                self.sending = []
+
+    async def _send_chunk(self, writer):
+        upload = next(iter(self.uploads.values()))
+        # Several uploads take turns, a chunk each
+        self.uploads.move_to_end(upload.id)
+        count = min(protocol.FILE_CHUNK_SIZE, upload.size - upload.done)
+        if count > 0:
+            writer.write(protocol.file_chunk_header(upload.id, count))
+            # Straight from the page cache to the socket where the OS can
+            sent = await self._loop.sendfile(writer.transport, upload.file, upload.done, count)
+            if upload.id not in self.uploads:
+                # Refused while the chunk was going out; the server drops the rest
+                return
+            if sent < count:
+                # The file shrank; the frame cannot be completed
+                self._finish(upload, True, "file changed while being sent")
+                writer.transport.abort()
+                return
+            upload.done += count
+        if upload.done >= upload.size:
+            writer.write(protocol.encode(protocol.FILE, f"end {upload.id}"))
+            self.sent_files[upload.id] = self.uploads.pop(upload.id)
+
+    def _start_download(self, args):
+        parts = args.split(' ', 3)
+        if len(parts) != 4 or not parts[0].isdigit() or not parts[1].isdigit():
+            return
+        transfer_id, size, sender = int(parts[0]), int(parts[1]), parts[2]
+        name = _file_name(parts[3])
+        if self.download_dir is None or size > self.max_download_size:
+            reason = "not accepting files" if self.download_dir is None else "file too large"
+            self._reject_download(transfer_id, name, sender, reason)
+            return
+        root, ext = os.path.splitext(name)
+        path = os.path.join(self.download_dir, name)
+        try:
+            os.makedirs(self.download_dir, exist_ok=True)
+            for n in itertools.count(1):
+                if not os.path.exists(path) and not os.path.exists(path + '.part'):
+                    break
+                path = os.path.join(self.download_dir, f"{root} ({n}){ext}")
+            file = open(path + '.part', 'wb')
+        except OSError as e:
+            self._reject_download(transfer_id, name, sender, f"cannot save: {e.strerror or e}")
+            return
+        self.downloads[transfer_id] = _File(transfer_id, name, sender, size, file, path)
+        self._control_frame(protocol.FILE, f"accept {transfer_id}")
+
+    def _reject_download(self, transfer_id, name, sender, reason):
+        self._control_frame(protocol.FILE, f"reject {transfer_id}")
+        self._events.put_nowait(Transfer(False, name, sender, 0, 0.0, None, reason))
+
+    def _receive_chunk(self, payload):
+        (transfer_id,) = protocol.FILE_ID.unpack_from(payload)
+        download = self.downloads.get(transfer_id)
+        if download is None:
+            return
+        with memoryview(payload) as view:
+            chunk = view[protocol.FILE_ID.size:]
+            # Nothing past the announced size, which max_download_size capped
+            if download.done + len(chunk) > download.size:
+                self._control_frame(protocol.FILE, f"reject {transfer_id}")
+                self._finish(download, False, "more data than announced")
+                return
+            download.done += download.file.write(chunk)
+
+    def _file_control(self, text):
+        command, _, args = text.partition(' ')
+        transfer_id, _, reason = args.partition(' ')
+        transfer_id = int(transfer_id) if transfer_id.isdigit() else None
+        if command == 'offer':
+            self._start_download(args)
+        elif command == 'end' and transfer_id in self.downloads:
+            download = self.downloads[transfer_id]
+            error = None if download.done == download.size else "file incomplete"
+            self._finish(download, False, error)
+        elif command == 'abort' and transfer_id in self.downloads:
+            self._finish(self.downloads[transfer_id], False, reason)
+        elif command == 'accepted' and transfer_id in self.offered:
+            upload = self.offered.pop(transfer_id)
+            # The rate covers the transfer, not the wait for the recipient
+            upload.started = time.monotonic()
+            self.uploads[transfer_id] = upload
+            self._wakeup.set()
+        elif command in ('done', 'refused'):
+            upload = (self.offered.get(transfer_id) or self.uploads.get(transfer_id)
+                      or self.sent_files.get(transfer_id))
+            if upload is not None:
+                self._finish(upload, True, reason if command == 'refused' else None)
+
+    def _finish(self, transfer, sent, error=None):
+        if sent:
+            self.offered.pop(transfer.id, None)
+            self.uploads.pop(transfer.id, None)
+            self.sent_files.pop(transfer.id, None)
+        else:
+            self.downloads.pop(transfer.id, None)
+        transfer.file.close()
+        if not sent:
+            if error is None:
+                os.replace(transfer.path + '.part', transfer.path)
+            else:
+                os.unlink(transfer.path + '.part')
+        self._events.put_nowait(Transfer(sent, transfer.name, transfer.peer, transfer.done,
+                                        time.monotonic() - transfer.started,
+                                        transfer.path if error is None else None, error))
+
+    # ----------------- Connection -----------------
+    async def connect(self, retry=False):
+        """Connect and complete the handshake; from then on the connection
+        is read, and with reconnect re-established, in the background. With
+        retry the first connection is made in the background too, retrying
+        with backoff instead of raising."""
+        if self._task is not None:
+            raise RuntimeError("already connected")
+        self._events = asyncio.Queue()
+        self._wakeup = asyncio.Event()
+        if self.outbox:
+            self._wakeup.set()
+        # Set last: send() from another thread uses _wakeup once this is set
+        self._loop = asyncio.get_running_loop()
+        if not retry:
+            await self._open()
+        self._task = asyncio.ensure_future(self._run(connected=not retry))
+
+    async def _open(self):
+        context = None
+        if self.tls_context is not None:
+            context = tls.Resuming(self.tls_context, self.tls_session)
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=context,
+                                    server_hostname=self.host if context else None),
+            self.connect_timeout)
+        frames = protocol.FrameReader()
+        try:
+            frame_type, payload = await asyncio.wait_for(
+                protocol.read_frame(reader, frames), self.connect_timeout)
+            if frame_type != protocol.NICK:
+                raise protocol.ProtocolError(f"expected NICK, got frame type {frame_type}")
+            wanted = {protocol.FILES, protocol.DEFLATE} if self.compress else {protocol.FILES}
+            self.features = protocol.parse_features(payload) & wanted
+            writer.write(protocol.encode_nick(self.nickname, sorted(self.features)))
+        except BaseException:
+            writer.close()
+            raise
+        self._reader, self._writer, self._frames = reader, writer, frames
+        self.connected = True
+        secure = ""
+        ssl_object = writer.get_extra_info('ssl_object')
+        if ssl_object is not None:
+            # The server's session ticket has arrived along with its NICK
+            self.tls_session = ssl_object.session
+            self.tls_resumed = ssl_object.session_reused
+            secure = f" ({ssl_object.version()}{', resumed' if self.tls_resumed else ''})"
+        self._events.put_nowait(Status(True, f"Connected to {self.host}:{self.port}{secure}"))
+
+    async def _run(self, connected):
+        if not connected:
+            connected = await self._reconnect(immediately=True)
+        while connected:
+            await self._serve()
+            if self.closed or not self.reconnect:
+                break
+            connected = await self._reconnect()
+        self._events.put_nowait(_END)
+
+    async def _reconnect(self, immediately=False):
+        """Connect again, backing off exponentially with jitter between
+        attempts. Returns False if the client was closed meanwhile."""
+        delay = self.reconnect_min
+        reason = "Connection lost"
+        while not self.closed:
+            if not immediately:
+                wait = random.uniform(delay / 2, delay)
+                waiting = f", {self.unsent} message(s) waiting" if self.unsent else ""
+                self._events.put_nowait(Status(False, f"{reason}, retrying in {wait:.1f}s{waiting}"))
+                await asyncio.sleep(wait)
+                delay = min(delay * 2, self.reconnect_max)
+            immediately = False
+            try:
+                await self._open()
+                return True
+            except (OSError, asyncio.TimeoutError, protocol.ProtocolError):
+                reason = f"Unable to connect to {self.host}:{self.port}"
+        return False
+
+    async def _serve(self):
+        """Read the current connection until it ends"""
+        writer_task = asyncio.ensure_future(self._write(self._writer))
+        try:
+            # Anything that arrived together with the NICK frame comes first
+            batch = self._frames.feed(b'')
+            while True:
+                for frame_type, payload in batch:
+                    self._dispatch(frame_type, payload)
+                batch = await protocol.read_frames(self._reader, self._frames)
+        except (OSError, protocol.ProtocolError):
+            pass
+        finally:
+            self.connected = False
+            writer_task.cancel()
+            self._writer.close()
+            self.control.clear()
+            for upload in [*self.offered.values(), *self.uploads.values(),
+                           *self.sent_files.values()]:
+                self._finish(upload, True, "connection lost")
+            for download in list(self.downloads.values()):
+                self._finish(download, False, "connection lost")
+
+    def _dispatch(self, frame_type, payload):
+        if frame_type == protocol.FILE_DATA:
+            self._receive_chunk(payload)
+        elif frame_type == protocol.FILE:
+            self._file_control(payload.decode('utf-8', 'replace'))
+        elif frame_type == protocol.PING:
+            # Through the writer: nothing else may write during a sendfile()
+            self._control_frame(protocol.PONG, payload)
+        elif frame_type == protocol.HISTORY:
+            # The reply to a "since" request is not a page and is ignored
+            page = protocol.parse_history_page(payload)
+            if page is not None:
+                offset, frames = page
+                self._events.put_nowait(HistoryPage(offset, [
+                    Message(t, p.decode('utf-8', 'replace')) for t, p in frames]))
+        elif frame_type in (protocol.CHAT, protocol.SYSTEM, protocol.CLOSE):
+            self._events.put_nowait(Message(frame_type, payload.decode('utf-8', 'replace')))
+
+    async def close(self):
+        """Disconnect for good. Messages still in the outbox are not sent."""
+        self.closed = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._writer is not None:
+            self._writer.close()
+        if self._events is not None:
+            self._events.put_nowait(_END)
+
+    # ----------------- Receiving -----------------
+    async def __aiter__(self):
+        while True:
+            event = await self._events.get()
+            if event is _END:
+                return
+            yield event
+
+    def start_thread(self, on_event):
+        """connect(retry=True) on an event loop in a daemon thread and call
+        on_event(event) there for every event. Returns the thread."""
+        async def consume():
+            await self.connect(retry=True)
+            async for event in self:
+                on_event(event)
+
+        thread = threading.Thread(target=asyncio.run, args=(consume(),),
+                                  name='chat-client', daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,332 @@
+"""
+Append-only chat log
+====================
+
+Every chat frame the server broadcasts can be appended to an on-disk log
+made of numbered segment files. A position in the log is a plain byte
+offset that keeps growing across segments; each segment file is named
+after the offset of its first record, e.g. 00000000000000000000.log.
+
+Record layout (all integers big-endian):
+
+    +-----------+----------+----------------+------+-------+-----------+
+    | size (4B) | crc (4B) | room len (2B)  | room | frame | size (4B) |
+    +-----------+----------+----------------+------+-------+-----------+
+
+size counts room len + room + frame and is repeated at the end so the
+log can also be walked backwards. Readers mmap the segment they need, so
+serving "history since offset N" never loads a whole file into memory.
+
+The offsets of all records, and of each room's records, are also kept in
+memory (8 bytes per record and per index), built when the log is opened.
+Reads find their records there with a binary search instead of walking
+the log, so a page of a quiet room costs the same as one of a busy room,
+and an offset that is not a record boundary gets no records rather than
+being parsed from the middle of one.
+
+Writes are batched in memory and flushed when batch_size bytes are
+pending or every flush_interval seconds by a single flusher thread. The
+fsync policy decides how often flushed data is forced to disk:
+'always' after every flush, 'interval' once fsync_interval seconds have
+passed since the last fsync (the flusher thread syncs a quiet tail too),
+'never' leaves it to the OS. close() always syncs.
+"""
+
+import bisect
+import itertools
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+
+HEADER = struct.Struct('!IIH')
+TRAILER = struct.Struct('!I')
+SEGMENT_SUFFIX = '.log'
+
+FSYNC_POLICIES = ('never', 'interval', 'always')
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+DEFAULT_BATCH_SIZE = 64 * 1024
+DEFAULT_FLUSH_INTERVAL = 0.05
+DEFAULT_FSYNC_INTERVAL = 1.0
+
+
+class ChatLog:
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE,
+                 batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 fsync='interval', fsync_interval=DEFAULT_FSYNC_INTERVAL):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"unknown fsync policy: {fsync}")
+        self.directory = directory
+        self.segment_size = segment_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+
+        self.lock = threading.Lock()
+        self.pending = bytearray()
+        self.last_fsync = time.monotonic()
+        self.unsynced = False   # flushed to the file but not yet fsynced
+        self.closed = False
+
+        os.makedirs(directory, exist_ok=True)
+        self.bases = sorted(int(name[:-len(SEGMENT_SUFFIX)])
+                            for name in os.listdir(directory)
+                            if name.endswith(SEGMENT_SUFFIX))
+        if not self.bases:
+            self.bases.append(0)
+        self.file = open(self._path(self.bases[-1]), 'ab')
+        self.file_size = self._recover_tail()
+        # Offset the next record will get
+        self.end = self.bases[-1] + self.file_size
+        # Record offsets in log order: all of them, and per room
+        self.offsets = array('q')
+        self.rooms = {}
+        self._build_index()
+
+        self.flusher = None
+        if batch_size > 0:
+            self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self.flusher.start()
+
+    def _path(self, base):
+        return os.path.join(self.directory, f"{base:020d}{SEGMENT_SUFFIX}")
+
+    def _recover_tail(self):
+        """Cut off a record that was only half written when we last stopped"""
+        path = self._path(self.bases[-1])
+        size = os.path.getsize(path)
+        if size == 0:
+            return 0
+        good = 0
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            for _, _, _, next_position in _scan(view, 0, size):
+                good = next_position
+        if good != size:
+            self.file.truncate(good)
+        return good
+
+    def _build_index(self):
+        for index, base in enumerate(self.bases):
+            segment_end = self.bases[index + 1] if index + 1 < len(self.bases) else self.end
+            with self._map(base) as view:
+                for position, room, _, _ in _scan(view, 0, min(len(view), segment_end - base)):
+                    self._index(room, base + position)
+
+    def _index(self, room, offset):
+        self.offsets.append(offset)
+        offsets = self.rooms.get(room)
+        if offsets is None:
+            offsets = self.rooms[room] = array('q')
+        offsets.append(offset)
+
+    # ----------------- Writing -----------------
+    def append(self, room, frame):
+        """Add one record and return its offset"""
+        room_bytes = room.encode('utf-8')
+        body = struct.pack('!H', len(room_bytes)) + room_bytes + frame
+        size = len(body)
+        record = struct.pack('!II', size, zlib.crc32(body)) + body + TRAILER.pack(size)
+        with self.lock:
+            if self.closed:
+                raise ValueError("chat log is closed")
+            if self.file_size + len(self.pending) + len(record) > self.segment_size \
+                    and self.file_size + len(self.pending) > 0:
+                self._flush()
+                self._roll()
+            offset = self.end
+            self.end += len(record)
+            self.pending += record
+            self._index(room, offset)
+            if len(self.pending) >= self.batch_size:
+                self._flush()
+            return offset
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.pending:
+            self.file.write(self.pending)
+            self.file.flush()
+            self.file_size += len(self.pending)
+            self.pending.clear()
+            self.unsynced = True
+        if self.unsynced and self.fsync != 'never':
+            now = time.monotonic()
+            if self.fsync == 'always' or now - self.last_fsync >= self.fsync_interval:
+                self._sync(now)
+
+    def _sync(self, now=None):
+        os.fsync(self.file.fileno())
+        self.last_fsync = time.monotonic() if now is None else now
+        self.unsynced = False
+
+    def _roll(self):
+        if self.fsync != 'never':
+            self._sync()
+        self.file.close()
+        self.bases.append(self.end)
+        self.file = open(self._path(self.end), 'ab')
+        self.file_size = 0
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            with self.lock:
+                if self.closed:
+                    break
+                self._flush()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self._flush()
+            self._sync()
+            self.file.close()
+            self.closed = True
+
+    # ----------------- Reading -----------------
+    def read_since(self, offset, room=None, limit=100):
+        """Records at or after offset, optionally for one room only.
+        Returns (records, next_offset) where records are (offset, room, frame)
+        and next_offset is where to continue reading."""
+        with self.lock:
+            self._flush()
+            offsets = self._offsets_of(room)
+            index = bisect.bisect_left(offsets, offset)
+            chosen = offsets[index:index + limit]
+            next_offset = offsets[index + limit] if index + limit < len(offsets) else self.end
+            bases = list(self.bases)
+        return self._read_at(chosen, bases), next_offset
+
+    def read_before(self, offset, room=None, limit=100):
+        """Up to limit records that start before offset, oldest first.
+        offset must be a record's offset or the end of the log; any other
+        value gets no records. Returns (records, first_offset) where
+        first_offset can be passed back in to page further into the past."""
+        with self.lock:
+            self._flush()
+            if offset != self.end and not _holds(self.offsets, offset):
+                return [], offset
+            offsets = self._offsets_of(room)
+            index = bisect.bisect_left(offsets, offset)
+            chosen = offsets[max(index - limit, 0):index]
+            bases = list(self.bases)
+        return self._read_at(chosen, bases), chosen[0] if chosen else offset
+
+    def find(self, room, frame, depth):
+        """Offset of the newest record of frame among the room's depth
+        newest records, or None. Only records of the room are looked at."""
+        room_bytes = room.encode('utf-8')
+        body = struct.pack('!H', len(room_bytes)) + room_bytes + frame
+        size = TRAILER.pack(len(body))
+        with self.lock:
+            self._flush()
+            offsets = self.rooms.get(room, _NO_OFFSETS)
+            chosen = offsets[max(len(offsets) - depth, 0):]
+            bases = list(self.bases)
+        chosen.reverse()
+        for base, group in itertools.groupby(chosen, lambda offset: _base_of(bases, offset)):
+            with self._map(base) as view:
+                for offset in group:
+                    # The size alone rules out most records
+                    position = offset - base
+                    start = position + HEADER.size - 2
+                    if view[position:position + TRAILER.size] == size \
+                            and view[start:start + len(body)] == body:
+                        return offset
+        return None
+
+    def _offsets_of(self, room):
+        if room is None:
+            return self.offsets
+        return self.rooms.get(room, _NO_OFFSETS)
+
+    def _read_at(self, offsets, bases):
+        """(offset, room, frame) for records at known offsets"""
+        records = []
+        for base, group in itertools.groupby(offsets, lambda offset: _base_of(bases, offset)):
+            with self._map(base) as view:
+                for offset in group:
+                    try:
+                        _, room, frame, _ = _read_record(view, offset - base)
+                    except (ValueError, struct.error):
+                        continue
+                    records.append((offset, room, frame))
+        return records
+
+    def _map(self, base):
+        f = open(self._path(base), 'rb')
+        try:
+            if os.fstat(f.fileno()).st_size == 0:
+                f.close()
+                return _EmptyView()
+            return _MappedSegment(f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except BaseException:
+            f.close()
+            raise
+
+
+# ----------------- Record Helpers -----------------
+_NO_OFFSETS = array('q')
+
+
+def _holds(offsets, offset):
+    index = bisect.bisect_left(offsets, offset)
+    return index < len(offsets) and offsets[index] == offset
+
+
+def _base_of(bases, offset):
+    return bases[bisect.bisect_right(bases, offset) - 1]
+
+
+def _read_record(view, position):
+    size, crc, room_length = HEADER.unpack_from(view, position)
+    body_start = position + HEADER.size - 2
+    body = view[body_start:body_start + size]
+    if zlib.crc32(body) != crc:
+        raise ValueError(f"corrupt record at position {position}")
+    room = bytes(body[2:2 + room_length]).decode('utf-8')
+    frame = bytes(body[2 + room_length:])
+    return position, room, frame, body_start + size + TRAILER.size
+
+
+def _scan(view, position, stop):
+    """Yield (position, room, frame, next_position) for whole, valid records"""
+    while position + HEADER.size <= stop:
+        size = HEADER.unpack_from(view, position)[0]
+        if position + HEADER.size - 2 + size + TRAILER.size > stop:
+            return
+        try:
+            record = _read_record(view, position)
+        except ValueError:
+            return
+        yield record
+        position = record[3]
+
+
+class _MappedSegment:
+    def __init__(self, f, view):
+        self.f = f
+        self.view = view
+
+    def __enter__(self):
+        return self.view
+
+    def __exit__(self, *exc):
+        self.view.close()
+        self.f.close()
+
+
+class _EmptyView:
+    def __enter__(self):
+        return b''
+
+    def __exit__(self, *exc):
+        pass
@@ -1,91 +1,277 @@
-import socket
-import threading
+"""
+Chat client (Tk)
+================
+
+A window on top of chat_client.ChatClient, which does all the networking
+on a thread of its own. The window is drawn first and the client
+connects in the background, reconnecting with backoff whenever the
+connection drops; messages typed meanwhile are sent once it is back.
+
+    python client_gui.py --nickname alice --port 5000
+
+Without --nickname the window asks for one. The File button sends a
+file to one user, and every transfer ends with a line giving its rate.
+Files sent to us are refused unless --download-dir says where to save
+them, and so are files over --max-download-mb. --tls connects over TLS
+(--tls-ca names the certificate to trust for a self-signed server).
+"""
+
+import argparse
+import os
+import queue
 import tkinter as tk
-from tkinter import scrolledtext, messagebox, ttk
-
-# ----------------- Network Setup -----------------
-nickname = input("Enter your nickname: ")
-host = '127.0.0.1'
-port = 5000
-
-client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-try:
-    client.connect((host, port))
-except:
-    print("Unable to connect to the server")
-    exit()
-
-# ----------------- GUI Setup -----------------
-window = tk.Tk()
-window.title(f"Chat - {nickname}")
-window.geometry("500x600")
-window.configure(bg="#1e1e2f")  # Dark futuristic background
-window.resizable(False, False)
-
-# ----------------- Chat Area Frame -----------------
-chat_frame = tk.Frame(window, bg="#2b2b3f", bd=2, relief=tk.RIDGE)
-chat_frame.pack(padx=15, pady=15, fill=tk.BOTH, expand=True)
-
-chat_area = scrolledtext.ScrolledText(chat_frame, wrap=tk.WORD, bg="#1e1e2f",
-                                      fg="#f0f0f0", font=("Segoe UI", 11), relief=tk.FLAT)
-chat_area.pack(padx=10, pady=10, fill=tk.BOTH, expand=True)
-chat_area.config(state='disabled')
-
-# ----------------- Entry Frame -----------------
-entry_frame = tk.Frame(window, bg="#1e1e2f")
-entry_frame.pack(padx=15, pady=(0, 15), fill=tk.X)
-
-message_entry = tk.Entry(entry_frame, font=("Segoe UI", 12), bg="#2b2b3f", fg="#ffffff",
-                         insertbackground='white', relief=tk.FLAT)
-message_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0,10), ipady=6)
-
-# Gradient-like 3D Send Button
-send_button = tk.Button(entry_frame, text="Send", command=lambda: send_message(),
-                        bg="#ff4c4c", fg="#ffffff", font=("Segoe UI Bold", 12),
-                        activebackground="#ff1a1a", relief=tk.RAISED, bd=4)
-send_button.pack(side=tk.RIGHT)
-
-# Add hover effect for send button
-def on_enter(e):
-    send_button['bg'] = "#ff1a1a"
-def on_leave(e):
-    send_button['bg'] = "#ff4c4c"
-
-send_button.bind("<Enter>", on_enter)
-send_button.bind("<Leave>", on_leave)
-
-# ----------------- Send Message Function -----------------
-def send_message():
-    message = message_entry.get()
-    if message:
-        full_message = f"{nickname}: {message}"
-        client.send(full_message.encode('utf-8'))
-        message_entry.delete(0, tk.END)
-
-# ----------------- Receive Messages -----------------
-def receive():
-    while True:
+from tkinter import filedialog, scrolledtext, simpledialog
+
+import protocol
+import tls
+from chat_client import (DEFAULT_MAX_DOWNLOAD_SIZE, ChatClient, HistoryPage, Message, OutboxFull,
+                         Status, Transfer)
+
+# The client thread never touches Tk: it queues events and the Tk main
+# loop shows whatever has arrived once per frame
+FRAME_MS = 16
+MAX_BATCH = 1000  # lines inserted per frame; any more wait for the next one
+
+# Lines kept on screen while following the chat (CHAT_SCROLLBACK); twice
+# that while scrolled up reading. Old lines are dropped in bulk once the
+# limit is exceeded by a tenth, and scrolling up past the top pages older
+# messages back in from the server's chat log.
+DEFAULT_SCROLLBACK = 5000
+
+
+class ChatWindow:
+    def __init__(self, host, port, nickname=None, scrollback=DEFAULT_SCROLLBACK,
+                 download_dir=None, max_download_size=DEFAULT_MAX_DOWNLOAD_SIZE,
+                 tls_context=None):
+        self.scrollback = scrollback
+        self.events = queue.SimpleQueue()
+        self.paging = False          # a "before" request is waiting for its page
+        self.history_done = False    # the server had nothing older
+        self.older_cursor = None     # log offset of the oldest paged-in message
+        self.client = None
+
+        self.window = tk.Tk()
+        self.setup_window()
+        self.create_widgets()
+        # Drawn before asking for a nickname or connecting
+        self.window.update()
+        prompt = "Enter your nickname:"
+        while nickname is None or not protocol.valid_nickname(nickname):
+            if nickname:
+                prompt = f"{protocol.NICKNAME_RULES}.\nEnter your nickname:"
+            nickname = simpledialog.askstring("Nickname", prompt, parent=self.window)
+            if not nickname:
+                self.window.destroy()
+                return
+        self.window.title(f"Chat - {nickname}")
+        self.client = ChatClient(nickname, host, port, download_dir=download_dir,
+                                 max_download_size=max_download_size,
+                                 tls_context=tls_context)
+        self.client.start_thread(self.events.put)
+        self.window.after(FRAME_MS, self.drain_events)
+
+    def setup_window(self):
+        self.window.title("Chat")
+        self.window.geometry("500x600")
+        self.window.configure(bg="#1e1e2f")  # Dark futuristic background
+        self.window.resizable(False, False)
+
+    def create_widgets(self):
+        # ----------------- Chat Area Frame -----------------
+        chat_frame = tk.Frame(self.window, bg="#2b2b3f", bd=2, relief=tk.RIDGE)
+        chat_frame.pack(padx=15, pady=15, fill=tk.BOTH, expand=True)
+
+        self.chat_area = scrolledtext.ScrolledText(chat_frame, wrap=tk.WORD, bg="#1e1e2f",
+                                                   fg="#f0f0f0", font=("Segoe UI", 11),
+                                                   relief=tk.FLAT)
+        self.chat_area.pack(padx=10, pady=10, fill=tk.BOTH, expand=True)
+        self.chat_area.config(state='disabled', yscrollcommand=self.on_scroll)
+        self.chat_area.bind('<Button-4>', self.on_wheel_up)
+        self.chat_area.bind('<MouseWheel>',
+                            lambda event: self.on_wheel_up(event) if event.delta > 0 else None)
+
+        # ----------------- Entry Frame -----------------
+        entry_frame = tk.Frame(self.window, bg="#1e1e2f")
+        entry_frame.pack(padx=15, pady=(0, 15), fill=tk.X)
+
+        self.message_entry = tk.Entry(entry_frame, font=("Segoe UI", 12), bg="#2b2b3f",
+                                      fg="#ffffff", insertbackground='white', relief=tk.FLAT)
+        self.message_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 10), ipady=6)
+        self.message_entry.bind("<Return>", lambda event: self.send_message())
+
+        # Gradient-like 3D Send Button
+        self.send_button = tk.Button(entry_frame, text="Send", command=self.send_message,
+                                     bg="#ff4c4c", fg="#ffffff", font=("Segoe UI Bold", 12),
+                                     activebackground="#ff1a1a", relief=tk.RAISED, bd=4)
+        self.send_button.pack(side=tk.RIGHT)
+
+        self.file_button = tk.Button(entry_frame, text="File", command=self.send_file,
+                                     bg="#2b2b3f", fg="#ffffff", font=("Segoe UI Bold", 12),
+                                     activebackground="#3b3b5f", relief=tk.RAISED, bd=4)
+        self.file_button.pack(side=tk.RIGHT, padx=(0, 10))
+
+        # Add hover effect for send button
+        self.send_button.bind("<Enter>", lambda e: self.send_button.config(bg="#ff1a1a"))
+        self.send_button.bind("<Leave>", lambda e: self.send_button.config(bg="#ff4c4c"))
+
+    # ----------------- Sending -----------------
+    def send_message(self):
+        message = self.message_entry.get()
+        if not message:
+            return
+        try:
+            self.client.send(message)
+        except OutboxFull:
+            self.show_notice(f"{self.client.unsent} messages are already waiting to be sent, "
+                             "try again later")
+            return
+        self.message_entry.delete(0, tk.END)
+        if not self.client.connected:
+            self.show_notice(f"Not connected: {self.client.unsent} message(s) "
+                             "will be sent on reconnect")
+
+    def send_file(self):
+        path = filedialog.askopenfilename(parent=self.window, title="Send a file")
+        if not path:
+            return
+        nickname = simpledialog.askstring("Send file", f"Send {os.path.basename(path)} to:",
+                                          parent=self.window)
+        if not nickname:
+            return
         try:
-            message = client.recv(1024).decode('utf-8')
-            if message == "NICK":
-                client.send(nickname.encode('utf-8'))
+            self.client.send_file(path, nickname)
+        except OSError as e:
+            self.show_notice(f"Cannot send {path}: {e}")
+            return
+        self.show_notice(f"Sending {os.path.basename(path)} to {nickname}...")
+
+    def show_notice(self, text):
+        self.events.put(Message(protocol.SYSTEM, text))
+
+    # ----------------- Display Messages -----------------
+    @staticmethod
+    def message_args(messages):
+        """Text.insert() arguments for Messages. Room chat is tagged 'chat'
+        and the newline after it is not, so the oldest message on screen the
+        server has logged can be found to ask for what came before it."""
+        args = []
+        for message in messages:
+            logged = message.type == protocol.CHAT and not protocol.is_direct_message(message.text)
+            args += [message.text, 'chat' if logged else '', "\n", '']
+        return args
+
+    def line_count(self):
+        return int(self.chat_area.index('end-1c').split('.')[0])
+
+    def drain_events(self):
+        lines = []
+        pages = []
+        while len(lines) < MAX_BATCH:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(event, HistoryPage):
+                pages.append(event)
+            elif isinstance(event, Status):
+                # The server greets us itself once connected
+                if not event.connected:
+                    lines.append(Message(protocol.SYSTEM, event.text))
+            elif isinstance(event, Transfer):
+                lines.append(Message(protocol.SYSTEM, str(event)))
             else:
-                chat_area.config(state='normal')
-                chat_area.insert(tk.END, message + "\n")
-                chat_area.yview(tk.END)
-                chat_area.config(state='disabled')
-        except:
-            messagebox.showerror("Error", "Connection lost")
-            client.close()
-            break
-
-# Start receiving thread
-receive_thread = threading.Thread(target=receive)
-receive_thread.daemon = True
-receive_thread.start()
-
-# ----------------- Enter key sends message -----------------
-message_entry.bind("<Return>", lambda event: send_message())
-
-# Start GUI
-window.mainloop()
\ No newline at end of file
+                lines.append(event)
+        if lines:
+            # Only follow new messages if the user has not scrolled up to read
+            at_bottom = self.chat_area.yview()[1] >= 1.0
+            self.chat_area.config(state='normal')
+            self.chat_area.insert(tk.END, *self.message_args(lines))
+            self.trim_scrollback(self.scrollback if at_bottom else self.scrollback * 2)
+            self.chat_area.config(state='disabled')
+            if at_bottom:
+                self.chat_area.yview(tk.END)
+        for page in pages:
+            self.show_older(page)
+        self.window.after(FRAME_MS, self.drain_events)
+
+    # ----------------- Scrollback -----------------
+    def trim_scrollback(self, limit):
+        """Drop the oldest lines in one go once there are a tenth too many"""
+        excess = self.line_count() - limit
+        if excess > max(limit // 10, 1):
+            self.chat_area.delete('1.0', f'{excess + 1}.0')
+            # Whatever was paged in may be gone; find our place by text next time
+            self.older_cursor = None
+            self.history_done = False
+
+    def request_older(self):
+        """Ask for the page of messages before the oldest one on screen"""
+        if self.client is None or self.paging or self.history_done or not self.client.connected \
+                or self.line_count() >= self.scrollback * 2:
+            return
+        text = None
+        if self.older_cursor is None:
+            oldest = self.chat_area.tag_nextrange('chat', '1.0')
+            text = self.chat_area.get(*oldest) if oldest else None
+        try:
+            self.client.request_older(self.older_cursor, text)
+        except OutboxFull:
+            return
+        # Stays set if the server has no chat log and never answers with a page
+        self.paging = True
+
+    def show_older(self, page):
+        self.paging = False
+        messages = [message for message in page.messages if message.type == protocol.CHAT]
+        if not messages:
+            self.history_done = True
+            return
+        self.older_cursor = page.offset
+        # Keep the line the user is looking at where it is
+        top = int(self.chat_area.index('@0,0').split('.')[0])
+        added = sum(message.text.count("\n") + 1 for message in messages)
+        self.chat_area.config(state='normal')
+        self.chat_area.insert('1.0', *self.message_args(messages))
+        self.chat_area.config(state='disabled')
+        self.chat_area.yview(f'{top + added}.0')
+
+    def on_scroll(self, first, last):
+        self.chat_area.vbar.set(first, last)
+        # Dragged to the top of more text than fits: fetch what came before
+        if float(first) <= 0.0 and float(last) < 1.0:
+            self.request_older()
+
+    def on_wheel_up(self, event):
+        if self.chat_area.yview()[0] <= 0.0:
+            self.request_older()
+
+    def run(self):
+        if self.client is not None:
+            self.window.mainloop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat client")
+    parser.add_argument('--nickname')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--scrollback', type=int,
+                        default=int(os.environ.get('CHAT_SCROLLBACK', DEFAULT_SCROLLBACK)),
+                        help="lines kept on screen (older ones are paged in from the server)")
+    parser.add_argument('--download-dir',
+                        help="accept files other users send and save them here "
+                             "(without it they are refused)")
+    parser.add_argument('--max-download-mb', type=int,
+                        default=DEFAULT_MAX_DOWNLOAD_SIZE // (1024 * 1024),
+                        help="refuse files larger than this")
+    parser.add_argument('--tls', action='store_true', help="connect over TLS")
+    parser.add_argument('--tls-ca', help="CA certificate to trust instead of the system's "
+                                         "(implies --tls)")
+    args = parser.parse_args()
+    tls_context = tls.client_context(args.tls_ca) if args.tls or args.tls_ca else None
+    ChatWindow(args.host, args.port, args.nickname, args.scrollback, args.download_dir,
+               args.max_download_mb * 1024 * 1024, tls_context).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+"""
+Multi-process chat server
+=========================
+
+`python server.py --workers N` forks N worker processes that each run a
+normal server engine on the same port. SO_REUSEPORT lets the kernel
+spread incoming connections across the workers, so the server is no
+longer limited to the one core a single Python process can use.
+
+Clients on different workers still see each other's messages: every room
+broadcast is also published on a local bus. The parent process listens
+on a Unix domain socket, every worker connects to it, and the parent
+relays each published message to all other workers, which deliver it to
+their local room members.
+
+Bus messages use the normal frame format with their own types:
+
+    HELLO  worker -> parent  worker id
+    ROOM   both ways         flags (1B) + room length (2B) + room + frame
+    STATS  worker -> parent  number of connected clients
+
+Direct messages, /rooms and duplicate-nickname checks only see the
+clients of the worker a user is connected to.
+"""
+
+import multiprocessing
+import os
+import selectors
+import signal
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+import outbound
+import protocol
+
+HELLO = 1
+ROOM = 2
+STATS = 3
+
+CHAT_FLAG = 1        # the relayed frame is a chat message worth keeping in history
+ROOM_HEADER = struct.Struct('!BH')
+
+STATS_INTERVAL = 2.0
+REPORT_INTERVAL = 10.0
+BUS_QUEUE_SIZE = 65536
+
+
+def encode_room(room, frame, chat):
+    room_bytes = room.encode('utf-8')
+    return protocol.encode(ROOM, ROOM_HEADER.pack(CHAT_FLAG if chat else 0, len(room_bytes))
+                           + room_bytes + frame)
+
+
+def decode_room(payload):
+    flags, room_length = ROOM_HEADER.unpack_from(payload)
+    start = ROOM_HEADER.size
+    room = payload[start:start + room_length].decode('utf-8')
+    return room, payload[start + room_length:], bool(flags & CHAT_FLAG)
+
+
+# ----------------- Worker Side -----------------
+class BusClient:
+    """A worker's connection to the bus.
+
+    publish() only queues; one writer thread sends, so a busy bus never
+    stalls a client handler. Incoming messages are read on another thread
+    and handed to dispatch(), which the asyncio engine replaces with
+    loop.call_soon_threadsafe so delivery happens on the event loop.
+    """
+
+    def __init__(self, path, worker_id):
+        self.path = path
+        self.worker_id = worker_id
+        self.sock = None
+        self.queue = outbound.OutboundQueue(BUS_QUEUE_SIZE, outbound.DROP_OLDEST)
+
+    def start(self, hub, dispatch=None):
+        self.hub = hub
+        self.dispatch = dispatch or (lambda callback, *args: callback(*args))
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+        self.sock.sendall(protocol.encode(HELLO, str(self.worker_id)))
+        for target in (self._write_loop, self._read_loop, self._stats_loop):
+            threading.Thread(target=target, daemon=True).start()
+
+    def max_frame_size(self, room):
+        """Largest frame publish() can carry for room: the ROOM message
+        holding it must itself fit in a frame"""
+        return protocol.MAX_FRAME_SIZE - ROOM_HEADER.size - len(room.encode('utf-8'))
+
+    def publish(self, room, frame, chat=False):
+        self.queue.put(encode_room(room, frame, chat))
+
+    def _write_loop(self):
+        while True:
+            batch = self.queue.get_batch()
+            if batch is None:
+                break
+            self.sock.sendall(b''.join(batch))
+
+    def _read_loop(self):
+        reader = protocol.FrameReader()
+        try:
+            while True:
+                for frame_type, payload in protocol.recv_frames(self.sock, reader):
+                    if frame_type == ROOM:
+                        room, frame, chat = decode_room(payload)
+                        self.dispatch(self.hub.deliver_remote, room, frame, chat)
+        except (OSError, protocol.ProtocolError):
+            # A worker cut off from the bus would silently split the chat
+            print(f"Worker {self.worker_id} lost the message bus, exiting")
+            os._exit(1)
+
+    def _stats_loop(self):
+        while True:
+            self.queue.put(protocol.encode(STATS, str(len(self.hub.registry))))
+            time.sleep(STATS_INTERVAL)
+
+
+def run_worker(worker_id, bus_path, args, run):
+    bus = BusClient(bus_path, worker_id)
+    if args.log_dir:
+        # Each worker owns its own log of every room's chat, including what
+        # arrives over the bus; one log file must have one writer
+        args.log_dir = os.path.join(args.log_dir, f"worker-{worker_id}")
+    if args.metrics_port:
+        args.metrics_port += worker_id
+    print(f"Worker {worker_id} (pid {os.getpid()}) starting")
+    try:
+        run(args, bus=bus)
+    except KeyboardInterrupt:
+        pass
+
+
+# ----------------- Parent Side -----------------
+class BusRelay:
+    """Runs in the parent: fans every ROOM message out to the other workers"""
+
+    def __init__(self, path):
+        self.path = path
+        self.selector = selectors.DefaultSelector()
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen()
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.readers = {}       # worker socket -> FrameReader
+        self.worker_ids = {}    # worker socket -> worker id
+        self.connections = {}   # worker id -> last reported client count
+
+    def run(self, report_interval=REPORT_INTERVAL):
+        next_report = time.monotonic() + report_interval
+        while True:
+            for key, _ in self.selector.select(timeout=1.0):
+                if key.fileobj is self.listener:
+                    self._accept()
+                else:
+                    self._read(key.fileobj)
+            if time.monotonic() >= next_report:
+                self.report()
+                next_report = time.monotonic() + report_interval
+
+    def _accept(self):
+        sock, _ = self.listener.accept()
+        sock.setblocking(True)
+        self.readers[sock] = protocol.FrameReader()
+        self.selector.register(sock, selectors.EVENT_READ)
+
+    def _read(self, sock):
+        try:
+            data = sock.recv(protocol.RECV_SIZE)
+        except OSError:
+            data = b''
+        if not data:
+            self._drop(sock)
+            return
+        for frame_type, payload in self.readers[sock].feed(data):
+            if frame_type == HELLO:
+                self.worker_ids[sock] = int(payload)
+                self.connections[int(payload)] = 0
+            elif frame_type == STATS:
+                self.connections[self.worker_ids.get(sock)] = int(payload)
+            elif frame_type == ROOM:
+                message = protocol.encode(ROOM, payload)
+                for other in list(self.readers):
+                    if other is not sock:
+                        try:
+                            other.sendall(message)
+                        except OSError:
+                            self._drop(other)
+
+    def _drop(self, sock):
+        self.selector.unregister(sock)
+        self.readers.pop(sock, None)
+        worker_id = self.worker_ids.pop(sock, None)
+        self.connections.pop(worker_id, None)
+        sock.close()
+
+    def report(self):
+        counts = ', '.join(f"worker {worker_id}: {count}"
+                           for worker_id, count in sorted(self.connections.items()))
+        total = sum(self.connections.values())
+        print(f"Connections per worker - {counts} (total {total})")
+
+    def close(self):
+        self.selector.close()
+        self.listener.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def run_cluster(args, run):
+    """Start args.workers worker processes sharing args.port and relay
+    messages between them until interrupted"""
+    bus_path = os.path.join(tempfile.mkdtemp(prefix='chat-bus-'), 'bus.sock')
+    relay = BusRelay(bus_path)
+    # fork keeps the parsed args and the run() callback without pickling
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=run_worker, args=(i, bus_path, args, run),
+                                       daemon=True)
+               for i in range(1, args.workers + 1)]
+    for worker in workers:
+        worker.start()
+    print(f"Started {len(workers)} workers on {args.host}:{args.port} (bus {bus_path})")
+    # SIGTERM stops the cluster like Ctrl-C: every worker is told to drain
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        relay.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+        relay.close()
+        os.rmdir(os.path.dirname(bus_path))
@@ -0,0 +1,82 @@
+"""
+Message history
+===============
+
+Each room keeps its most recent chat frames in a fixed-size ring buffer
+so people who join (or reconnect) can catch up. The buffers store the
+already-encoded frames, so a replay is just one b''.join() handed to the
+joiner's outbound queue as a single write.
+
+Memory is bounded twice over: every room keeps at most `depth` frames
+and at most `max_rooms` rooms keep a history, the least recently used
+one being dropped first.
+"""
+
+import collections
+import threading
+
+DEFAULT_DEPTH = 50
+DEFAULT_MAX_ROOMS = 256
+
+
+class RingBuffer:
+    """Fixed-size buffer that overwrites its oldest item when full"""
+
+    __slots__ = ('slots', 'start', 'count', 'lock')
+
+    def __init__(self, size):
+        self.slots = [None] * size
+        self.start = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def append(self, item):
+        size = len(self.slots)
+        with self.lock:
+            self.slots[(self.start + self.count) % size] = item
+            if self.count < size:
+                self.count += 1
+            else:
+                self.start = (self.start + 1) % size
+
+    def items(self):
+        """Oldest to newest"""
+        size = len(self.slots)
+        with self.lock:
+            end = self.start + self.count
+            if end <= size:
+                return self.slots[self.start:end]
+            return self.slots[self.start:] + self.slots[:end - size]
+
+
+class ChatHistory:
+    def __init__(self, depth=DEFAULT_DEPTH, max_rooms=DEFAULT_MAX_ROOMS):
+        self.depth = depth
+        self.max_rooms = max_rooms
+        self.rooms = collections.OrderedDict()  # room -> RingBuffer
+        self.lock = threading.Lock()
+
+    def _buffer(self, room, create):
+        with self.lock:
+            buffer = self.rooms.get(room)
+            if buffer is not None:
+                self.rooms.move_to_end(room)
+            elif create:
+                buffer = self.rooms[room] = RingBuffer(self.depth)
+                if len(self.rooms) > self.max_rooms:
+                    self.rooms.popitem(last=False)
+            return buffer
+
+    def record(self, room, frame):
+        if self.depth > 0:
+            self._buffer(room, True).append(frame)
+
+    def replay(self, room):
+        """All remembered frames of a room as one write, or b'' if none"""
+        buffer = self._buffer(room, False)
+        if buffer is None:
+            return b''
+        return b''.join(buffer.items())
@@ -0,0 +1,608 @@
+"""
+Chat hub
+========
+
+Everything the server does with a message once it has been read: room
+membership, chat commands and fan-out. The engines only move bytes; they
+register a connection with join(), pass every incoming frame to
+handle_frame() and call leave() when the connection ends.
+
+Chat commands (sent as ordinary CHAT text):
+
+    /join <room>          move to another room (created on first join)
+    /leave                go back to the lobby
+    /msg <nick> <text>    direct message to one user
+    /rooms                list rooms and how many people are in them
+    /help                 show this list
+
+When the server runs with a chat log, a client can also send a HISTORY
+frame "since <offset>" to fetch logged messages of its room; the reply is
+the logged frames followed by a HISTORY frame holding the offset to ask
+for next time.
+
+Scrolling back works the other way: "before <offset>" asks for the page
+of messages just older than offset, and "before" followed by a newline
+and the text of a chat message asks for the page older than that message
+(looked for among the room's HISTORY_SEARCH_DEPTH newest logged
+messages), which is how a client that only kept its newest lines finds
+its place again. The reply is one HISTORY frame, see
+protocol.encode_history_page(); it holds no messages if the offset is not
+one the log handed out or the message is not found. Direct messages are
+never logged, so they are never looked for.
+
+File transfers (see protocol.py) go from one client to another by
+nickname, relayed chunk by chunk once the recipient has accepted them. The server never holds more of a file
+than a few chunks per recipient: chunks skip the flood limits but are
+queued with put_paced(), so the sender's reader waits for the recipient
+and TCP flow control slows the sender down. Compression is not applied
+to chunks.
+
+Heartbeats: a client that has sent nothing for ping_interval seconds gets
+a PING frame, and one that still sends nothing (not even the PONG) within
+pong_timeout is disconnected. So is one whose outbound queue is too full
+to take the PING, whatever the slow-consumer policy. Deadlines live on a
+single timer wheel that the engine advances by calling heartbeat() once
+per tick; incoming frames only record the time they arrived.
+
+Shutdown (see lifecycle.py): begin_drain() stops the hub taking chat
+messages, then the engine calls goodbye() for every client, which queues
+a CLOSE frame and closes the queue so the writer flushes it and hangs up.
+A client whose queue is full is disconnected instead, so a slow reader
+cannot hold up the drain under the block policy.
+"""
+
+import itertools
+import time
+
+import protocol
+import ratelimit
+from history import ChatHistory
+from metrics import Metrics
+from registry import LOBBY
+from timerwheel import TimerWheel
+
+MAX_ROOM_NAME = 32
+HISTORY_PAGE = 100
+# How many of a room's newest logged messages a "before <text>" request
+# searches: twice the GUI's default scrollback, where its oldest line can be
+HISTORY_SEARCH_DEPTH = 10000
+DEFAULT_PING_INTERVAL = 30.0
+DEFAULT_PONG_TIMEOUT = 10.0
+DEFAULT_DRAIN_TIMEOUT = 10.0
+DEFAULT_DRAIN_SPREAD = 2.0
+DEFAULT_MAX_FILE_SIZE = 100 * 1024 * 1024
+MAX_TRANSFERS = 4   # files one client may be sending at once
+FILE_WINDOW = 4     # chunks queued per recipient before the sender waits
+HELP_TEXT = ("Commands: /join <room>, /leave, /msg <nick> <text>, "
+             "/rooms, /help")
+
+
+class ChatHub:
+    def __init__(self, registry, disconnect, history=None, log=None):
+        # disconnect(key) is supplied by the engine and must make the
+        # connection's reader fail, which ends in a call to leave()
+        self.registry = registry
+        self.disconnect = disconnect
+        self.history = history if history is not None else ChatHistory()
+        self.log = log
+        # Set in multi-process mode: room traffic is also published to the
+        # other workers (see cluster.py)
+        self.bus = None
+        # Offered to clients in the NICK frame
+        self.features = protocol.FEATURES
+        self.flood = ratelimit.FloodControl()
+        # 0 turns heartbeats off
+        self.ping_interval = DEFAULT_PING_INTERVAL
+        self.pong_timeout = DEFAULT_PONG_TIMEOUT
+        self.wheel = TimerWheel()
+        # Shutdown: goodbyes are spread over drain_spread seconds, and
+        # clients still connected after drain_timeout are cut off
+        self.draining = False
+        self.drain_reason = None
+        self.drain_spread = DEFAULT_DRAIN_SPREAD
+        self.drain_timeout = DEFAULT_DRAIN_TIMEOUT
+        self.max_file_size = DEFAULT_MAX_FILE_SIZE
+        self.transfer_ids = itertools.count(1)
+
+        self.metrics = Metrics()
+        self.messages_in = self.metrics.counter(
+            'chat_messages_in_total', "Frames received from clients")
+        self.bytes_in = self.metrics.counter(
+            'chat_bytes_in_total', "Bytes of frames received from clients")
+        self.messages_out = self.metrics.counter(
+            'chat_messages_out_total', "Frames queued for delivery to clients")
+        self.bytes_out = self.metrics.counter(
+            'chat_bytes_out_total', "Bytes queued for delivery to clients")
+        self.connections = self.metrics.counter(
+            'chat_connections_total', "Clients that completed the handshake")
+        self.handshake_failures = self.metrics.counter(
+            'chat_handshake_failures_total', "Connections dropped before completing the handshake")
+        self.throttled = self.metrics.counter(
+            'chat_throttled_messages_total', "Frames discarded by flood control")
+        self.throttled_bytes = self.metrics.counter(
+            'chat_throttled_bytes_total', "Bytes of frames discarded by flood control")
+        self.flood_disconnects = self.metrics.counter(
+            'chat_flood_disconnects_total', "Connections closed by flood control")
+        self.pings_sent = self.metrics.counter(
+            'chat_pings_sent_total', "PING frames sent to quiet clients")
+        self.reaped = self.metrics.counter(
+            'chat_reaped_connections_total', "Connections closed for not answering a PING")
+        self.compression_saved = self.metrics.counter(
+            'chat_compression_saved_bytes_total', "Bytes not sent thanks to frame compression")
+        self.socket_reads = self.metrics.counter(
+            'chat_socket_reads_total', "Reads issued on client sockets")
+        self.socket_writes = self.metrics.counter(
+            'chat_socket_writes_total', "Writes issued on client sockets")
+        self.tls_handshakes = self.metrics.counter(
+            'chat_tls_handshakes_total', "Completed TLS handshakes")
+        self.tls_resumed = self.metrics.counter(
+            'chat_tls_resumed_total', "TLS handshakes that resumed an earlier session")
+        self.files_started = self.metrics.counter(
+            'chat_file_transfers_total', "File transfers relayed")
+        self.file_bytes = self.metrics.counter(
+            'chat_file_bytes_total', "Bytes of file data relayed")
+        self.fanout_latency = self.metrics.histogram(
+            'chat_broadcast_fanout_seconds', "Time to queue one broadcast for all recipients")
+        self.metrics.gauge('chat_active_connections', "Connected clients",
+                           lambda: len(self.registry))
+        self.metrics.gauge('chat_rooms', "Rooms with at least one member",
+                           lambda: len(self.registry.rooms()))
+        self.metrics.gauge('chat_client_queue_depth', "Frames waiting to be written, per client",
+                           self.registry.queue_depths)
+        self.metrics.gauge('chat_client_messages_in', "Frames received, per client",
+                           lambda: {c.nickname: c.messages_in for c in self.registry.clients()})
+        self.metrics.gauge('chat_client_bytes_in', "Bytes received, per client",
+                           lambda: {c.nickname: c.bytes_in for c in self.registry.clients()})
+        self.metrics.gauge('chat_client_throttled', "Frames discarded by flood control, per client",
+                           lambda: {c.nickname: c.throttled for c in self.registry.clients()})
+
+    # ----------------- Connection Lifecycle -----------------
+    def join(self, key, nickname, queue, features=()):
+        """Register a connection that finished the NICK handshake"""
+        compress = protocol.DEFLATE in features and protocol.DEFLATE in self.features
+        client = self.registry.add(key, nickname, queue, compress=compress)
+        client.files = protocol.FILES in features and protocol.FILES in self.features
+        client.limits = self.flood.new_client()
+        if self.ping_interval:
+            self.wheel.schedule(client.last_seen + self.ping_interval, client)
+        self.connections.inc()
+        if self.draining:
+            # Finished its handshake just as the server began shutting down
+            self.goodbye(client)
+            return client
+        self.replay(client)
+        self.publish(protocol.encode(protocol.SYSTEM, f"{client.nickname} joined the chat!"),
+                     client.room)
+        self.send(client, protocol.encode(
+            protocol.SYSTEM, f"Connected to the server! You are in #{client.room}. {HELP_TEXT}"))
+        return client
+
+    def leave(self, key):
+        """Unregister a connection. Only the first call for a key does
+        anything, so the leave notice is sent exactly once."""
+        client = self.registry.remove(key)
+        if client is None:
+            return None
+        client.queue.close()
+        for transfer in list(client.uploads.values()):
+            self.stop_transfer(transfer, f"{client.nickname} left", notify_sender=False)
+        for transfer in list(client.downloads.values()):
+            self.stop_transfer(transfer, f"{client.nickname} left", notify_recipient=False)
+        if not self.draining:
+            self.publish(protocol.encode(protocol.SYSTEM, f"{client.nickname} left the chat!"),
+                         client.room)
+        return client
+
+    def begin_drain(self, reason):
+        """Stop taking chat messages and release what another server
+        process would need: pending log writes and the metrics port"""
+        self.draining = True
+        self.drain_reason = reason
+        if self.log is not None:
+            self.log.flush()
+        self.metrics.stop()
+
+    def goodbye(self, client):
+        """Queue the CLOSE frame last; the writer flushes it and hangs up.
+        Never waits: a client with no room left for it is cut off."""
+        frame = protocol.encode(protocol.CLOSE, self.drain_reason)
+        if client.queue.put_nowait(frame):
+            self.messages_out.inc()
+            self.bytes_out.inc(len(frame))
+        else:
+            self.disconnect(client.key)
+        client.queue.close()
+
+    # ----------------- Fan-out -----------------
+    def _put(self, client, frame):
+        if not client.queue.put(frame):
+            # While draining a closed queue just means goodbye was sent
+            if not self.draining:
+                self.disconnect(client.key)
+            return False
+        return True
+
+    def send(self, client, frame):
+        if client.compress:
+            compressed = protocol.compress(frame)
+            self.compression_saved.inc(len(frame) - len(compressed))
+            frame = compressed
+        self.messages_out.inc()
+        self.bytes_out.inc(len(frame))
+        return self._put(client, frame)
+
+    def broadcast(self, frame, room=None):
+        """Queue one encoded frame for a room (or everyone if room is None).
+        Returns the queues that are over their limit under the block policy."""
+        started = time.perf_counter()
+        members = self.registry.clients() if room is None else self.registry.members(room)
+        congested = []
+        # Compressed at most once, however many recipients asked for it
+        compressed = None
+        compressed_count = 0
+        for client in members:
+            data = frame
+            if client.compress:
+                if compressed is None:
+                    compressed = protocol.compress(frame)
+                data = compressed
+                compressed_count += 1
+            if self._put(client, data) and client.queue.congested:
+                congested.append(client.queue)
+        # Counted once per broadcast rather than once per recipient
+        self.messages_out.inc(len(members))
+        saved = (len(frame) - len(compressed)) * compressed_count if compressed_count else 0
+        self.bytes_out.inc(len(frame) * len(members) - saved)
+        self.compression_saved.inc(saved)
+        self.fanout_latency.observe(time.perf_counter() - started)
+        return congested
+
+    def publish(self, frame, room, chat=False):
+        """Broadcast to a room here and on every other worker"""
+        if self.bus is not None:
+            self.bus.publish(room, frame, chat)
+        return self.broadcast(frame, room)
+
+    def max_chat_size(self, room):
+        """Largest CHAT payload that can still be published to room"""
+        if self.bus is None:
+            return protocol.MAX_FRAME_SIZE
+        return self.bus.max_frame_size(room) - protocol.HEADER.size
+
+    def deliver_remote(self, room, frame, chat):
+        """A room broadcast that another worker published on the bus"""
+        if chat:
+            self.history.record(room, frame)
+            # Every worker logs the whole chat, so history pages served
+            # here are not limited to this worker's own clients
+            if self.log is not None:
+                self.log.append(room, frame)
+        self.broadcast(frame, room)
+
+    # ----------------- Heartbeats -----------------
+    def tls_connected(self, resumed):
+        self.tls_handshakes.inc()
+        if resumed:
+            self.tls_resumed.inc()
+
+    def heartbeat(self, now=None):
+        """Ping clients that went quiet and reap the ones that never
+        answered. The engine calls this once per timer wheel tick."""
+        now = time.monotonic() if now is None else now
+        for client in self.wheel.advance(now):
+            if self.registry.get(client.key) is not client:
+                # Left since it was scheduled
+                continue
+            if now - client.last_seen < self.ping_interval:
+                # Heard from it in the meantime
+                self.wheel.schedule(client.last_seen + self.ping_interval, client)
+            elif not client.pinged:
+                client.pinged = True
+                # Never waits, or one stalled client under the block policy
+                # would stop the heartbeat for everybody
+                ping = protocol.encode(protocol.PING)
+                if not client.queue.put_nowait(ping):
+                    print(f"Reaping {client.nickname}: outbound queue full")
+                    self.reaped.inc()
+                    self.disconnect(client.key)
+                    continue
+                self.pings_sent.inc()
+                self.messages_out.inc()
+                self.bytes_out.inc(len(ping))
+                self.wheel.schedule(now + self.pong_timeout, client)
+            else:
+                print(f"Reaping {client.nickname}: no answer to PING")
+                self.reaped.inc()
+                self.disconnect(client.key)
+
+    def replay(self, client):
+        """Send the room's recent messages to a joiner in one write"""
+        backlog = self.history.replay(client.room)
+        if backlog:
+            self.send(client, backlog)
+
+    # ----------------- Incoming Frames -----------------
+    def handle_frame(self, client, frame_type, payload):
+        """Act on one frame from a registered client. Returns the queues
+        the sender should wait on before sending more (block policy)."""
+        size = len(payload) + protocol.HEADER.size
+        # Any frame proves the peer is alive, whatever happens to it next
+        client.last_seen = time.monotonic()
+        client.pinged = False
+        self.messages_in.inc()
+        self.bytes_in.inc(size)
+        client.messages_in += 1
+        client.bytes_in += size
+        if frame_type == protocol.FILE_DATA:
+            if self.draining:
+                return []
+            transfer = self.upload_of(client, payload)
+            if transfer is not None and transfer.accepted:
+                # Paced by the recipient rather than the flood limits
+                return self.relay_chunk(transfer, payload)
+            if transfer is not None:
+                self.stop_transfer(transfer, "data sent before the file was accepted")
+            # Chunks of no accepted transfer are charged like any other frame
+        if self.draining and frame_type not in (protocol.PING, protocol.PONG):
+            self.reply(client, f"{self.drain_reason}, message not sent")
+            return []
+        # Limits apply before anything is broadcast or looked up
+        verdict = self.flood.check(client.limits, size)
+        if verdict != ratelimit.ALLOW:
+            self.throttle(client, size, verdict)
+            return []
+        if frame_type == protocol.PING:
+            self.send(client, protocol.encode(protocol.PONG, payload))
+            return []
+        if frame_type == protocol.HISTORY:
+            self.send_log(client, payload.decode('utf-8', 'replace'))
+            return []
+        if frame_type == protocol.FILE:
+            self.handle_file(client, payload.decode('utf-8', 'replace'))
+            return []
+        if frame_type != protocol.CHAT:
+            return []
+        text = payload.decode('utf-8', 'replace')
+        if text.startswith('/'):
+            return self.handle_command(client, text)
+        line = f"{client.nickname}: {text}".encode('utf-8')
+        if len(line) > self.max_chat_size(client.room):
+            # The nickname prefix can push a frame that fit over the limit
+            self.reply(client, "Message too long, not sent")
+            return []
+        frame = protocol.encode(protocol.CHAT, line)
+        self.history.record(client.room, frame)
+        if self.log is not None:
+            self.log.append(client.room, frame)
+        return self.publish(frame, client.room, chat=True)
+
+    def throttle(self, client, size, verdict):
+        self.throttled.inc()
+        self.throttled_bytes.inc(size)
+        client.throttled += 1
+        if verdict == ratelimit.KICK:
+            self.flood_disconnects.inc()
+            self.reply(client, "Disconnected for flooding")
+            self.disconnect(client.key)
+        elif not client.limits.warned:
+            client.limits.warned = True
+            if self.flood.penalty == ratelimit.MUTE:
+                self.reply(client, f"You are muted for {self.flood.mute_seconds:g} seconds "
+                                   "for sending too fast")
+            else:
+                self.reply(client, "You are sending too fast, messages are being dropped")
+
+    def send_log(self, client, request):
+        """Answer a HISTORY request from the on-disk chat log"""
+        if self.log is None:
+            self.reply(client, "Message history is not enabled on this server")
+            return
+        if request == 'before' or request.startswith(('before ', 'before\n')):
+            self.send_older(client, request[len('before') + 1:], request[6:7] == '\n')
+            return
+        command, _, offset = request.partition(' ')
+        if command != 'since' or not offset.isdigit():
+            self.reply(client, "Bad history request")
+            return
+        records, next_offset = self.log.read_since(int(offset), client.room, HISTORY_PAGE)
+        self.send(client, b''.join([frame for _, _, frame in records]
+                                   + [protocol.encode(protocol.HISTORY, str(next_offset))]))
+
+    def send_older(self, client, anchor, is_text):
+        """Answer "before ..." with the page of the room's messages that
+        precede an offset or a given message, oldest first"""
+        if is_text:
+            offset = None
+            if not protocol.is_direct_message(anchor):
+                offset = self.log.find(client.room, protocol.encode(protocol.CHAT, anchor),
+                                       HISTORY_SEARCH_DEPTH)
+        elif anchor.isdigit():
+            offset = int(anchor)
+        elif not anchor:
+            offset = self.log.end
+        else:
+            self.reply(client, "Bad history request")
+            return
+        frames = []
+        if offset is not None:
+            records, _ = self.log.read_before(offset, client.room, HISTORY_PAGE)
+            # The page travels as one frame, so it must stay under the frame limit
+            room_left = protocol.MAX_FRAME_SIZE - 64
+            for record_offset, _, frame in reversed(records):
+                room_left -= len(frame)
+                if room_left < 0:
+                    break
+                frames.append(frame)
+                offset = record_offset
+            frames.reverse()
+        self.send(client, protocol.encode_history_page(offset or 0, frames))
+
+    # ----------------- File Transfers -----------------
+    def handle_file(self, client, text):
+        if not client.files:
+            return
+        command, _, args = text.partition(' ')
+        if command == 'offer':
+            self.offer_file(client, args)
+        elif command in ('end', 'cancel') and args.isdigit():
+            transfer = client.uploads.get(int(args))
+            if transfer is not None:
+                if command == 'end':
+                    complete = transfer.accepted and transfer.received == transfer.size
+                    self.stop_transfer(transfer, None if complete else "file incomplete")
+                else:
+                    self.stop_transfer(transfer, f"cancelled by {client.nickname}",
+                                       notify_sender=False)
+        elif command == 'accept' and args.isdigit():
+            transfer = client.downloads.get(int(args))
+            if transfer is not None and not transfer.accepted:
+                transfer.accepted = True
+                self.send(transfer.sender,
+                          protocol.encode(protocol.FILE, f"accepted {transfer.upload_id}"))
+        elif command == 'reject' and args.isdigit():
+            transfer = client.downloads.get(int(args))
+            if transfer is not None:
+                self.stop_transfer(transfer, f"rejected by {client.nickname}",
+                                   notify_recipient=False)
+
+    def offer_file(self, client, args):
+        parts = args.split(' ', 3)
+        if len(parts) != 4 or not parts[0].isdigit() or not parts[1].isdigit():
+            self.reply(client, "Bad file offer")
+            return
+        upload_id, size, nickname, name = int(parts[0]), int(parts[1]), parts[2], parts[3]
+        target = self.registry.find(nickname)
+        if upload_id in client.uploads:
+            reason = "transfer id already in use"
+        elif len(client.uploads) >= MAX_TRANSFERS:
+            reason = f"at most {MAX_TRANSFERS} files can be sent at once"
+        elif size > self.max_file_size:
+            reason = f"files are limited to {self.max_file_size} bytes"
+        elif target is None:
+            reason = f"no such user: {nickname}"
+        elif not target.files:
+            reason = f"{nickname} cannot receive files"
+        else:
+            transfer = Transfer(client, upload_id, target, next(self.transfer_ids), size)
+            client.uploads[upload_id] = transfer
+            target.downloads[transfer.transfer_id] = transfer
+            self.files_started.inc()
+            self.send(target, protocol.encode(
+                protocol.FILE, f"offer {transfer.transfer_id} {size} {client.nickname} {name}"))
+            return
+        self.send(client, protocol.encode(protocol.FILE, f"refused {upload_id} {reason}"))
+
+    def upload_of(self, client, payload):
+        """The client's transfer a FILE_DATA payload belongs to, or None"""
+        if len(payload) < protocol.FILE_ID.size:
+            return None
+        (upload_id,) = protocol.FILE_ID.unpack_from(payload)
+        return client.uploads.get(upload_id)
+
+    def relay_chunk(self, transfer, payload):
+        with memoryview(payload) as view:
+            chunk = view[protocol.FILE_ID.size:]
+            transfer.received += len(chunk)
+            if transfer.received > transfer.size:
+                self.stop_transfer(transfer, "more data than announced")
+                return []
+            frame = protocol.encode_file_chunk(transfer.transfer_id, chunk)
+            self.file_bytes.inc(len(chunk))
+        self.messages_out.inc()
+        self.bytes_out.inc(len(frame))
+        queue = transfer.recipient.queue
+        if not queue.put_paced(frame, FILE_WINDOW):
+            self.stop_transfer(transfer, f"{transfer.recipient.nickname} left",
+                               notify_recipient=False)
+            return []
+        return [queue] if queue.congested else []
+
+    def stop_transfer(self, transfer, reason, notify_sender=True, notify_recipient=True):
+        """Forget a finished (reason None) or failed transfer and tell
+        whichever side still needs to know"""
+        if transfer.sender.uploads.pop(transfer.upload_id, None) is None:
+            return
+        transfer.recipient.downloads.pop(transfer.transfer_id, None)
+        if notify_recipient:
+            text = f"end {transfer.transfer_id}" if reason is None \
+                else f"abort {transfer.transfer_id} {reason}"
+            self.send(transfer.recipient, protocol.encode(protocol.FILE, text))
+        if notify_sender:
+            text = f"done {transfer.upload_id}" if reason is None \
+                else f"refused {transfer.upload_id} {reason}"
+            self.send(transfer.sender, protocol.encode(protocol.FILE, text))
+
+    def handle_command(self, client, text):
+        command, _, args = text[1:].partition(' ')
+        command = command.lower()
+        args = args.strip()
+
+        if command == 'join':
+            return self.join_room(client, args.lstrip('#'))
+        if command == 'leave':
+            return self.join_room(client, LOBBY)
+        if command == 'msg':
+            nickname, _, message = args.partition(' ')
+            return self.direct_message(client, nickname, message.strip())
+        if command == 'rooms':
+            rooms = ', '.join(f"#{room} ({count})"
+                              for room, count in sorted(self.registry.rooms().items()))
+            self.reply(client, f"Rooms: {rooms}")
+        elif command == 'help':
+            self.reply(client, HELP_TEXT)
+        else:
+            self.reply(client, f"Unknown command /{command}. {HELP_TEXT}")
+        return []
+
+    def join_room(self, client, room):
+        if not room or len(room) > MAX_ROOM_NAME or ' ' in room:
+            self.reply(client, f"Room names are 1-{MAX_ROOM_NAME} characters without spaces")
+            return []
+        if room == client.room:
+            self.reply(client, f"You are already in #{room}")
+            return []
+        old = self.registry.move(client, room)
+        self.publish(protocol.encode(protocol.SYSTEM, f"{client.nickname} left #{old}"), old)
+        self.replay(client)
+        congested = self.publish(
+            protocol.encode(protocol.SYSTEM, f"{client.nickname} joined #{room}"), room)
+        self.reply(client, f"You are now in #{room}")
+        return congested
+
+    def direct_message(self, client, nickname, message):
+        target = self.registry.find(nickname)
+        if target is None:
+            self.reply(client, f"No such user: {nickname}")
+            return []
+        if not message:
+            self.reply(client, "Usage: /msg <nick> <text>")
+            return []
+        # Formatted so that protocol.is_direct_message() recognises them
+        received = f"[DM] {client.nickname}: {message}".encode('utf-8')
+        sent = f"[DM to {nickname}] {message}".encode('utf-8')
+        if max(len(received), len(sent)) > protocol.MAX_FRAME_SIZE:
+            self.reply(client, "Message too long, not sent")
+            return []
+        self.send(target, protocol.encode(protocol.CHAT, received))
+        if target is not client:
+            self.send(client, protocol.encode(protocol.CHAT, sent))
+        return [target.queue] if target.queue.congested else []
+
+    def reply(self, client, text):
+        self.send(client, protocol.encode(protocol.SYSTEM, text))
+
+
+class Transfer:
+    """One file on its way from sender to recipient"""
+
+    __slots__ = ('sender', 'upload_id', 'recipient', 'transfer_id', 'size', 'received',
+                 'accepted')
+
+    def __init__(self, sender, upload_id, recipient, transfer_id, size):
+        self.sender = sender
+        self.upload_id = upload_id
+        self.recipient = recipient
+        self.transfer_id = transfer_id
+        self.size = size
+        self.received = 0
+        self.accepted = False
@@ -0,0 +1,67 @@
+"""
+Graceful shutdown and hot restart
+=================================
+
+SIGTERM or SIGINT drains the server: it stops accepting, stops taking
+new chat messages, sends every client a CLOSE frame after whatever is
+already queued for it and hangs up once the queue is flushed. Clients are
+said goodbye to over drain_spread seconds rather than all at once, so
+they do not all reconnect in the same instant. Whoever is still connected
+drain_timeout seconds after the drain began is cut off, and so is a
+client whose queue has no room left for the CLOSE frame.
+
+SIGHUP does the same after starting a new server process with the same
+command line. The new process inherits the listening socket (its file
+descriptor number is passed in CHAT_LISTEN_FD) instead of binding the
+port again, so the port never stops accepting: connections that arrive
+during the restart wait in the shared accept queue and clients told to
+reconnect land on the new process.
+
+Hot restart is for single-process servers. In --workers mode SIGHUP is
+ignored; stopping the cluster still drains every worker.
+"""
+
+import atexit
+import os
+import socket
+import subprocess
+import sys
+
+LISTEN_FD_ENV = 'CHAT_LISTEN_FD'
+
+SHUTDOWN_REASON = "Server is shutting down"
+RESTART_REASON = "Server is restarting, please reconnect"
+
+
+def inherited_listener():
+    """The listening socket handed over by a previous process, or None"""
+    fd = os.environ.pop(LISTEN_FD_ENV, None)
+    if fd is None:
+        return None
+    return socket.socket(fileno=int(fd))
+
+
+def spawn_successor(listener):
+    """Start a copy of this server that takes over the listening socket"""
+    fd = listener.fileno()
+    env = dict(os.environ, **{LISTEN_FD_ENV: str(fd)})
+    proc = subprocess.Popen([sys.executable, *sys.argv], pass_fds=(fd,), env=env)
+    print(f"Hot restart: new server process {proc.pid} takes over")
+    return proc
+
+
+def write_pid_file(path):
+    """Record our pid; removed again at exit unless a successor replaced it"""
+    pid = str(os.getpid())
+    with open(path, 'w') as f:
+        f.write(pid + '\n')
+
+    def remove():
+        try:
+            with open(path) as f:
+                if f.read().strip() == pid:
+                    os.unlink(path)
+        except OSError:
+            pass
+
+    atexit.register(remove)
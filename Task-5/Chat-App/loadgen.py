@@ -0,0 +1,448 @@
+"""
+Chat load generator
+===================
+
+Runs thousands of simulated chat clients on one asyncio loop against a
+chat server, without any Tk windows. Every client completes the NICK
+handshake and optionally joins one of several rooms; a subset of them
+then send messages at a fixed rate for a while and every client records
+how long each message took to reach it.
+
+Each message carries the sender's send time, so latency is measured end
+to end on one clock: from the moment the message was due to be sent to
+the moment a recipient parsed it. Using the scheduled time rather than
+the actual send time keeps a stalled sender from hiding the stall in its
+own numbers.
+
+With --reconnect a client whose connection ends (for example after the
+server's CLOSE frame during a shutdown or hot restart) connects again
+and carries on; --signal-after sends a signal to a spawned server in the
+middle of the run, so a restart can be measured under load:
+
+    python loadgen.py --spawn asyncio --reconnect --signal-after 10 --signal HUP
+
+With --tls-ca clients connect over TLS and, unless --no-resume is given,
+offer the session of their previous connection when they reconnect; the
+report then counts how many handshakes resumed (none after a hot restart,
+see tls.py):
+
+    python loadgen.py --spawn asyncio --reconnect --signal-after 10 --tls-ca certs/cert.pem \
+        --server-args "--tls-cert certs/cert.pem --tls-key certs/key.pem"
+
+The run ends with a report of connect times, throughput, delivery ratio
+and latency percentiles. With --report it is also written as JSON
+together with every setting, the random seed and the environment, so two
+runs (engines, server flags, commits) can be compared line by line.
+
+Usage:
+    python loadgen.py --port 5000 --clients 2000 --senders 100 --rate 2
+    python loadgen.py --spawn asyncio --clients 2000 --report asyncio.json
+    python loadgen.py --spawn threaded --server-args "--slow-policy block"
+"""
+
+import argparse
+import array
+import asyncio
+import json
+import os
+import platform
+import random
+import shlex
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import protocol
+import tls
+from bench_engines import raise_fd_limit, start_server, wait_for_port
+
+MARKER = b'~lg '
+
+
+def percentile(values, fraction):
+    """values must be sorted"""
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Recorder:
+    """Results shared by all simulated clients (one event loop, no locks)"""
+
+    def __init__(self):
+        self.measure_from = None    # perf_counter_ns; earlier messages are warm-up
+        self.latencies = array.array('d')
+        self.connect_times = []
+        self.connect_failures = 0
+        self.sent = 0
+        self.expected = 0
+        self.delivered = 0
+        self.disconnects = 0
+        self.closes = 0             # CLOSE frames received
+        self.reconnects = 0
+        self.reconnect_times = []   # seconds from losing a connection to being back
+        self.tls_handshakes = 0
+        self.tls_resumed = 0
+        self.unsent = 0             # sends due while reconnecting
+
+
+class LoadClient:
+    def __init__(self, index, room, recorder, compress=False, tls_context=None, resume=True):
+        self.index = index
+        self.nickname = f"lg{index}"
+        self.room = room
+        self.recorder = recorder
+        self.compress = compress
+        self.tls_context = tls_context
+        self.resume = resume
+        self.tls_session = None
+        self.frames = protocol.FrameReader()
+        self.reader = None
+        self.writer = None
+        self.connected = False
+        self.closing = False
+
+    async def connect(self, host, port, timeout):
+        started = time.perf_counter()
+        self.frames = protocol.FrameReader()
+        context = None
+        if self.tls_context is not None:
+            context = tls.Resuming(self.tls_context, self.tls_session if self.resume else None)
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=context,
+                                    server_hostname=host if context else None), timeout)
+        frame_type, payload = await asyncio.wait_for(
+            protocol.read_frame(self.reader, self.frames), timeout)
+        if frame_type != protocol.NICK:
+            raise RuntimeError("unexpected greeting")
+        ssl_object = self.writer.get_extra_info('ssl_object')
+        if ssl_object is not None:
+            self.tls_session = ssl_object.session
+            self.recorder.tls_handshakes += 1
+            self.recorder.tls_resumed += ssl_object.session_reused
+        features = protocol.parse_features(payload) & {protocol.DEFLATE} if self.compress else ()
+        self.writer.write(protocol.encode_nick(self.nickname, sorted(features)))
+        if self.room:
+            self.writer.write(protocol.encode(protocol.CHAT, f"/join {self.room}"))
+        await self.writer.drain()
+        self.connected = True
+        return time.perf_counter() - started
+
+    async def read_loop(self, host, port, timeout, reconnect):
+        recorder = self.recorder
+        while True:
+            try:
+                while True:
+                    frames = await protocol.read_frames(self.reader, self.frames)
+                    now = time.perf_counter_ns()
+                    for frame_type, payload in frames:
+                        if frame_type == protocol.CHAT:
+                            self.on_chat(payload, now)
+                        elif frame_type == protocol.PING:
+                            self.writer.write(protocol.encode(protocol.PONG, payload))
+                        elif frame_type == protocol.CLOSE:
+                            recorder.closes += 1
+            except (OSError, protocol.ProtocolError):
+                pass
+            self.connected = False
+            self.writer.close()
+            if self.closing:
+                return
+            if not reconnect or not await self.reconnect(host, port, timeout):
+                recorder.disconnects += 1
+                return
+
+    async def reconnect(self, host, port, timeout, attempts=10):
+        lost = time.perf_counter()
+        delay = 0.05
+        for _ in range(attempts):
+            if self.closing:
+                return False
+            try:
+                await self.connect(host, port, timeout)
+            except (OSError, RuntimeError, asyncio.TimeoutError, protocol.ProtocolError):
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 2.0)
+                continue
+            self.recorder.reconnects += 1
+            self.recorder.reconnect_times.append(time.perf_counter() - lost)
+            return True
+        return False
+
+    def on_chat(self, payload, now):
+        # "lg12: ~lg <sender> <sequence> <sent ns> <padding>"
+        start = payload.find(MARKER)
+        if start < 0:
+            return
+        fields = payload[start + len(MARKER):].split(b' ', 3)
+        sent_at = int(fields[2])
+        if self.recorder.measure_from is not None and sent_at >= self.recorder.measure_from:
+            self.recorder.delivered += 1
+            self.recorder.latencies.append((now - sent_at) / 1e6)
+
+    async def send_loop(self, rate, size, stop_at, rng, audience):
+        """Send one message every 1/rate seconds until stop_at. The first
+        send is offset randomly so senders do not fire in lockstep."""
+        recorder = self.recorder
+        interval = 1.0 / rate
+        due = time.perf_counter() + rng.random() * interval
+        sequence = 0
+        try:
+            while due < stop_at:
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                sent_at = int(due * 1e9)    # same clock as perf_counter_ns()
+                if not self.connected:
+                    recorder.unsent += 1
+                    due += interval
+                    continue
+                head = b'%s%d %d %d ' % (MARKER, self.index, sequence, sent_at)
+                self.writer.write(protocol.encode(
+                    protocol.CHAT, head + b'x' * max(0, size - len(head))))
+                try:
+                    await self.writer.drain()
+                except ConnectionError:
+                    # The reader notices too and reconnects if it may
+                    pass
+                if recorder.measure_from is not None and sent_at >= recorder.measure_from:
+                    recorder.sent += 1
+                    recorder.expected += audience
+                sequence += 1
+                due += interval
+        except (OSError, ConnectionError):
+            pass
+
+    def close(self):
+        self.closing = True
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def connect_all(clients, host, port, concurrency, timeout):
+    """Connect everyone, at most `concurrency` handshakes in flight"""
+    gate = asyncio.Semaphore(concurrency)
+
+    async def connect(client):
+        async with gate:
+            try:
+                client.recorder.connect_times.append(await client.connect(host, port, timeout))
+                return True
+            except (OSError, RuntimeError, asyncio.TimeoutError, protocol.ProtocolError):
+                client.recorder.connect_failures += 1
+                client.close()
+                return False
+
+    results = await asyncio.gather(*(connect(c) for c in clients))
+    return [c for c, ok in zip(clients, results) if ok]
+
+
+async def run_load(args, recorder, proc=None):
+    tls_context = tls.client_context(args.tls_ca) if args.tls_ca else None
+    if args.spawn:
+        probe = await wait_for_port(args.port, ssl=tls_context)
+        probe.writer.close()
+    rng = random.Random(args.seed)
+    rooms = [f"load{i}" for i in range(args.rooms)] if args.rooms > 1 else [None]
+    clients = [LoadClient(i, rooms[i % len(rooms)], recorder, args.compress, tls_context,
+                          not args.no_resume)
+               for i in range(args.clients)]
+
+    started = time.perf_counter()
+    connected = await connect_all(clients, args.host, args.port,
+                                  args.connect_concurrency, args.timeout)
+    connect_elapsed = time.perf_counter() - started
+    readers = [asyncio.ensure_future(c.read_loop(args.host, args.port, args.timeout,
+                                                 args.reconnect))
+               for c in connected]
+    # Let join notices and room moves settle
+    await asyncio.sleep(args.settle)
+
+    members = {}
+    for c in connected:
+        members[c.room] = members.get(c.room, 0) + 1
+    senders = connected[:args.senders]
+
+    begin = time.perf_counter()
+    recorder.measure_from = time.perf_counter_ns() + int(args.warmup * 1e9)
+    stop_at = begin + args.warmup + args.duration
+    if args.signal_after is not None and proc is not None:
+        asyncio.get_running_loop().call_later(
+            args.warmup + args.signal_after, proc.send_signal,
+            getattr(signal, f"SIG{args.signal}"))
+    await asyncio.gather(*(s.send_loop(args.rate, args.size, stop_at, rng, members[s.room])
+                           for s in senders))
+    await asyncio.sleep(args.drain)
+
+    for c in connected:
+        c.close()
+    for task in readers:
+        task.cancel()
+    return len(connected), connect_elapsed
+
+
+def stop_spawned(proc, pid_file):
+    try:
+        with open(pid_file) as f:
+            pid = int(f.read())
+    except (OSError, ValueError):
+        pid = proc.pid
+    if pid != proc.pid:
+        os.kill(pid, signal.SIGKILL)
+    proc.kill()
+    proc.wait()
+    if os.path.exists(pid_file):
+        os.unlink(pid_file)
+    os.rmdir(os.path.dirname(pid_file))
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+                              timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def build_report(args, recorder, connected, connect_elapsed):
+    latencies = sorted(recorder.latencies)
+    connect_times = sorted(recorder.connect_times)
+    reconnect_times = sorted(recorder.reconnect_times)
+    return {
+        'settings': vars(args),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'revision': git_revision(),
+        },
+        'connections': {
+            'requested': args.clients,
+            'connected': connected,
+            'failed': recorder.connect_failures,
+            'dropped_during_run': recorder.disconnects,
+            'connect_seconds': round(connect_elapsed, 3),
+            'handshake_p50_ms': round(percentile(connect_times, 0.50) * 1000, 2),
+            'handshake_p99_ms': round(percentile(connect_times, 0.99) * 1000, 2),
+            'close_frames': recorder.closes,
+            'reconnects': recorder.reconnects,
+            'reconnect_p50_ms': round(percentile(reconnect_times, 0.50) * 1000, 2),
+            'reconnect_max_ms': round(reconnect_times[-1] * 1000, 2) if reconnect_times else None,
+            'tls_handshakes': recorder.tls_handshakes,
+            'tls_resumed': recorder.tls_resumed,
+        },
+        'throughput': {
+            'sent': recorder.sent,
+            'unsent_while_reconnecting': recorder.unsent,
+            'expected_deliveries': recorder.expected,
+            'delivered': recorder.delivered,
+            'delivery_ratio': round(recorder.delivered / recorder.expected, 4)
+            if recorder.expected else None,
+            'sent_per_sec': round(recorder.sent / args.duration, 1),
+            'delivered_per_sec': round(recorder.delivered / args.duration, 1),
+        },
+        'latency_ms': {
+            'samples': len(latencies),
+            'mean': round(sum(latencies) / len(latencies), 3) if latencies else None,
+            'p50': round(percentile(latencies, 0.50), 3),
+            'p90': round(percentile(latencies, 0.90), 3),
+            'p99': round(percentile(latencies, 0.99), 3),
+            'p999': round(percentile(latencies, 0.999), 3),
+            'max': round(latencies[-1], 3) if latencies else None,
+        },
+    }
+
+
+def print_report(report):
+    connections = report['connections']
+    throughput = report['throughput']
+    latency = report['latency_ms']
+    print(f"connected   {connections['connected']}/{connections['requested']} in "
+          f"{connections['connect_seconds']}s (handshake p50 {connections['handshake_p50_ms']} ms, "
+          f"p99 {connections['handshake_p99_ms']} ms), {connections['failed']} failed, "
+          f"{connections['dropped_during_run']} dropped during the run")
+    if connections['close_frames'] or connections['reconnects']:
+        print(f"reconnects  {connections['reconnects']} after {connections['close_frames']} "
+              f"CLOSE frames (p50 {connections['reconnect_p50_ms']} ms, "
+              f"max {connections['reconnect_max_ms']} ms), "
+              f"{throughput['unsent_while_reconnecting']} sends skipped")
+    if connections['tls_handshakes']:
+        print(f"tls         {connections['tls_handshakes']} handshakes, "
+              f"{connections['tls_resumed']} resumed a session")
+    print(f"sent        {throughput['sent']} ({throughput['sent_per_sec']}/s)")
+    print(f"delivered   {throughput['delivered']} of {throughput['expected_deliveries']} "
+          f"expected ({throughput['delivered_per_sec']}/s, ratio {throughput['delivery_ratio']})")
+    print(f"latency ms  p50 {latency['p50']}  p90 {latency['p90']}  p99 {latency['p99']}  "
+          f"p99.9 {latency['p999']}  max {latency['max']}  ({latency['samples']} samples)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless chat load generator")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--spawn', choices=('threaded', 'asyncio'),
+                        help="start a local server with this engine on --port for the run")
+    parser.add_argument('--server-args', default='',
+                        help="extra command line for the spawned server")
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--senders', type=int, default=50,
+                        help="how many of the clients send messages")
+    parser.add_argument('--rate', type=float, default=1.0, help="messages per second per sender")
+    parser.add_argument('--size', type=int, default=100, help="message text bytes")
+    parser.add_argument('--rooms', type=int, default=1, help="spread clients over this many rooms")
+    parser.add_argument('--compress', action='store_true',
+                        help="ask for compression if the server offers it")
+    parser.add_argument('--duration', type=float, default=30.0, help="measured seconds")
+    parser.add_argument('--warmup', type=float, default=2.0,
+                        help="seconds of sending before measurement starts")
+    parser.add_argument('--settle', type=float, default=1.0,
+                        help="pause between connecting and sending")
+    parser.add_argument('--drain', type=float, default=2.0,
+                        help="seconds to wait for in-flight messages after sending stops")
+    parser.add_argument('--tls-ca', help="connect over TLS, trusting this CA certificate")
+    parser.add_argument('--no-resume', action='store_true',
+                        help="with --tls-ca: full handshake on every reconnect")
+    parser.add_argument('--connect-concurrency', type=int, default=200)
+    parser.add_argument('--timeout', type=float, default=30.0, help="connect/handshake timeout")
+    parser.add_argument('--reconnect', action='store_true',
+                        help="reconnect clients whose connection ends during the run")
+    parser.add_argument('--signal-after', type=float,
+                        help="send --signal to the spawned server this many seconds into "
+                             "the measured run")
+    parser.add_argument('--signal', choices=('HUP', 'TERM', 'INT'), default='HUP',
+                        help="HUP = hot restart, TERM/INT = graceful shutdown")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--report', help="write the report as JSON to this file")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    proc = None
+    pid_file = None
+    if args.spawn:
+        # After a hot restart the server that is running is no longer our
+        # child; the pid file says which process to stop at the end
+        pid_file = os.path.join(tempfile.mkdtemp(prefix='loadgen-'), 'server.pid')
+        proc = start_server(args.spawn, args.port,
+                            ['--pid-file', pid_file, *shlex.split(args.server_args)])
+    recorder = Recorder()
+    try:
+        connected, connect_elapsed = asyncio.run(run_load(args, recorder, proc))
+    finally:
+        if proc is not None:
+            stop_spawned(proc, pid_file)
+
+    report = build_report(args, recorder, connected, connect_elapsed)
+    print_report(report)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"Report written to {args.report}")
+    return 0 if connected else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
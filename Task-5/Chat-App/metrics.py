@@ -0,0 +1,206 @@
+"""
+Server metrics
+==============
+
+Counters and histograms cheap enough to leave on in production, exposed
+over HTTP in the Prometheus text format (`--metrics-port`, path /metrics).
+
+Updates never take a lock: every thread increments its own shard (a
+plain list reached through threading.local) and a scrape adds the shards
+up. When a thread ends its shard is folded into a retired total, so
+thread churn in the threaded engine does not make scrapes slower.
+"""
+
+import threading
+import weakref
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+
+class _ShardOwner:
+    """Lives in the thread-local; its finalizer runs when the thread ends"""
+
+    __slots__ = ('values', '__weakref__')
+
+    def __init__(self, values):
+        self.values = values
+
+
+class Counter:
+    __slots__ = ('metrics', 'index')
+
+    def __init__(self, metrics, index):
+        self.metrics = metrics
+        self.index = index
+
+    def inc(self, amount=1):
+        self.metrics.shard()[self.index] += amount
+
+    def value(self):
+        return self.metrics.total(self.index)
+
+
+class Histogram:
+    """Cumulative-bucket histogram; occupies len(buckets) + 2 shard slots
+    (one per bucket, then +Inf, then the sum)"""
+
+    __slots__ = ('metrics', 'index', 'buckets')
+
+    def __init__(self, metrics, index, buckets):
+        self.metrics = metrics
+        self.index = index
+        self.buckets = buckets
+
+    def observe(self, value):
+        shard = self.metrics.shard()
+        slot = self.index
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            slot += 1
+        shard[slot] += 1
+        shard[self.index + len(self.buckets) + 1] += value
+
+
+class Metrics:
+    def __init__(self):
+        self.families = []        # (kind, name, help, metric or callback)
+        self.size = 0             # shard slots in use
+        self.local = threading.local()
+        # Reentrant: a finalizer may run while this thread holds it
+        self.lock = threading.RLock()
+        self.shards = {}          # id -> values list of a live thread
+        self.retired = []
+        self.httpd = None
+
+    # ----------------- Definition -----------------
+    def _allocate(self, slots):
+        with self.lock:
+            index = self.size
+            self.size += slots
+            self.retired.extend([0] * slots)
+            return index
+
+    def counter(self, name, help):
+        counter = Counter(self, self._allocate(1))
+        self.families.append(('counter', name, help, counter))
+        return counter
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        histogram = Histogram(self, self._allocate(len(buckets) + 2), tuple(buckets))
+        self.families.append(('histogram', name, help, histogram))
+        return histogram
+
+    def gauge(self, name, help, callback, label='nickname'):
+        """callback() returns a number, or a dict of {label value: number}
+        for a labelled family"""
+        self.families.append(('gauge', name, help, (callback, label)))
+
+    # ----------------- Per-thread Shards -----------------
+    def shard(self):
+        try:
+            values = self.local.owner.values
+        except AttributeError:
+            values = self._new_shard()
+        if len(values) < self.size:
+            values.extend([0] * (self.size - len(values)))
+        return values
+
+    def _new_shard(self):
+        values = [0] * self.size
+        owner = _ShardOwner(values)
+        with self.lock:
+            self.shards[id(owner)] = values
+        weakref.finalize(owner, self._retire, id(owner))
+        self.local.owner = owner
+        return values
+
+    def _retire(self, key):
+        with self.lock:
+            values = self.shards.pop(key, None)
+            if values is not None:
+                for i, value in enumerate(values):
+                    self.retired[i] += value
+
+    def totals(self):
+        with self.lock:
+            totals = list(self.retired)
+            for values in list(self.shards.values()):
+                for i, value in enumerate(values):
+                    totals[i] += value
+        return totals
+
+    def total(self, index):
+        return self.totals()[index]
+
+    # ----------------- Exposition -----------------
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        totals = self.totals()
+        lines = []
+        for kind, name, help, metric in self.families:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'counter':
+                lines.append(f"{name} {_number(totals[metric.index])}")
+            elif kind == 'histogram':
+                cumulative = 0
+                for offset, bound in enumerate(metric.buckets):
+                    cumulative += totals[metric.index + offset]
+                    lines.append(f'{name}_bucket{{le="{bound}"}} {_number(cumulative)}')
+                cumulative += totals[metric.index + len(metric.buckets)]
+                lines.append(f'{name}_bucket{{le="+Inf"}} {_number(cumulative)}')
+                lines.append(f"{name}_sum {totals[metric.index + len(metric.buckets) + 1]}")
+                lines.append(f"{name}_count {_number(cumulative)}")
+            else:
+                callback, label = metric
+                value = callback()
+                if isinstance(value, dict):
+                    for label_value, number in value.items():
+                        lines.append(f'{name}{{{label}="{_escape(label_value)}"}} '
+                                     f'{_number(number)}')
+                else:
+                    lines.append(f"{name} {_number(value)}")
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, host, port):
+        """Serve /metrics from a daemon thread"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        httpd = ThreadingHTTPServer((host, port), Handler)
+        httpd.daemon_threads = True
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        print(f"Metrics on http://{host}:{port}/metrics")
+        self.httpd = httpd
+        return httpd
+
+    def stop(self):
+        """Stop serving /metrics and free the port"""
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+
+def _number(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _escape(label):
+    return str(label).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
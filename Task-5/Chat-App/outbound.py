@@ -0,0 +1,211 @@
+"""
+Per-client outbound queues
+==========================
+
+broadcast() never writes to a socket itself. It encodes a frame once and
+puts the same bytes object on every recipient's bounded queue; the I/O
+layer of each engine drains the queue and writes whole batches at once.
+A slow reader therefore only fills its own queue, and what happens when
+that queue is full is decided by the slow-consumer policy:
+
+    drop-oldest  discard the oldest queued frame to make room
+    disconnect   close the lagging client
+    block        make the sender wait until the queue has room
+
+Frames the server sends on its own behalf (heartbeat PINGs) go in with
+put_nowait(), which never waits or drops whatever the policy and fails
+on a full queue instead: the caller must not be stalled by the very
+client it is checking on.
+
+Bulk data such as file chunks goes in with put_paced() instead, which
+never drops and always makes the sender wait while more than a small
+window of frames is queued. A transfer then runs at the recipient's pace
+and a chat message never queues behind more than that window of chunks.
+"""
+
+import asyncio
+import collections
+import threading
+
+DROP_OLDEST = 'drop-oldest'
+DISCONNECT = 'disconnect'
+BLOCK = 'block'
+POLICIES = (DROP_OLDEST, DISCONNECT, BLOCK)
+
+DEFAULT_QUEUE_SIZE = 1024
+
+
+class OutboundQueue:
+    """Thread-safe bounded frame queue, drained by one writer thread"""
+
+    # Under the block policy put() itself waits for room, so a threaded
+    # sender never has to wait on a congested queue afterwards
+    congested = False
+
+    def __init__(self, maxsize=DEFAULT_QUEUE_SIZE, policy=DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown slow-consumer policy: {policy}")
+        self.frames = collections.deque()
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    @property
+    def depth(self):
+        return len(self.frames)
+
+    def put(self, frame):
+        """Queue one encoded frame. Returns False if the client is gone or
+        has just been cut off by the disconnect policy."""
+        with self.cond:
+            if self.closed:
+                return False
+            if len(self.frames) >= self.maxsize:
+                if self.policy == DROP_OLDEST:
+                    self.frames.popleft()
+                    self.dropped += 1
+                elif self.policy == DISCONNECT:
+                    self.closed = True
+                    self.cond.notify_all()
+                    return False
+                else:
+                    while len(self.frames) >= self.maxsize and not self.closed:
+                        self.cond.wait()
+                    if self.closed:
+                        return False
+            self.frames.append(frame)
+            self.cond.notify_all()
+            return True
+
+    def put_nowait(self, frame):
+        """Queue one frame if there is room. Returns False if the queue is
+        full or closed."""
+        with self.cond:
+            if self.closed or len(self.frames) >= self.maxsize:
+                return False
+            self.frames.append(frame)
+            self.cond.notify_all()
+            return True
+
+    def put_paced(self, frame, window):
+        """Queue bulk data once fewer than window frames are waiting"""
+        with self.cond:
+            while len(self.frames) >= window and not self.closed:
+                self.cond.wait()
+            if self.closed:
+                return False
+            self.frames.append(frame)
+            self.cond.notify_all()
+            return True
+
+    def get_batch(self):
+        """Block until frames are queued and take all of them.
+        Returns None once the queue is closed and empty."""
+        with self.cond:
+            while not self.frames and not self.closed:
+                self.cond.wait()
+            if not self.frames:
+                return None
+            batch = list(self.frames)
+            self.frames.clear()
+            self.cond.notify_all()
+            return batch
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class AsyncOutboundQueue:
+    """Loop-confined bounded frame queue, drained by one writer task.
+
+    A coroutine cannot block inside broadcast(), so under the block policy
+    put() lets the queue run over its limit and reports it as congested;
+    the sender then awaits wait_for_space() before reading more input.
+    """
+
+    def __init__(self, maxsize=DEFAULT_QUEUE_SIZE, policy=DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown slow-consumer policy: {policy}")
+        self.frames = collections.deque()
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self.closed = False
+        # Set by put_paced() until the writer takes the batch
+        self.window = 0
+        self.ready = asyncio.Event()
+        self.space = asyncio.Event()
+        self.space.set()
+
+    @property
+    def depth(self):
+        return len(self.frames)
+
+    @property
+    def congested(self):
+        if self.closed:
+            return False
+        if self.window and len(self.frames) >= self.window:
+            return True
+        return self.policy == BLOCK and len(self.frames) >= self.maxsize
+
+    def put(self, frame):
+        if self.closed:
+            return False
+        if len(self.frames) >= self.maxsize:
+            if self.policy == DROP_OLDEST:
+                self.frames.popleft()
+                self.dropped += 1
+            elif self.policy == DISCONNECT:
+                self.close()
+                return False
+            else:
+                self.space.clear()
+        self.frames.append(frame)
+        self.ready.set()
+        return True
+
+    def put_nowait(self, frame):
+        if self.closed or len(self.frames) >= self.maxsize:
+            return False
+        self.frames.append(frame)
+        self.ready.set()
+        return True
+
+    def put_paced(self, frame, window):
+        """Queue bulk data; the sender awaits wait_for_space() while window
+        or more frames are waiting"""
+        if self.closed:
+            return False
+        self.frames.append(frame)
+        self.window = window
+        if len(self.frames) >= window:
+            self.space.clear()
+        self.ready.set()
+        return True
+
+    async def get_batch(self):
+        while not self.frames and not self.closed:
+            self.ready.clear()
+            await self.ready.wait()
+        if not self.frames:
+            return None
+        batch = list(self.frames)
+        self.frames.clear()
+        self.window = 0
+        self.space.set()
+        return batch
+
+    async def wait_for_space(self):
+        while self.congested:
+            self.space.clear()
+            await self.space.wait()
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+        self.space.set()
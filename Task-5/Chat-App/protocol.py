@@ -0,0 +1,316 @@
+"""
+Chat wire protocol
+==================
+
+Every message travels as one length-prefixed frame:
+
+    +----------------+-----------+------------------+
+    | length (4 B)   | type (1B) | payload          |
+    | big-endian u32 |           | (length bytes)   |
+    +----------------+-----------+------------------+
+
+A single recv() may return several frames or only part of one, so both
+ends run incoming bytes through a FrameReader that buffers partial data
+and hands back whole frames.
+
+Compression is negotiated in the NICK handshake: the server's NICK frame
+lists the features it supports ("deflate") and the client answers with
+its nickname followed by the features it wants, one per line. A plain
+nickname still works and means no features.
+
+A compressed frame has the high bit of its type set and a raw deflate
+payload. Every frame is compressed on its own against a fixed preset
+dictionary instead of a per-connection stream, so the server compresses
+a broadcast once and sends the same bytes to every recipient. Small
+frames and frames that do not shrink are always sent uncompressed.
+
+File transfers are the "files" feature. The sender announces a file to
+one nickname with a FILE frame "offer <id> <size> <nickname> <name>".
+The recipient sees "offer <id> <size> <sender> <name>" under an id the
+server picks and answers "accept <id>" or "reject <id>"; the sender gets
+"accepted <id>", and only then streams the file as FILE_DATA frames (a
+4-byte transfer id, then up to FILE_CHUNK_SIZE bytes of the file),
+finishing with "end <id>". The server answers "done <id>" once the last
+chunk is on its way to the recipient, or "refused <id> <why>" if the
+transfer failed at any point. The recipient sees the chunks and
+"end <id>", or "abort <id> <why>". Either side can give up later on:
+the recipient with "reject <id>", the sender with "cancel <id>".
+"""
+
+import socket
+import struct
+import zlib
+
+# ----------------- Frame Types -----------------
+NICK = 1     # server -> client: offered features, client -> server: nickname + features
+CHAT = 2     # client -> server: message text, server -> client: "nick: text"
+SYSTEM = 3   # server -> client: join/leave notices and other server messages
+HISTORY = 4  # client -> server: "since <offset>" or "before ...", server -> client: next
+             # offset after a replay, or a page of older messages (encode_history_page)
+PING = 5     # either way: are you still there? Answered with a PONG echoing the payload
+PONG = 6
+CLOSE = 7    # server -> client: the server is going away (payload: why); the connection ends next
+FILE = 8     # either way: file transfer control ("offer ...", "end <id>", ...)
+FILE_DATA = 9  # either way: transfer id + the next chunk of the file
+
+FRAME_NAMES = {NICK: 'NICK', CHAT: 'CHAT', SYSTEM: 'SYSTEM', HISTORY: 'HISTORY',
+               PING: 'PING', PONG: 'PONG', CLOSE: 'CLOSE', FILE: 'FILE', FILE_DATA: 'FILE_DATA'}
+
+HEADER = struct.Struct('!IB')
+MAX_FRAME_SIZE = 1024 * 1024
+MAX_NICKNAME = 32
+NICKNAME_RULES = f"Nicknames are 1-{MAX_NICKNAME} characters without spaces or control characters"
+RECV_SIZE = 65536
+# Most frames a single sendmsg() hands to the kernel (the usual IOV_MAX)
+MAX_IOVECS = 1024
+
+# ----------------- File Transfers -----------------
+FILES = 'files'
+FILE_ID = struct.Struct('!I')
+FILE_CHUNK_SIZE = 64 * 1024
+
+# ----------------- Compression -----------------
+DEFLATE = 'deflate'
+FEATURES = (DEFLATE, FILES)
+COMPRESSED = 0x80          # type flag: payload is raw deflate
+MIN_COMPRESS_SIZE = 96     # smaller payloads rarely shrink enough to pay off
+COMPRESS_LEVEL = 6
+
+# Strings both ends expect to see often. zlib matches against the end of
+# the dictionary most cheaply, so the most common text goes last. Changing
+# this breaks compatibility with existing clients.
+PRESET_DICTIONARY = (
+    b'Traceback (most recent call last):\n  File "", line , in \n'
+    b'Error: Exception: WARNING INFO DEBUG ERROR None True False self return '
+    b'def import from class https://www. http://.com/ .org .py .html '
+    b'[DM to ] [DM] Rooms: #lobby () Unknown command /join /leave /msg /rooms /help '
+    b'Connected to the server! You are in #lobby. Commands: '
+    b'because about would could should there their which people think '
+    b'what when where with this that have just like know really yeah okay '
+    b'thanks please sorry hello everyone anyone the and for you are not '
+    b' left the chat! joined the chat! left # joined # '
+)
+
+_compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS,
+                               zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY,
+                               PRESET_DICTIONARY)
+
+
+class ProtocolError(Exception):
+    """Raised when the peer sends bytes that are not a valid frame"""
+
+
+def encode(frame_type, payload=b''):
+    """Build the bytes for one frame. Text payloads are sent as UTF-8."""
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"frame of {len(payload)} bytes exceeds {MAX_FRAME_SIZE}")
+    return HEADER.pack(len(payload), frame_type) + payload
+
+
+def compress(frame):
+    """Compressed copy of an encoded frame, or the frame itself when
+    compressing would not make it smaller"""
+    length, frame_type = HEADER.unpack_from(frame)
+    # Several frames joined together (a history replay) are left alone
+    if length < MIN_COMPRESS_SIZE or frame_type & COMPRESSED or len(frame) != HEADER.size + length:
+        return frame
+    # Copying a primed compressor skips loading the dictionary every time
+    compressor = _compressor.copy()
+    payload = compressor.compress(memoryview(frame)[HEADER.size:]) + compressor.flush()
+    if len(payload) >= length:
+        return frame
+    return HEADER.pack(len(payload), frame_type | COMPRESSED) + payload
+
+
+def file_chunk_header(transfer_id, length):
+    """The bytes that go before `length` bytes of file data in a FILE_DATA
+    frame, so the data itself can be sent with sendfile()"""
+    return HEADER.pack(FILE_ID.size + length, FILE_DATA) + FILE_ID.pack(transfer_id)
+
+
+def encode_file_chunk(transfer_id, data):
+    """One whole FILE_DATA frame"""
+    return b''.join([file_chunk_header(transfer_id, len(data)), data])
+
+
+def decompress(payload, max_size=MAX_FRAME_SIZE):
+    """Inflate a compressed payload, refusing to grow past max_size"""
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=PRESET_DICTIONARY)
+    try:
+        data = decompressor.decompress(payload, max_size)
+    except zlib.error as e:
+        raise ProtocolError(f"bad compressed frame: {e}") from None
+    if decompressor.unconsumed_tail:
+        raise ProtocolError(f"compressed frame inflates past {max_size} bytes")
+    return data
+
+
+def encode_nick(nickname, features=()):
+    """Client NICK reply: the nickname, then one requested feature per line"""
+    return encode(NICK, '\n'.join([nickname, *features]))
+
+
+def parse_nick(payload):
+    """Split a NICK reply into (nickname, set of requested features)"""
+    nickname, *features = payload.decode('utf-8', 'replace').split('\n')
+    return nickname, set(features) & set(FEATURES)
+
+
+def is_direct_message(text):
+    """Whether a CHAT text is a direct message ("[DM] nick: text" or
+    "[DM to nick] text") rather than "nick: text" from a room, which can
+    never start like that because nicknames hold no spaces"""
+    return text.startswith(('[DM] ', '[DM to '))
+
+
+def valid_nickname(nickname):
+    """Whether nickname can be used: /msg and file offers split on spaces"""
+    return 0 < len(nickname) <= MAX_NICKNAME and all(
+        c.isprintable() and not c.isspace() for c in nickname)
+
+
+def parse_features(payload):
+    """Features the server offered in its NICK frame"""
+    return set(payload.decode('utf-8', 'replace').split()) & set(FEATURES)
+
+
+def encode_history_page(offset, frames):
+    """HISTORY reply to a "before" request: the offset to page back from
+    next, a newline, then the page's frames oldest first (none once the
+    start of the log is reached)"""
+    return encode(HISTORY, b'before %d\n' % offset + b''.join(frames))
+
+
+def parse_history_page(payload):
+    """(offset, frames) from encode_history_page(), or None for the reply
+    to a "since" request"""
+    header, newline, rest = payload.partition(b'\n')
+    command, _, offset = header.partition(b' ')
+    if command != b'before' or not newline or not offset.isdigit():
+        return None
+    return int(offset), FrameReader().feed(rest)
+
+
+class FrameReader:
+    """Reassembles frames from an arbitrary chunked byte stream and
+    inflates compressed frames, so callers only ever see plain payloads"""
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+        # recv_into() target, allocated on first use and reused after that
+        self.scratch = None
+        self.view = None
+
+    def feed(self, data):
+        """Add received bytes and return every frame that is now complete"""
+        self.buffer += data
+        frames = []
+        frame = self.next_frame()
+        while frame is not None:
+            frames.append(frame)
+            frame = self.next_frame()
+        return frames
+
+    def next_frame(self):
+        """Pop one complete (type, payload) frame, or None if more bytes are needed"""
+        if len(self.buffer) < HEADER.size:
+            return None
+        length, frame_type = HEADER.unpack_from(self.buffer)
+        if length > self.max_frame_size:
+            raise ProtocolError(f"frame of {length} bytes exceeds {self.max_frame_size}")
+        end = HEADER.size + length
+        if len(self.buffer) < end:
+            return None
+        # One copy out of the buffer rather than a slice and then bytes()
+        with memoryview(self.buffer) as view:
+            payload = bytes(view[HEADER.size:end])
+        # Deleting from the front of a bytearray is cheap in CPython
+        del self.buffer[:end]
+        if frame_type & COMPRESSED:
+            return frame_type & ~COMPRESSED, decompress(payload, self.max_frame_size)
+        return frame_type, payload
+
+    def recv_from(self, sock, bufsize=RECV_SIZE):
+        """recv_into() the reusable scratch buffer and append what arrived,
+        so reading allocates no new bytes object per call"""
+        if self.scratch is None or len(self.scratch) != bufsize:
+            self.scratch = bytearray(bufsize)
+            self.view = memoryview(self.scratch)
+        n = sock.recv_into(self.scratch)
+        if not n:
+            raise ConnectionError("connection closed by peer")
+        self.buffer += self.view[:n]
+        return n
+
+
+# ----------------- Blocking Socket Helpers -----------------
+def recv_frame(sock, reader, bufsize=RECV_SIZE):
+    """Block until one whole frame is available on a plain socket"""
+    frame = reader.next_frame()
+    while frame is None:
+        reader.recv_from(sock, bufsize)
+        frame = reader.next_frame()
+    return frame
+
+
+def recv_frames(sock, reader, bufsize=RECV_SIZE):
+    """Block for the next recv() and return all frames it completed"""
+    reader.recv_from(sock, bufsize)
+    return reader.feed(b'')
+
+
+def send_frames(sock, frames):
+    """Write a batch of encoded frames with as few syscalls as possible:
+    sendmsg() hands the kernel up to MAX_IOVECS frames at once without
+    joining them into one buffer first. Returns the number of send calls."""
+    calls = 0
+    frames = list(frames)
+    while frames:
+        chunk = frames[:MAX_IOVECS]
+        sent = sock.sendmsg(chunk)
+        calls += 1
+        # A partial write ends inside some frame: drop what went out and
+        # resend the rest of that frame along with the frames after it
+        for i, frame in enumerate(chunk):
+            if sent < len(frame):
+                frames = [memoryview(frame)[sent:], *frames[i + 1:]]
+                break
+            sent -= len(frame)
+        else:
+            frames = frames[len(chunk):]
+    return calls
+
+
+def tune_socket(sock, nodelay=True, sndbuf=0, rcvbuf=0):
+    """Per-connection socket options. A buffer size of 0 keeps the kernel's
+    default (and its autotuning, which an explicit size switches off)."""
+    if sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(nodelay))
+    if sndbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+    if rcvbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+
+
+# ----------------- asyncio Stream Helpers -----------------
+async def read_frame(stream, reader, bufsize=RECV_SIZE):
+    """Await one whole frame from an asyncio StreamReader"""
+    frame = reader.next_frame()
+    while frame is None:
+        data = await stream.read(bufsize)
+        if not data:
+            raise ConnectionError("connection closed by peer")
+        reader.buffer += data
+        frame = reader.next_frame()
+    return frame
+
+
+async def read_frames(stream, reader, bufsize=RECV_SIZE):
+    """Await the next read and return all frames it completed"""
+    data = await stream.read(bufsize)
+    if not data:
+        raise ConnectionError("connection closed by peer")
+    return reader.feed(data)
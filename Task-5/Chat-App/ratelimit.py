@@ -0,0 +1,131 @@
+"""
+Flood control
+=============
+
+Every connection gets two token buckets, one counting messages and one
+counting bytes. A bucket holds up to `burst` tokens and refills at `rate`
+tokens per second; a frame is let through only if both buckets can pay
+for it.
+
+Buckets are refilled lazily from the time of the previous check, so a
+check is a few arithmetic operations and no timer or thread is needed,
+however many clients are connected.
+
+What happens to a client that goes over its limit is the penalty:
+
+    drop        the frame is discarded, later frames pass again as soon
+                as the buckets refill
+    mute        the frame is discarded and so is everything else the
+                client sends for the next mute_seconds
+    disconnect  the connection is closed
+"""
+
+import time
+
+DROP = 'drop'
+MUTE = 'mute'
+DISCONNECT = 'disconnect'
+PENALTIES = (DROP, MUTE, DISCONNECT)
+
+DEFAULT_MESSAGE_RATE = 10.0
+DEFAULT_MESSAGE_BURST = 20
+DEFAULT_BYTE_RATE = 64 * 1024
+DEFAULT_BYTE_BURST = 256 * 1024
+DEFAULT_MUTE_SECONDS = 10.0
+
+# check() results
+ALLOW = 0
+THROTTLED = 1
+KICK = 2
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def can_take(self, amount, now):
+        """Refill for the time that passed and say whether amount tokens
+        are available. A single cost larger than the whole bucket is let
+        through when the bucket is full and leaves it in debt, so oversized
+        frames are slowed down rather than refused forever."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens >= min(amount, self.burst)
+
+    def take(self, amount):
+        self.tokens -= amount
+
+
+class ClientLimits:
+    """Flood-control state of one connection"""
+
+    __slots__ = ('messages', 'bytes', 'muted_until', 'warned')
+
+    def __init__(self, messages, byte_bucket):
+        self.messages = messages
+        self.bytes = byte_bucket
+        self.muted_until = 0.0
+        # Only the first throttled frame of a burst is answered with a warning
+        self.warned = False
+
+
+class FloodControl:
+    """Rate limits shared by all connections. A rate of 0 turns that
+    bucket off; with both off every frame is allowed."""
+
+    def __init__(self, message_rate=DEFAULT_MESSAGE_RATE, message_burst=DEFAULT_MESSAGE_BURST,
+                 byte_rate=DEFAULT_BYTE_RATE, byte_burst=DEFAULT_BYTE_BURST,
+                 penalty=DROP, mute_seconds=DEFAULT_MUTE_SECONDS):
+        if penalty not in PENALTIES:
+            raise ValueError(f"unknown flood penalty: {penalty}")
+        self.message_rate = message_rate
+        self.message_burst = max(message_burst, 1)
+        self.byte_rate = byte_rate
+        self.byte_burst = max(byte_burst, 1)
+        self.penalty = penalty
+        self.mute_seconds = mute_seconds
+
+    @property
+    def enabled(self):
+        return self.message_rate > 0 or self.byte_rate > 0
+
+    def new_client(self):
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        return ClientLimits(
+            TokenBucket(self.message_rate, self.message_burst, now) if self.message_rate > 0 else None,
+            TokenBucket(self.byte_rate, self.byte_burst, now) if self.byte_rate > 0 else None)
+
+    def check(self, limits, size):
+        """ALLOW, THROTTLED or KICK for one frame of size bytes"""
+        if limits is None:
+            return ALLOW
+        now = time.monotonic()
+        if now < limits.muted_until:
+            return THROTTLED
+        # Both buckets are checked before either is charged, so a dropped
+        # frame costs the client nothing
+        messages, byte_bucket = limits.messages, limits.bytes
+        if (messages is None or messages.can_take(1, now)) and \
+                (byte_bucket is None or byte_bucket.can_take(size, now)):
+            if messages is not None:
+                messages.take(1)
+            if byte_bucket is not None:
+                byte_bucket.take(size)
+            limits.warned = False
+            return ALLOW
+        if self.penalty == DISCONNECT:
+            # Frames already read behind this one are dropped quietly
+            # while the connection closes
+            limits.muted_until = float('inf')
+            limits.warned = True
+            return KICK
+        if self.penalty == MUTE:
+            limits.muted_until = now + self.mute_seconds
+        return THROTTLED
@@ -0,0 +1,145 @@
+"""
+Client registry
+===============
+
+One place that knows who is connected. Connections are keyed by their
+socket (threaded engine) or stream writer (asyncio engine) and indexed by
+nickname and by room, so join, leave, room moves and lookup are all O(1)
+dict operations instead of scans over parallel lists.
+
+All methods take the registry lock, which keeps it safe for the threaded
+engine; the asyncio engine only uses it from the loop thread, where the
+lock is never contended.
+"""
+
+import threading
+import time
+
+LOBBY = 'lobby'
+
+
+class Client:
+    """One registered connection"""
+
+    __slots__ = ('key', 'nickname', 'queue', 'room', 'compress', 'limits',
+                 'messages_in', 'bytes_in', 'throttled', 'last_seen', 'pinged',
+                 'files', 'uploads', 'downloads')
+
+    def __init__(self, key, nickname, queue, room=LOBBY, compress=False):
+        self.key = key
+        self.nickname = nickname
+        self.queue = queue
+        self.room = room
+        # Negotiated in the handshake: send compressed frames where they help
+        self.compress = compress
+        # Flood-control state, set by the hub (see ratelimit.py)
+        self.limits = None
+        # Only ever updated by the connection's own reader
+        self.messages_in = 0
+        self.bytes_in = 0
+        self.throttled = 0
+        # Heartbeat state: when the last frame arrived, and whether a PING
+        # is waiting for an answer
+        self.last_seen = time.monotonic()
+        self.pinged = False
+        # File transfers (see hub.py): whether the client asked for them,
+        # and the transfers it is sending (by its own id) and receiving
+        # (by the server's id)
+        self.files = False
+        self.uploads = {}
+        self.downloads = {}
+
+
+class ClientRegistry:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.by_key = {}
+        self.by_nickname = {}
+        self.by_room = {}          # room -> {key: Client}
+        self._snapshot = None
+        self._room_snapshots = {}  # room -> tuple of Clients
+
+    def __len__(self):
+        return len(self.by_key)
+
+    def add(self, key, nickname, queue, room=LOBBY, compress=False):
+        """Register a connection. A nickname that is already in use gets a
+        numeric suffix so every nickname maps to exactly one client."""
+        with self.lock:
+            unique = nickname
+            suffix = 2
+            while unique in self.by_nickname:
+                unique = f"{nickname}_{suffix}"
+                suffix += 1
+            client = Client(key, unique, queue, room, compress)
+            self.by_key[key] = client
+            self.by_nickname[unique] = client
+            self.by_room.setdefault(room, {})[key] = client
+            self._snapshot = None
+            self._room_snapshots.pop(room, None)
+            return client
+
+    def remove(self, key):
+        """Unregister a connection. Returns its Client, or None if it was
+        already removed (e.g. by another thread)."""
+        with self.lock:
+            client = self.by_key.pop(key, None)
+            if client is not None:
+                del self.by_nickname[client.nickname]
+                self._leave_room(client)
+                self._snapshot = None
+            return client
+
+    def move(self, client, room):
+        """Put a registered client in another room. Returns the old room."""
+        with self.lock:
+            old = client.room
+            if old != room and client.key in self.by_key:
+                self._leave_room(client)
+                client.room = room
+                self.by_room.setdefault(room, {})[client.key] = client
+                self._room_snapshots.pop(room, None)
+            return old
+
+    def _leave_room(self, client):
+        members = self.by_room.get(client.room)
+        if members is not None:
+            members.pop(client.key, None)
+            if not members:
+                del self.by_room[client.room]
+        self._room_snapshots.pop(client.room, None)
+
+    def get(self, key):
+        return self.by_key.get(key)
+
+    def find(self, nickname):
+        return self.by_nickname.get(nickname)
+
+    def clients(self):
+        """Immutable view of every client for fan-out. It is rebuilt only
+        after a join or leave, so broadcasts do not copy the registry."""
+        with self.lock:
+            if self._snapshot is None:
+                self._snapshot = tuple(self.by_key.values())
+            return self._snapshot
+
+    def members(self, room):
+        """Immutable view of one room, cached the same way as clients()"""
+        with self.lock:
+            snapshot = self._room_snapshots.get(room)
+            if snapshot is None:
+                members = self.by_room.get(room)
+                if members is None:
+                    return ()
+                snapshot = tuple(members.values())
+                self._room_snapshots[room] = snapshot
+            return snapshot
+
+    def rooms(self):
+        """Member count per room"""
+        with self.lock:
+            return {room: len(members) for room, members in self.by_room.items()}
+
+    def queue_depths(self):
+        """Frames waiting to be written, per nickname"""
+        return {client.nickname: client.queue.depth for client in self.clients()}
@@ -1,51 +1,259 @@
-import socket
+"""
+Chat server
+===========
+
+ChatServer runs one chat server on either engine and can be embedded in
+other code; importing this module opens no sockets and starts no
+threads.
+
+    server = ChatServer(port=0, engine='asyncio')
+    host, port = server.serve()      # returns once it is listening
+    ...
+    server.shutdown()                # graceful drain, see lifecycle.py
+
+From the command line serve_forever() runs until SIGTERM/SIGINT (drain
+and exit) or SIGHUP (hot restart):
+
+    python server.py --engine asyncio --port 5000
+
+Every command line option can also come from a CHAT_* environment
+variable named after it, e.g. CHAT_PORT=6000, CHAT_ENGINE=asyncio or
+CHAT_NO_COMPRESSION=1. The command line wins over the environment.
+"""
+
+import argparse
+import os
+import signal
 import threading
 
-host = '0.0.0.0'
-port = 5000
+import chatlog
+import history
+import hub
+import lifecycle
+import outbound
+import protocol
+import ratelimit
+import tls
+
+ENGINES = ('threaded', 'asyncio')
+ENV_PREFIX = 'CHAT_'
+TRUE_WORDS = ('1', 'true', 'yes', 'on')
+SEND_MODES = ('sendmsg', 'join')
+
+
+# ----------------- Configuration -----------------
+def build_parser():
+    parser = argparse.ArgumentParser(description="Chat server")
+    parser.add_argument('--engine', choices=ENGINES, default='threaded',
+                        help="threaded = one thread per client, asyncio = single event loop")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000, help="0 picks a free port")
+    parser.add_argument('--backlog', type=int, default=1024,
+                        help="pending connections the kernel queues for accept()")
+    parser.add_argument('--handshake-timeout', type=float, default=10.0,
+                        help="seconds a new client has to send its nickname")
+    parser.add_argument('--recv-size', type=int, default=protocol.RECV_SIZE,
+                        help="bytes read from a client socket at a time")
+    parser.add_argument('--tcp-nodelay', action=argparse.BooleanOptionalAction, default=True,
+                        help="send small frames immediately instead of coalescing them (Nagle)")
+    parser.add_argument('--sndbuf', type=int, default=0,
+                        help="SO_SNDBUF bytes per client socket (0 = kernel default, autotuned)")
+    parser.add_argument('--rcvbuf', type=int, default=0,
+                        help="SO_RCVBUF bytes per client socket (0 = kernel default, autotuned)")
+    parser.add_argument('--send-mode', choices=SEND_MODES, default='sendmsg',
+                        help="threaded engine: sendmsg() the queued frames as they are or "
+                             "join them into one buffer first (asyncio batches on its own)")
+    parser.add_argument('--tls-cert', help="serve TLS with this PEM certificate (chain)")
+    parser.add_argument('--tls-key', help="PEM private key, if not in the --tls-cert file")
+    parser.add_argument('--queue-size', type=int, default=outbound.DEFAULT_QUEUE_SIZE,
+                        help="frames buffered per client before the slow-consumer policy applies")
+    parser.add_argument('--slow-policy', choices=outbound.POLICIES, default=outbound.DROP_OLDEST)
+    parser.add_argument('--history', type=int, default=history.DEFAULT_DEPTH,
+                        help="recent messages per room replayed to joiners (0 disables)")
+    parser.add_argument('--log-dir', help="append chat messages to a segment log in this directory")
+    parser.add_argument('--log-fsync', choices=chatlog.FSYNC_POLICIES, default='interval')
+    parser.add_argument('--log-segment-mb', type=int, default=64)
+    parser.add_argument('--no-compression', action='store_true',
+                        help="do not offer per-message compression to clients")
+    parser.add_argument('--no-files', action='store_true',
+                        help="do not relay file transfers between clients")
+    parser.add_argument('--max-file-mb', type=int,
+                        default=hub.DEFAULT_MAX_FILE_SIZE // (1024 * 1024),
+                        help="largest file a client may send")
+    parser.add_argument('--rate-messages', type=float, default=ratelimit.DEFAULT_MESSAGE_RATE,
+                        help="messages per second each client may send (0 = unlimited)")
+    parser.add_argument('--burst-messages', type=int, default=ratelimit.DEFAULT_MESSAGE_BURST,
+                        help="messages a client may send at once before the rate applies")
+    parser.add_argument('--rate-bytes', type=int, default=ratelimit.DEFAULT_BYTE_RATE,
+                        help="bytes per second each client may send (0 = unlimited)")
+    parser.add_argument('--burst-bytes', type=int, default=ratelimit.DEFAULT_BYTE_BURST)
+    parser.add_argument('--flood-penalty', choices=ratelimit.PENALTIES, default=ratelimit.DROP,
+                        help="what happens to a client over its rate limit")
+    parser.add_argument('--mute-seconds', type=float, default=ratelimit.DEFAULT_MUTE_SECONDS)
+    parser.add_argument('--ping-interval', type=float, default=hub.DEFAULT_PING_INTERVAL,
+                        help="seconds of silence before a client is pinged (0 disables)")
+    parser.add_argument('--pong-timeout', type=float, default=hub.DEFAULT_PONG_TIMEOUT,
+                        help="seconds a pinged client has to answer before it is disconnected")
+    parser.add_argument('--drain-timeout', type=float, default=hub.DEFAULT_DRAIN_TIMEOUT,
+                        help="seconds clients get to disconnect on shutdown before being cut off")
+    parser.add_argument('--drain-spread', type=float, default=hub.DEFAULT_DRAIN_SPREAD,
+                        help="seconds over which clients are told to go on shutdown/restart")
+    parser.add_argument('--pid-file', help="write the server pid here (kept current across "
+                                           "hot restarts with SIGHUP)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="worker processes sharing the port via SO_REUSEPORT")
+    parser.add_argument('--metrics-port', type=int,
+                        help="serve Prometheus metrics on this port (worker N uses port + N)")
+    parser.add_argument('--metrics-host', default='127.0.0.1')
+    return parser
+
+
+def load_config(argv=None, environ=None):
+    """Settings from argv (default: sys.argv), then CHAT_* variables from
+    environ (default: os.environ), then the built-in defaults"""
+    parser = build_parser()
+    environ = os.environ if environ is None else environ
+    defaults = {}
+    for action in parser._actions:
+        value = environ.get(ENV_PREFIX + action.dest.upper())
+        if value is None or action.dest == 'help':
+            continue
+        if action.nargs == 0:
+            # A flag such as --no-compression
+            defaults[action.dest] = value.lower() in TRUE_WORDS
+            continue
+        try:
+            value = action.type(value) if action.type else value
+        except ValueError:
+            parser.error(f"{ENV_PREFIX}{action.dest.upper()}: invalid value {value!r}")
+        if action.choices and value not in action.choices:
+            parser.error(f"{ENV_PREFIX}{action.dest.upper()}: must be one of "
+                         f"{', '.join(map(str, action.choices))}")
+        defaults[action.dest] = value
+    parser.set_defaults(**defaults)
+    return parser.parse_args(argv)
+
 
-server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server.bind((host, port))
-server.listen()
-print(f"Server started on {host}:{port}")
+# ----------------- Server -----------------
+class ChatServer:
+    """One chat server. config is a namespace as returned by load_config();
+    keyword arguments override single settings (ChatServer(port=0))."""
 
-clients = []
-nicknames = []
+    def __init__(self, config=None, bus=None, **overrides):
+        config = config if config is not None else load_config([], {})
+        self.config = argparse.Namespace(**{**vars(config), **overrides})
+        if self.config.engine not in ENGINES:
+            raise ValueError(f"unknown engine: {self.config.engine}")
+        self.bus = bus
+        self.engine = None
+        self.chat_log = None
+        self.address = None
 
-def broadcast(message):
-    for client in clients:
-        client.send(message)
+    @property
+    def hub(self):
+        return self.engine.hub if self.engine is not None else None
 
-def handle(client):
-    while True:
+    def serve(self):
+        """Start serving in background threads. Returns (host, port) once
+        the server is listening."""
+        if self.engine is not None:
+            raise RuntimeError("server already started")
+        config = self.config
+        if config.log_dir:
+            self.chat_log = chatlog.ChatLog(config.log_dir,
+                                            segment_size=config.log_segment_mb * 1024 * 1024,
+                                            fsync=config.log_fsync)
+        if config.engine == 'asyncio':
+            from async_server import AsyncEngine as engine_class
+        else:
+            from threaded_server import ThreadedEngine as engine_class
+        tls_context = None
+        if config.tls_cert:
+            tls_context = tls.server_context(config.tls_cert, config.tls_key)
+        self.engine = engine_class(config, self.chat_log, tls_context)
+        self.configure_hub(self.engine.hub)
+        if config.metrics_port:
+            self.engine.hub.metrics.serve(config.metrics_host, config.metrics_port)
         try:
-            message = client.recv(1024)
-            broadcast(message)
-        except:
-            index = clients.index(client)
-            clients.remove(client)
-            client.close()
-            nickname = nicknames[index]
-            broadcast(f"{nickname} left the chat!".encode('utf-8'))
-            nicknames.remove(nickname)
-            break
-
-def receive():
-    while True:
-        client, address = server.accept()
-        print(f"Connected with {str(address)}")
-
-        client.send("NICK".encode('utf-8'))
-        nickname = client.recv(1024).decode('utf-8')
-        nicknames.append(nickname)
-        clients.append(client)
-
-        print(f"Nickname of the client is {nickname}")
-        broadcast(f"{nickname} joined the chat!".encode('utf-8'))
-        client.send("Connected to the server!".encode('utf-8'))
-
-        thread = threading.Thread(target=handle, args=(client,))
-        thread.start()
-
-print("Server is running and waiting for connections...")
-receive()
+            self.address = self.engine.serve(self.bus)
+        except BaseException:
+            self.close_resources()
+            raise
+        return self.address
+
+    def configure_hub(self, chat_hub):
+        config = self.config
+        disabled = set()
+        if config.no_compression:
+            disabled.add(protocol.DEFLATE)
+        if config.no_files:
+            disabled.add(protocol.FILES)
+        chat_hub.features = tuple(f for f in chat_hub.features if f not in disabled)
+        chat_hub.max_file_size = config.max_file_mb * 1024 * 1024
+        chat_hub.flood = ratelimit.FloodControl(config.rate_messages, config.burst_messages,
+                                                config.rate_bytes, config.burst_bytes,
+                                                config.flood_penalty, config.mute_seconds)
+        chat_hub.ping_interval = config.ping_interval
+        chat_hub.pong_timeout = config.pong_timeout
+        chat_hub.drain_timeout = config.drain_timeout
+        chat_hub.drain_spread = config.drain_spread
+
+    def serve_forever(self):
+        """serve() and block until the server has been stopped. In the
+        main thread, SIGTERM/SIGINT drain and stop it and SIGHUP hot
+        restarts it."""
+        self.serve()
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.engine.stop())
+            signal.signal(signal.SIGINT, lambda signum, frame: self.engine.stop())
+            if self.bus is None:
+                signal.signal(signal.SIGHUP, lambda signum, frame: self.engine.stop(restart=True))
+            else:
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        try:
+            self.engine.wait()
+        finally:
+            self.close_resources()
+
+    def shutdown(self, restart=False, timeout=None):
+        """Drain and stop the server. Returns True once it has stopped."""
+        if self.engine is None:
+            return True
+        self.engine.stop(restart)
+        stopped = self.engine.wait(timeout)
+        if stopped:
+            self.close_resources()
+        return stopped
+
+    def close_resources(self):
+        if self.engine is not None:
+            self.engine.hub.metrics.stop()
+        if self.chat_log is not None:
+            self.chat_log.close()
+
+    def __enter__(self):
+        self.serve()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
+def run(config, bus=None):
+    """Serve one process until stopped (also the entry point of cluster workers)"""
+    ChatServer(config, bus=bus).serve_forever()
+
+
+def main(argv=None):
+    config = load_config(argv)
+    if config.pid_file:
+        lifecycle.write_pid_file(config.pid_file)
+    if config.workers > 1:
+        import cluster
+        cluster.run_cluster(config, run)
+    else:
+        run(config)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Chat log history across workers
+===============================
+
+With --workers every worker keeps its own log, and messages from clients
+of other workers reach it over the bus. A history page must still show
+the whole conversation of the room, whichever worker serves it.
+
+Run with:  python -m pytest test_cluster_history.py
+"""
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+import protocol
+
+CLIENTS = 8
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def connect(port, nickname):
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            sock = socket.create_connection(('127.0.0.1', port))
+            break
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+    sock.settimeout(5)
+    reader = protocol.FrameReader()
+    protocol.recv_frame(sock, reader)
+    sock.sendall(protocol.encode_nick(nickname))
+    return sock, reader
+
+
+def history_page(sock, reader):
+    """Chat texts of the newest page of the client's room"""
+    sock.sendall(protocol.encode(protocol.HISTORY, "before"))
+    while True:
+        frame_type, payload = protocol.recv_frame(sock, reader)
+        if frame_type == protocol.HISTORY:
+            return [text.decode() for _, text in protocol.parse_history_page(payload)[1]]
+
+
+@pytest.fixture
+def cluster(tmp_path):
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, 'server.py', '--host', '127.0.0.1', '--port', str(port),
+         '--workers', '2', '--log-dir', str(tmp_path), '--ping-interval', '0',
+         '--drain-timeout', '1', '--drain-spread', '0'],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    yield port
+    server.send_signal(signal.SIGINT)
+    try:
+        server.wait(10)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+def test_history_holds_messages_from_every_worker(cluster):
+    clients = [connect(cluster, f"user{number}") for number in range(CLIENTS)]
+    try:
+        for number, (sock, _) in enumerate(clients):
+            sock.sendall(protocol.encode(protocol.CHAT, f"message {number}"))
+        expected = {f"user{number}: message {number}" for number in range(CLIENTS)}
+        deadline = time.monotonic() + 5
+        for sock, reader in clients:
+            while True:
+                seen = set(history_page(sock, reader))
+                if seen >= expected or time.monotonic() > deadline:
+                    break
+                time.sleep(0.1)
+            assert seen >= expected
+    finally:
+        for sock, _ in clients:
+            sock.close()
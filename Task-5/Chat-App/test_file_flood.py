@@ -0,0 +1,64 @@
+"""
+FILE_DATA and flood control
+===========================
+
+Chunks of an accepted transfer are paced by the recipient and skip the
+flood limits. Any other FILE_DATA frame (unknown id, or a file nobody
+accepted yet) is charged like a chat message, so it cannot be used to
+push megabytes past the limiter.
+
+Run with:  python -m pytest test_file_flood.py
+"""
+
+import outbound
+import protocol
+import ratelimit
+from hub import ChatHub
+from registry import ClientRegistry
+
+CHUNK = b'x' * protocol.FILE_CHUNK_SIZE
+
+
+def file_hub():
+    disconnected = []
+    hub = ChatHub(ClientRegistry(), disconnected.append)
+    hub.flood.penalty = ratelimit.DISCONNECT
+    clients = [hub.join(nickname, nickname, outbound.OutboundQueue(1000), (protocol.FILES,))
+               for nickname in ('alice', 'bob')]
+    return hub, clients, disconnected
+
+
+def chunk(upload_id):
+    return protocol.FILE_ID.pack(upload_id) + CHUNK
+
+
+def test_stray_chunks_are_flood_limited():
+    hub, (alice, _), disconnected = file_hub()
+    for _ in range(10):
+        hub.handle_frame(alice, protocol.FILE_DATA, chunk(7))
+    assert disconnected == ['alice']
+    assert hub.flood_disconnects.value() == 1
+
+
+def test_chunks_before_accept_are_flood_limited():
+    hub, (alice, bob), disconnected = file_hub()
+    size = 10 * len(CHUNK)
+    hub.handle_frame(alice, protocol.FILE, f"offer 1 {size} bob notes.txt".encode())
+    hub.handle_frame(alice, protocol.FILE_DATA, chunk(1))
+    assert 1 not in alice.uploads and not bob.downloads
+    for _ in range(10):
+        hub.handle_frame(alice, protocol.FILE_DATA, chunk(1))
+    assert disconnected == ['alice']
+
+
+def test_accepted_chunks_skip_flood_limits():
+    hub, (alice, bob), disconnected = file_hub()
+    size = 10 * len(CHUNK)
+    hub.handle_frame(alice, protocol.FILE, f"offer 1 {size} bob notes.txt".encode())
+    (transfer_id,) = bob.downloads
+    hub.handle_frame(bob, protocol.FILE, f"accept {transfer_id}".encode())
+    for _ in range(10):
+        hub.handle_frame(alice, protocol.FILE_DATA, chunk(1))
+        bob.queue.get_batch()
+    assert disconnected == []
+    assert hub.file_bytes.value() == size
@@ -0,0 +1,70 @@
+"""
+Paging back through the chat log
+================================
+
+"before ..." HISTORY requests come straight from clients, so whatever
+offset or anchor text they hold must get an answer (possibly an empty
+page) and never an exception.
+
+Run with:  python -m pytest test_history_paging.py
+"""
+
+import pytest
+
+import outbound
+import protocol
+from chatlog import ChatLog
+from hub import ChatHub
+from registry import ClientRegistry
+
+
+@pytest.fixture
+def hub(tmp_path):
+    log = ChatLog(str(tmp_path), batch_size=0)
+    for number in range(300):
+        log.append('lobby', protocol.encode(protocol.CHAT, f"alice: message {number}"))
+        if number % 100 == 0:
+            log.append('quiet', protocol.encode(protocol.CHAT, f"bob: quiet {number}"))
+    yield ChatHub(ClientRegistry(), lambda key: None, log=log)
+    log.close()
+
+
+def ask(hub, request, room='lobby'):
+    """Send a HISTORY request; returns (offset, chat texts) of the page"""
+    queue = outbound.OutboundQueue(100)
+    client = hub.join(object(), 'reader', queue)
+    hub.registry.move(client, room)
+    queue.get_batch()
+    hub.send_log(client, request)
+    (frame_type, payload), = protocol.FrameReader().feed(b''.join(queue.get_batch()))
+    assert frame_type == protocol.HISTORY
+    offset, frames = protocol.parse_history_page(payload)
+    return offset, [text.decode() for _, text in frames]
+
+
+def test_page_before_anchor(hub):
+    offset, texts = ask(hub, "before\nalice: message 250")
+    assert texts == [f"alice: message {number}" for number in range(150, 250)]
+    offset, texts = ask(hub, f"before {offset}")
+    assert texts == [f"alice: message {number}" for number in range(50, 150)]
+
+
+def test_page_of_quiet_room(hub):
+    _, texts = ask(hub, "before", room='quiet')
+    assert texts == ["bob: quiet 0", "bob: quiet 100", "bob: quiet 200"]
+
+
+@pytest.mark.parametrize('anchor, room', [
+    ("alice: never said this", 'lobby'),   # not logged
+    ("[DM] alice: message 5", 'lobby'),    # direct messages are never logged
+    ("[DM to alice] hello", 'lobby'),
+    ("alice: message 5", 'quiet'),         # logged, but in another room
+])
+def test_anchor_not_found_gives_empty_page(hub, anchor, room):
+    assert ask(hub, "before\n" + anchor, room)[1] == []
+
+
+@pytest.mark.parametrize('offset', [7, 1, 10 ** 12])
+def test_offset_inside_record_gives_empty_page(hub, offset):
+    assert ask(hub, f"before {offset}")[1] == []
+    assert hub.log.read_before(offset, 'lobby') == ([], offset)
@@ -0,0 +1,71 @@
+"""
+Messages at the frame size limit
+================================
+
+The hub prefixes chat with the sender's nickname (and, across workers,
+wraps it in a room-tagged bus message), so a client frame that is just
+under MAX_FRAME_SIZE can no longer be encoded. Such a message must be
+refused with a SYSTEM reply, not end the sender's connection.
+
+Run with:  python -m pytest test_message_size.py
+"""
+
+import pytest
+
+import cluster
+import outbound
+import protocol
+from hub import ChatHub
+from registry import ClientRegistry
+
+
+class RecordingBus:
+    """Stands in for cluster.BusClient and keeps what was published"""
+
+    def __init__(self):
+        self.published = []
+
+    max_frame_size = cluster.BusClient.max_frame_size
+
+    def publish(self, room, frame, chat=False):
+        self.published.append(cluster.encode_room(room, frame, chat))
+
+
+def chat_hub(clustered):
+    disconnected = []
+    hub = ChatHub(ClientRegistry(), disconnected.append)
+    hub.bus = RecordingBus() if clustered else None
+    hub.flood.message_rate = hub.flood.byte_rate = 0
+    queue = outbound.OutboundQueue(100)
+    client = hub.join('sender', 'sender', queue)
+    queue.get_batch()
+    if clustered:
+        hub.bus.published.clear()
+    return hub, client, disconnected
+
+
+def frames(queue):
+    return list(protocol.FrameReader().feed(b''.join(queue.get_batch() or [])))
+
+
+@pytest.mark.parametrize('clustered', [False, True])
+@pytest.mark.parametrize('text', [
+    'x' * (protocol.MAX_FRAME_SIZE - 3),
+    '/msg sender ' + 'x' * (protocol.MAX_FRAME_SIZE - 12),   # to itself: "[DM] sender: "
+], ids=['chat', 'direct'])
+def test_oversized_message_is_refused(clustered, text):
+    hub, client, disconnected = chat_hub(clustered)
+    hub.handle_frame(client, protocol.CHAT, text.encode())
+    assert frames(client.queue) == [(protocol.SYSTEM, b"Message too long, not sent")]
+    assert disconnected == []
+    assert not clustered or hub.bus.published == []
+
+
+@pytest.mark.parametrize('clustered', [False, True])
+def test_largest_message_is_sent(clustered):
+    hub, client, _ = chat_hub(clustered)
+    text = 'x' * (hub.max_chat_size(client.room) - len('sender: '))
+    hub.handle_frame(client, protocol.CHAT, text.encode())
+    (frame_type, payload), = frames(client.queue)
+    assert (frame_type, len(payload)) == (protocol.CHAT, hub.max_chat_size(client.room))
+    assert not clustered or len(hub.bus.published) == 1
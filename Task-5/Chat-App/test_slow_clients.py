@@ -0,0 +1,96 @@
+"""
+Slow clients under the block policy
+===================================
+
+A client that stops reading fills its outbound queue, and under
+--slow-policy block a plain put() then waits for room that never comes.
+Nothing the server does on its own behalf (heartbeat PINGs, the CLOSE
+frame on shutdown) may wait like that.
+
+Run with:  python -m pytest test_slow_clients.py
+"""
+
+import socket
+import threading
+import time
+
+import pytest
+
+import outbound
+import protocol
+from hub import ChatHub
+from registry import ClientRegistry
+from server import ChatServer
+
+
+def stalled_hub(queue_size=2):
+    """A hub with one registered client whose full queue nobody drains"""
+    disconnected = []
+    hub = ChatHub(ClientRegistry(), disconnected.append)
+    hub.ping_interval = 5.0
+    hub.pong_timeout = 1.0
+    queue = outbound.OutboundQueue(queue_size, outbound.BLOCK)
+    client = hub.join('stalled', 'stalled', queue)
+    while queue.put_nowait(protocol.encode(protocol.CHAT, "filler")):
+        pass
+    return hub, client, disconnected
+
+
+def run_briefly(target, *args):
+    """Run target in a thread; True if it returned within a second"""
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    thread.join(1.0)
+    return not thread.is_alive()
+
+
+def test_heartbeat_reaps_client_with_full_queue():
+    hub, client, disconnected = stalled_hub()
+    due = client.last_seen + hub.ping_interval + 2 * hub.wheel.tick
+    assert run_briefly(hub.heartbeat, due)
+    assert disconnected == ['stalled']
+    assert hub.reaped.value() == 1
+    assert hub.pings_sent.value() == 0
+
+
+def test_heartbeat_pings_client_with_room():
+    hub, client, disconnected = stalled_hub()
+    client.queue.get_batch()
+    due = client.last_seen + hub.ping_interval + 2 * hub.wheel.tick
+    assert run_briefly(hub.heartbeat, due)
+    assert disconnected == []
+    assert client.queue.get_batch() == [protocol.encode(protocol.PING)]
+
+
+def stalled_connection(port):
+    """A client that completes the handshake, then sends chat until the
+    server stops reading from it, and never reads anything itself"""
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.connect(('127.0.0.1', port))
+    protocol.recv_frame(sock, protocol.FrameReader())
+    sock.sendall(protocol.encode_nick('stalled'))
+    sock.settimeout(0.5)
+    try:
+        while True:
+            sock.sendall(protocol.encode(protocol.CHAT, 'x' * 30000))
+    except socket.timeout:
+        pass
+    return sock
+
+
+@pytest.mark.parametrize('engine', ['threaded', 'asyncio'])
+def test_drain_timeout_applies_to_client_that_never_reads(engine):
+    server = ChatServer(engine=engine, host='127.0.0.1', port=0, slow_policy=outbound.BLOCK,
+                        queue_size=8, sndbuf=4096, ping_interval=0, drain_spread=0,
+                        drain_timeout=1.0, rate_messages=1e6, burst_messages=10**6,
+                        rate_bytes=10**9, burst_bytes=10**9)
+    _, port = server.serve()
+    sock = stalled_connection(port)
+    try:
+        assert len(server.hub.registry) == 1
+        started = time.monotonic()
+        assert server.shutdown(timeout=5)
+        assert time.monotonic() - started < 3
+    finally:
+        sock.close()
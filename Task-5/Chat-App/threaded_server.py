@@ -0,0 +1,233 @@
+"""
+Threaded engine
+===============
+
+The classic engine: one reader thread and one writer thread per
+connected client, plus one thread that accepts and one that drives the
+heartbeat timer wheel. Blocking sockets keep every piece simple; the
+cost is a few hundred KB of stack per client. With TLS the two threads
+share each connection through tls.LockedTLSSocket.
+"""
+
+import selectors
+import socket
+import threading
+import time
+
+import lifecycle
+import outbound
+import protocol
+import tls
+from history import ChatHistory
+from hub import ChatHub
+from registry import ClientRegistry
+
+
+class ThreadedEngine:
+    def __init__(self, config, chat_log=None, tls_context=None):
+        self.config = config
+        self.tls = tls_context
+        self.registry = ClientRegistry()
+        self.hub = ChatHub(self.registry, self.disconnect, ChatHistory(config.history), chat_log)
+        self.listener = None
+        # Written to by stop() to wake the accept loop
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.done = threading.Event()
+
+    # ----------------- Connections -----------------
+    def disconnect(self, client):
+        # Waking the reader is enough: its recv() fails and it cleans up
+        try:
+            client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def write(self, client, queue):
+        # SSL sockets have no sendmsg()
+        sendmsg = self.config.send_mode == 'sendmsg' and self.tls is None
+        while True:
+            batch = queue.get_batch()
+            if batch is None:
+                break
+            try:
+                if sendmsg:
+                    self.hub.socket_writes.inc(protocol.send_frames(client, batch))
+                else:
+                    client.sendall(b''.join(batch))
+                    self.hub.socket_writes.inc()
+            except OSError:
+                queue.close()
+                self.disconnect(client)
+                return
+        # Everything queued is sent (the CLOSE frame last, after a goodbye),
+        # so hang up; the reader then fails and cleans up
+        self.disconnect(client)
+
+    def handshake(self, client):
+        """NICK exchange with a deadline, so a client that never answers only
+        ties up its own thread. Returns (nickname, features, reader) or None
+        on failure."""
+        hub = self.hub
+        reader = protocol.FrameReader()
+        client.settimeout(self.config.handshake_timeout)
+        try:
+            client.sendall(protocol.encode(protocol.NICK, ' '.join(hub.features)))
+            frame_type, payload = protocol.recv_frame(client, reader, self.config.recv_size)
+        except (OSError, protocol.ProtocolError):
+            return None
+        if frame_type != protocol.NICK:
+            return None
+        nickname, features = protocol.parse_nick(payload)
+        if not protocol.valid_nickname(nickname):
+            try:
+                client.sendall(protocol.encode(protocol.SYSTEM, protocol.NICKNAME_RULES))
+            except OSError:
+                pass
+            return None
+        client.settimeout(None)
+        return nickname, features, reader
+
+    def tls_handshake(self, client):
+        """The TLS handshake, with the same deadline as the NICK exchange.
+        Returns False on failure."""
+        client.settimeout(self.config.handshake_timeout)
+        try:
+            client.do_handshake()
+        except OSError:
+            return False
+        self.hub.tls_connected(client.session_reused)
+        return True
+
+    def handle(self, client, address):
+        hub = self.hub
+        print(f"Connected with {str(address)}")
+        protocol.tune_socket(client, self.config.tcp_nodelay)
+        joined = None
+        if self.tls is not None:
+            client = tls.LockedTLSSocket(client, self.tls)
+        if self.tls is None or self.tls_handshake(client):
+            joined = self.handshake(client)
+        if joined is None:
+            print(f"Handshake with {str(address)} failed")
+            hub.handshake_failures.inc()
+            client.close()
+            return
+        nickname, features, reader = joined
+        queue = outbound.OutboundQueue(self.config.queue_size, self.config.slow_policy)
+        threading.Thread(target=self.write, args=(client, queue), daemon=True).start()
+        try:
+            info = hub.join(client, nickname, queue, features)
+            print(f"Nickname of the client is {info.nickname}")
+            # Anything that arrived together with the nickname is parsed first
+            frames = reader.feed(b'')
+            while True:
+                for frame_type, payload in frames:
+                    hub.handle_frame(info, frame_type, payload)
+                frames = protocol.recv_frames(client, reader, self.config.recv_size)
+                hub.socket_reads.inc()
+        except (OSError, protocol.ProtocolError):
+            pass
+        finally:
+            hub.leave(client)
+            # Also ends the writer if join() failed before registering
+            queue.close()
+            client.close()
+
+    # ----------------- Serving -----------------
+    def serve(self, bus=None):
+        """Listen and start the accept and heartbeat threads.
+        Returns the (host, port) the server is listening on."""
+        config = self.config
+        self.listener = lifecycle.inherited_listener()
+        if self.listener is None:
+            self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if bus is not None:
+                # Sibling workers listen on the same port
+                self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.listener.bind((config.host, config.port))
+            self.listener.listen(config.backlog)
+            print(f"Server started on {config.host}:{self.listener.getsockname()[1]}")
+        else:
+            print(f"Server took over {self.listener.getsockname()} from the previous process")
+        # Accepted sockets inherit the buffer sizes, and setting them on the
+        # listener lets the window scale offered in the SYN-ACK match them
+        protocol.tune_socket(self.listener, config.tcp_nodelay, config.sndbuf, config.rcvbuf)
+        self.listener.setblocking(False)
+        if bus is not None:
+            self.hub.bus = bus
+            bus.start(self.hub)
+        threading.Thread(target=self.accept_loop, name='accept').start()
+        if self.hub.ping_interval:
+            threading.Thread(target=self.heartbeat_loop, name='heartbeat', daemon=True).start()
+        print("Server is running and waiting for connections...")
+        return self.listener.getsockname()[:2]
+
+    def accept_loop(self):
+        # The accept loop does nothing but accept, so a burst of connection
+        # attempts is drained as fast as the kernel hands them over
+        selector = selectors.DefaultSelector()
+        selector.register(self.listener, selectors.EVENT_READ)
+        selector.register(self.wakeup_recv, selectors.EVENT_READ)
+        try:
+            while not self.hub.draining:
+                for key, _ in selector.select():
+                    if key.fileobj is self.listener:
+                        self.accept_pending()
+        finally:
+            selector.close()
+            self.listener.close()
+            self.drain()
+            self.wakeup_recv.close()
+            self.wakeup_send.close()
+            self.done.set()
+
+    def accept_pending(self):
+        while True:
+            try:
+                client, address = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # Out of file descriptors and the like: back off a little
+                print(f"accept() failed: {e}")
+                time.sleep(0.1)
+                return
+            threading.Thread(target=self.handle, args=(client, address)).start()
+
+    def heartbeat_loop(self):
+        # One thread drives the timer wheel for every connection
+        while not self.done.wait(self.hub.wheel.tick):
+            self.hub.heartbeat()
+
+    # ----------------- Shutdown -----------------
+    def stop(self, restart=False):
+        """Begin a graceful shutdown; safe to call from any thread or a
+        signal handler. With restart, a new process takes over the port."""
+        hub = self.hub
+        if hub.draining:
+            return
+        print("Restarting..." if restart else "Shutting down...")
+        hub.begin_drain(lifecycle.RESTART_REASON if restart else lifecycle.SHUTDOWN_REASON)
+        if restart:
+            lifecycle.spawn_successor(self.listener)
+        self.wakeup_send.send(b'\0')
+
+    def drain(self):
+        hub = self.hub
+        # The timeout covers the goodbyes too, however they are spread
+        deadline = time.monotonic() + hub.drain_timeout
+        clients = self.registry.clients()
+        pause = hub.drain_spread / len(clients) if clients else 0
+        for client in clients:
+            hub.goodbye(client)
+            time.sleep(max(0, min(pause, deadline - time.monotonic())))
+        while len(self.registry) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        for client in self.registry.clients():
+            self.disconnect(client.key)
+        print(f"Drained {len(clients)} clients")
+
+    def wait(self, timeout=None):
+        """Block until the server has drained. Returns True if it has."""
+        return self.done.wait(timeout)
@@ -0,0 +1,66 @@
+"""
+Timer wheel
+===========
+
+A hashed timing wheel: a ring of slots, each covering `tick` seconds.
+Scheduling drops an item into the slot its deadline falls in, and
+advance() walks the slots that have passed since the last call and hands
+back the items that are due. Both are O(1) per item, so one wheel driven
+by one thread (or one asyncio task) can watch every connection instead
+of keeping a timer per connection.
+
+Deadlines further away than one turn of the ring simply stay in their
+slot until the wheel comes round to them with the deadline reached.
+There is no cancel: owners check whether an item they get back still
+matters, which keeps the hot path (a connection doing something) free of
+any wheel bookkeeping.
+"""
+
+import math
+import threading
+import time
+
+DEFAULT_TICK = 1.0
+DEFAULT_SLOTS = 64
+
+
+class TimerWheel:
+    def __init__(self, tick=DEFAULT_TICK, slots=DEFAULT_SLOTS, now=None):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.lock = threading.Lock()
+        # Index of the next tick advance() has to look at
+        self.current = self._tick_of(time.monotonic() if now is None else now)
+
+    def __len__(self):
+        return sum(len(slot) for slot in self.slots)
+
+    def _tick_of(self, when):
+        return math.floor(when / self.tick)
+
+    def schedule(self, deadline, item):
+        """Return item from advance() once deadline has passed"""
+        with self.lock:
+            # Anything already due fires on the next advance()
+            slot = max(self._tick_of(deadline), self.current)
+            self.slots[slot % len(self.slots)].append((deadline, item))
+
+    def advance(self, now=None):
+        """Pop and return every item whose deadline is <= now"""
+        now = time.monotonic() if now is None else now
+        due = []
+        with self.lock:
+            last = self._tick_of(now)
+            # After a long stall, one turn of the ring covers every slot
+            first = max(self.current, last - len(self.slots) + 1)
+            for tick in range(first, last + 1):
+                index = tick % len(self.slots)
+                slot = self.slots[index]
+                if not slot:
+                    continue
+                keep = []
+                for entry in slot:
+                    (due if entry[0] <= now else keep).append(entry)
+                self.slots[index] = keep
+            self.current = last
+        return [item for _, item in due]
@@ -0,0 +1,157 @@
+"""
+TLS
+===
+
+Optional TLS for the chat protocol, standard library only. The server
+turns it on with --tls-cert (and --tls-key unless the key is in the same
+PEM file); clients pass a context from client_context() to ChatClient.
+
+Session resumption: the server hands out TLS session tickets and a
+client that reconnects offers the ticket from its previous connection.
+The server then skips the certificate exchange and signature, which is
+most of what a handshake costs. Tickets are sealed with a key OpenSSL
+picks at random for each server process and that never leaves its
+memory, so they resume only with the process that issued them: after a
+hot restart, or on another worker, clients pay a full handshake. A key
+shared between processes would have to be stored and rotated, and
+Python's ssl module has no way to set one.
+
+Certificates for local testing:
+
+    python tls.py certs/      # writes certs/cert.pem and certs/key.pem (add rsa for RSA-2048)
+    python server.py --tls-cert certs/cert.pem --tls-key certs/key.pem
+    python client_gui.py --tls --tls-ca certs/cert.pem
+"""
+
+import os
+import select
+import socket
+import ssl
+import subprocess
+import sys
+import threading
+import time
+
+
+# ----------------- Contexts -----------------
+def server_context(cert, key=None):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(cert, key)
+    return context
+
+
+def client_context(cafile=None):
+    """Verifies the server against cafile, or the system's CAs if None"""
+    context = ssl.create_default_context(cafile=cafile)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    return context
+
+
+class Resuming:
+    """Passed to asyncio in place of an SSLContext to offer a session from
+    an earlier connection, which asyncio itself has no argument for"""
+
+    def __init__(self, context, session):
+        self.context = context
+        self.session = session
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None):
+        return self.context.wrap_bio(incoming, outgoing, server_side, server_hostname,
+                                     session=self.session)
+
+
+# ----------------- Threaded Engine -----------------
+class LockedTLSSocket:
+    """A server-side TLS socket shared by a reader and a writer thread.
+    OpenSSL allows only one thread in a connection at a time, so every
+    call holds a lock; the socket is non-blocking underneath and threads
+    wait for it outside the lock, so a blocked writer never stalls the
+    reader or the other way round."""
+
+    def __init__(self, sock, context):
+        self.sock = context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+        self.sock.setblocking(False)
+        self.lock = threading.Lock()
+        self.timeout = None
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def _call(self, method, *args):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            with self.lock:
+                try:
+                    return method(*args)
+                except ssl.SSLWantReadError:
+                    events = select.POLLIN
+                except ssl.SSLWantWriteError:
+                    events = select.POLLOUT
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise socket.timeout("timed out")
+            # poll() rather than select(), which fails for descriptors past
+            # FD_SETSIZE (1024) and a busy server has many more than that
+            poller = select.poll()
+            fd = self.sock.fileno()
+            if fd < 0:
+                # Closed by the other thread meanwhile
+                raise OSError("socket closed")
+            poller.register(fd, events)
+            poller.poll(None if remaining is None else remaining * 1000)
+
+    def do_handshake(self):
+        self._call(self.sock.do_handshake)
+
+    @property
+    def session_reused(self):
+        return self.sock.session_reused
+
+    def recv_into(self, buffer, nbytes=0):
+        return self._call(self.sock.recv_into, buffer, nbytes)
+
+    def sendall(self, data):
+        with memoryview(data) as view:
+            while view:
+                view = view[self._call(self.sock.send, view):]
+
+    def shutdown(self, how):
+        # Plain TCP shutdown (no close_notify): wakes the reader in select()
+        socket.socket.shutdown(self.sock, how)
+
+    def close(self):
+        self.sock.close()
+
+
+# ----------------- Certificates -----------------
+KEY_TYPES = {
+    'ec': ('-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1'),
+    'rsa': ('-newkey', 'rsa:2048'),
+}
+
+
+def generate_certificate(directory, hostnames=('localhost', '127.0.0.1'), days=365, key_type='ec'):
+    """A self-signed certificate and key for local testing, made with the
+    openssl command line tool. Returns (cert path, key path)."""
+    os.makedirs(directory, exist_ok=True)
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    names = ','.join(f"IP:{name}" if name.replace('.', '').isdigit() else f"DNS:{name}"
+                     for name in hostnames)
+    subprocess.run(['openssl', 'req', '-x509', *KEY_TYPES[key_type], '-nodes',
+                    '-days', str(days), '-subj', f"/CN={hostnames[0]}",
+                    '-addext', f"subjectAltName={names}", '-keyout', key, '-out', cert],
+                   check=True, capture_output=True)
+    return cert, key
+
+
+def main():
+    directory = sys.argv[1] if len(sys.argv) > 1 else 'certs'
+    key_type = sys.argv[2] if len(sys.argv) > 2 else 'ec'
+    cert, key = generate_certificate(directory, key_type=key_type)
+    print(f"Certificate: {cert}\nKey: {key}")
+
+
+if __name__ == '__main__':
+    main()